@@ -9,50 +9,1407 @@ GitHub: https://github.com/Lorry-San/route-load-balancing
 License: MIT
 """
 
+import abc
 import socket
 import threading
+import asyncio
 import time
 import argparse
+import array
 import sys
 import os
 import signal
+import bisect
+import heapq
+import collections
+import random
+import selectors
+import queue
+import itertools
+import errno
+import json
+import struct
 import logging
-from logging.handlers import RotatingFileHandler
+import hashlib
+import math
+import unicodedata
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 __version__ = "1.0.0"
 
+# splice零拷贝转发（Linux + Python 3.10+）
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+SPLICE_CHUNK = 65536  # 与默认管道容量一致
+
+# 客户端TCP Fast Open（Linux 4.11+，Python未导出该常量）
+TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30 if sys.platform.startswith('linux') else None)
+
+# 多进程模式：工作进程上报统计的间隔（秒）
+WORKER_REPORT_INTERVAL = 1
+# 工作进程运行不足该秒数即退出（如端口绑定失败）时，重启间隔从1秒起逐次加倍，最长WORKER_RESTART_MAX_DELAY秒
+WORKER_STABLE_UPTIME = 10
+WORKER_RESTART_MAX_DELAY = 60
+# 合并多进程统计时不求和、直接取最新值的字段
+NON_ADDITIVE_STATS = ('health', 'size_adapt')
+
+# 控制socket：命令连接及平滑升级交接的超时（秒）
+CONTROL_TIMEOUT = 30
+# 控制命令stats计算速率的时间窗口（秒）
+RATE_WINDOWS = (1, 10, 60)
+
+# 准入控制拒绝原因：reject=超出上限（或队列已满），timeout=排队超时，shed=排队时被新来的挤掉，per_ip=单IP超限
+OVERLOAD_REASONS = ('reject', 'timeout', 'shed', 'per_ip')
+OVERLOAD_POLICIES = ('reject', 'queue', 'shed')
+
+# 线路限速：令牌桶默认容量为多少秒的流量（且不小于SHAPE_MIN_BURST字节）；UDP超速时 drop=丢弃, queue=排队
+SHAPE_BURST_SECONDS = 0.05
+SHAPE_MIN_BURST = 16384
+SHAPE_POLICIES = ('drop', 'queue')
+
+# 首包大小直方图的桶上界（字节）：32B起每个2的幂再分4格，也是自适应阈值的候选值
+PACKET_SIZE_BUCKETS = tuple(sorted({base + base * k // 4 for base in (2 ** e for e in range(5, 16)) for k in range(4)} | {65536}))
+# 自适应小包阈值：直方图每个调整周期的衰减系数、开始调整所需的最少样本数、
+# 预计主线路占比与目标相差多少以内不调整（滞回，避免阈值来回跳动）
+SIZE_ADAPT_DECAY = 0.5
+SIZE_ADAPT_MIN_SAMPLES = 50
+SIZE_ADAPT_HYSTERESIS = 0.05
+
+# 连接延迟直方图的桶上界（秒），与Prometheus默认桶一致
+CONNECT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 健康检查：EWMA平滑系数，及延迟优选的最小容差（秒）
+EWMA_ALPHA = 0.3
+LATENCY_SLACK = 0.005
+
+# 多线路绑定：子连接握手（魔数、会话ID、线路编号、线路数）及数据帧头（序号、长度、标志）
+BOND_MAGIC = b'BS2B'
+BOND_HELLO = struct.Struct('!4s16sBB')
+BOND_FRAME = struct.Struct('!IIB')
+BOND_FIN = 0x01
+BOND_QUEUE_LIMIT = 262144  # 每条子连接发送队列上限（字节）
+BOND_REORDER_LIMIT = 8 * 1024 * 1024  # 接收端乱序缓冲上限（字节）
+BOND_RATE_PRIOR = 1024 * 1024  # 尚未测得速率时，每单位权重的假定速率（字节/秒）
+BOND_RATE_WINDOW = 0.1  # 每累计多少秒发送耗时更新一次速率
+BOND_NOTSENT_LOWAT = 131072  # 子连接内核中未发出数据的上限，使发送阻塞能反映线路实际速率
+
+
+class ShardedCounters:
+    """按线程分片的计数器：写入只修改本线程的分片（无需加锁），读取时合并所有分片"""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []  # [(线程, 分片字典)]
+        self.retired = {}  # 已结束线程的分片合并结果
+        self.lock = threading.Lock()  # 只保护分片的注册与合并
+
+    def add(self, key, value=1):
+        """累加计数"""
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.local.shard = self.register()
+        shard[key] = shard.get(key, 0) + value
+
+    def register(self):
+        """为当前线程注册新分片"""
+        shard = {}
+        with self.lock:
+            # 每连接线程模式下线程不断新建，定期回收已结束线程的分片
+            if len(self.shards) >= 256:
+                self.fold_finished()
+            self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def fold_finished(self):
+        """将已结束线程的分片并入retired（调用方需持有锁）"""
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+                continue
+            for key, value in shard.items():
+                self.retired[key] = self.retired.get(key, 0) + value
+        self.shards = alive
+
+    def snapshot(self):
+        """合并所有分片，返回 {key: value}"""
+        with self.lock:
+            self.fold_finished()
+            merged = dict(self.retired)
+            shards = [shard for _, shard in self.shards]
+        for shard in shards:
+            for key, value in list(shard.items()):
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+class RateTracker:
+    """每秒记录一次各线路的累计计数，计算最近1/10/60秒的每秒速率"""
+
+    def __init__(self, windows=RATE_WINDOWS):
+        self.windows = windows
+        self.samples = collections.deque(maxlen=max(windows) + 2)  # (时间, {计数名: [各线路累计值]})
+        self.targets = None  # 样本各位置对应的目标地址
+        self.lock = threading.Lock()
+
+    def record(self, totals, targets):
+        with self.lock:
+            # 重载配置改变了线路（数量或顺序）时重新采样
+            if targets != self.targets:
+                self.samples.clear()
+                self.targets = list(targets)
+            self.samples.append((time.monotonic(), totals))
+
+    def rates(self):
+        """{窗口秒数: {计数名: [各线路每秒速率]}}，样本不足时为None；运行不满一个窗口时按最早的样本计算"""
+        with self.lock:
+            samples = list(self.samples)
+        if len(samples) < 2:
+            return {str(window): None for window in self.windows}
+        latest_time, latest = samples[-1]
+        result = {}
+        for window in self.windows:
+            base_time, base = samples[0]
+            for sample_time, totals in reversed(samples[:-1]):
+                # 采样间隔会有抖动，半秒以内视为到达窗口
+                if sample_time <= latest_time - window + 0.5:
+                    base_time, base = sample_time, totals
+                    break
+            elapsed = latest_time - base_time
+            result[str(window)] = {
+                name: [round((value - old) / elapsed, 2) for value, old in zip(values, base[name])]
+                for name, values in latest.items()
+            }
+        return result
+
+
+class DroppingQueueHandler(QueueHandler):
+    """有界日志队列：队列满时丢弃并计数，消息格式化推迟到日志线程"""
+
+    def __init__(self, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 不在业务线程格式化，%参数由日志线程的处理器展开
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BufferPool:
+    """有上限的可复用缓冲区池（配合recv_into/memoryview使用，稳态转发不再逐包分配）"""
+
+    def __init__(self, buffer_size, max_buffers, preallocate=16):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.free = [bytearray(buffer_size) for _ in range(min(preallocate, max_buffers))]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self):
+        """取出一个缓冲区，池空时临时分配"""
+        with self.lock:
+            if self.free:
+                self.hits += 1
+                return self.free.pop()
+            self.misses += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        """归还缓冲区，超出上限的直接丢弃"""
+        with self.lock:
+            if len(self.free) < self.max_buffers:
+                self.free.append(buf)
+
+
+class AdmissionRejected(Exception):
+    """新流量超出准入上限（调用方计数，不记错误日志）"""
+
+
+class AdmissionGate:
+    """并发上限与过载策略
+
+    reject=超出上限立即拒绝；queue=排队等待空位，超过期限或队列已满时拒绝新来的；
+    shed=同样排队，但队列满时丢弃等待最久的，优先服务新来的。
+    空出的名额直接交给队首的等待者，由释放名额的线程/协程接着处理，不另起线程。
+    """
+
+    def __init__(self, limit, policy, queue_timeout, drop):
+        """
+        :param limit: 最大并发数（等待队列长度与之相同）
+        :param policy: reject / queue / shed
+        :param queue_timeout: 排队最长等待时间（秒）
+        :param drop: drop(item, reason) 处理被拒绝的条目，reason为 reject/timeout/shed
+        """
+        self.limit = limit
+        self.policy = policy
+        self.queue_timeout = queue_timeout
+        self.drop = drop
+        self.active = 0
+        self.waiting = collections.deque()  # (期限, 条目)
+        self.queued = 0
+        self.lock = threading.Lock()
+
+    def admit(self, item):
+        """申请名额：获得时返回True；否则条目已排队或已被拒绝，返回False"""
+        with self.lock:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.policy == 'reject':
+                dropped = [(item, 'reject')]
+            else:
+                dropped = self.expire_locked()
+                if len(self.waiting) >= self.limit and self.policy == 'shed':
+                    dropped.append((self.waiting.popleft()[1], 'shed'))
+                if len(self.waiting) < self.limit:
+                    self.waiting.append((time.monotonic() + self.queue_timeout, item))
+                    self.queued += 1
+                else:
+                    dropped.append((item, 'reject'))
+        for dropped_item, reason in dropped:
+            self.drop(dropped_item, reason)
+        return False
+
+    def release(self):
+        """归还名额：有未过期的等待者时名额直接转给它并返回该条目（调用方接着处理），否则返回None"""
+        with self.lock:
+            dropped = self.expire_locked()
+            if self.waiting:
+                item = self.waiting.popleft()[1]
+            else:
+                item = None
+                self.active -= 1
+        for dropped_item, reason in dropped:
+            self.drop(dropped_item, reason)
+        return item
+
+    def expire(self):
+        """丢弃排队超过期限的条目"""
+        with self.lock:
+            dropped = self.expire_locked()
+        for dropped_item, reason in dropped:
+            self.drop(dropped_item, reason)
+
+    def expire_locked(self):
+        now = time.monotonic()
+        dropped = []
+        while self.waiting and self.waiting[0][0] <= now:
+            dropped.append((self.waiting.popleft()[1], 'timeout'))
+        return dropped
+
+
+class SocketProfile:
+    """socket选项配置，由逗号分隔的规格解析，如 nodelay,sndbuf=4M,keepalive=60:10:5,cc=bbr
+
+    nodelay[=0|1]、sndbuf=/rcvbuf=字节（可带K/M）、keepalive[=空闲:间隔:次数]、
+    fastopen[=队列长度]（监听为TCP_FASTOPEN，连接目标为TCP_FASTOPEN_CONNECT）、user_timeout=毫秒、cc=拥塞控制算法
+    """
+    OPTIONS = ('nodelay', 'sndbuf', 'rcvbuf', 'keepalive', 'fastopen', 'user_timeout', 'cc')
+    TCP_ONLY = ('nodelay', 'keepalive', 'fastopen', 'user_timeout', 'cc')
+
+    def __init__(self, options=None):
+        self.options = dict(options or {})
+
+    @classmethod
+    def parse(cls, spec):
+        """解析规格字符串，格式错误时抛出ValueError"""
+        options = {}
+        for item in filter(None, (part.strip() for part in spec.split(','))):
+            key, has_value, value = item.partition('=')
+            key = key.strip().replace('-', '_')
+            if key not in cls.OPTIONS:
+                raise ValueError(f"未知socket选项: {key}（可用: {', '.join(cls.OPTIONS)}）")
+            value = value.strip()
+            if not has_value and key not in ('nodelay', 'keepalive', 'fastopen'):
+                raise ValueError(f"socket选项 {key} 需要取值，如 {key}=...")
+            try:
+                options[key] = cls.parse_value(key, value)
+            except ValueError:
+                raise ValueError(f"socket选项 {key} 的取值无效: {value}")
+        return cls(options)
+
+    @staticmethod
+    def parse_value(key, value):
+        if key == 'nodelay':
+            return value in ('', '1', 'on', 'true')
+        if key in ('sndbuf', 'rcvbuf'):
+            return int(parse_size(value))
+        if key == 'keepalive':
+            if value in ('0', 'off'):
+                return False
+            # 空闲秒数:探测间隔秒数:探测次数，省略的项保持系统默认
+            parts = value.split(':') if value else []
+            if len(parts) > 3:
+                raise ValueError(value)
+            parts += [''] * (3 - len(parts))
+            return tuple(int(part) if part else None for part in parts)
+        if key == 'fastopen':
+            return int(value) if value else 256
+        if key == 'user_timeout':
+            return int(value)
+        if not value:
+            raise ValueError(value)
+        return value
+
+    def merged(self, other):
+        """合并另一配置（other中的项优先）"""
+        return SocketProfile({**self.options, **other.options})
+
+    def apply(self, sock, listener=False):
+        """在socket上设置各选项（UDP socket只设置缓冲区），返回失败的 [(选项, 错误)]"""
+        errors = []
+        is_tcp = sock.type == socket.SOCK_STREAM
+        for key, value in self.options.items():
+            if key in self.TCP_ONLY and not is_tcp:
+                continue
+            try:
+                self.set_option(sock, key, value, listener)
+            except (OSError, AttributeError, TypeError) as e:
+                errors.append((key, e))
+        return errors
+
+    @staticmethod
+    def set_option(sock, key, value, listener):
+        if key == 'nodelay':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(value))
+        elif key == 'sndbuf':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, value)
+        elif key == 'rcvbuf':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, value)
+        elif key == 'keepalive':
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(value)))
+            if value:
+                for option, seconds in zip(('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'), value):
+                    if seconds is not None:
+                        sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), seconds)
+        elif key == 'fastopen':
+            if listener:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, value)
+            else:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, int(value > 0))
+        elif key == 'user_timeout':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, value)
+        elif key == 'cc':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, value.encode())
+
+    def describe(self):
+        """可读的配置描述"""
+        items = []
+        for key, value in self.options.items():
+            if value is True or (key == 'fastopen' and value == 256):
+                items.append(key)
+            elif value is False:
+                items.append(f"{key}=off")
+            elif key == 'keepalive':
+                items.append('keepalive=' + ':'.join('' if part is None else str(part) for part in value).rstrip(':'))
+            elif key in ('sndbuf', 'rcvbuf'):
+                items.append(f"{key}={format_bytes(value)}")
+            else:
+                items.append(f"{key}={value}")
+        return ', '.join(items)
+
+
+class TokenBucket:
+    """令牌桶：每秒补充rate个令牌，最多积累burst个（不自带锁，由LineShaper加锁）"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, amount):
+        """取amount个令牌前需等待的秒数；超过桶容量的请求在桶满时即可取，差额记为欠账由后来者等待"""
+        return max(0.0, (min(amount, self.burst) - self.tokens) / self.rate)
+
+
+class LineShaper:
+    """一条线路的限速：上下行各一组令牌桶，该线路上的所有TCP连接和UDP会话共享
+
+    规格如 rate=10M,pps=5000：rate=每秒字节数（可带K/M/G，上下行各自限制），up=/down=单独指定某一方向，
+    pps=每秒UDP包数（TCP只按字节限速），burst=字节桶容量（默认为50ms的流量，且不小于16K）。
+    发送前先预约令牌（允许欠账）再等待相应时间，多个流并发时依次放行，整体速率平滑而不突发。
+    """
+    OPTIONS = ('rate', 'up', 'down', 'pps', 'burst')
+
+    def __init__(self, options, share=1):
+        """
+        :param options: parse返回的配置
+        :param share: 本进程分得的份额（多进程模式下各工作进程平分限速）
+        """
+        self.options = dict(options)
+        pps = self.options.get('pps')
+        self.bytes = {}
+        self.packets = {}
+        for direction in ('up', 'down'):
+            rate = self.options.get(direction, self.options.get('rate'))
+            if rate:
+                rate *= share
+                burst = self.options.get('burst') or max(rate * SHAPE_BURST_SECONDS, SHAPE_MIN_BURST)
+                self.bytes[direction] = TokenBucket(rate, burst)
+            if pps:
+                self.packets[direction] = TokenBucket(pps * share, max(pps * share * SHAPE_BURST_SECONDS, 1))
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec):
+        """解析规格字符串为配置字典，格式错误时抛出ValueError"""
+        options = {}
+        for item in filter(None, (part.strip() for part in spec.split(','))):
+            key, _, value = item.partition('=')
+            key = key.strip()
+            if key not in cls.OPTIONS:
+                raise ValueError(f"未知限速项: {key}（可用: {', '.join(cls.OPTIONS)}）")
+            try:
+                options[key] = float(value) if key == 'pps' else parse_size(value.strip())
+            except ValueError:
+                raise ValueError(f"限速项 {key} 的取值无效: {value}")
+            if options[key] <= 0:
+                raise ValueError(f"限速项 {key} 必须大于0: {value}")
+        if not {'rate', 'up', 'down', 'pps'} & set(options):
+            raise ValueError(f"限速规格至少需指定 rate/up/down/pps 之一: {spec}")
+        return options
+
+    def reserve(self, direction, size, packet=False, max_wait=None):
+        """预约发送size字节（packet为True时另计1个包），返回需等待的秒数；超过max_wait时不预约，返回None"""
+        buckets = []
+        if direction in self.bytes:
+            buckets.append((self.bytes[direction], size))
+        if packet and direction in self.packets:
+            buckets.append((self.packets[direction], 1))
+        if not buckets:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            for bucket, _ in buckets:
+                bucket.refill(now)
+            wait = max(bucket.delay(amount) for bucket, amount in buckets)
+            if max_wait is not None and wait > max_wait:
+                return None
+            for bucket, amount in buckets:
+                bucket.tokens -= amount
+        return wait
+
+    def describe(self):
+        """可读的限速描述（配置值，不含多进程分摊）"""
+        items = []
+        up = self.options.get('up', self.options.get('rate'))
+        down = self.options.get('down', self.options.get('rate'))
+        if up and up == down:
+            items.append(f"上下行各 {format_bytes(up)}/s")
+        else:
+            if up:
+                items.append(f"上行 {format_bytes(up)}/s")
+            if down:
+                items.append(f"下行 {format_bytes(down)}/s")
+        if 'pps' in self.options:
+            items.append(f"UDP {self.options['pps']:g}包/s")
+        if 'burst' in self.options:
+            items.append(f"突发 {format_bytes(self.options['burst'])}")
+        return '，'.join(items)
+
+
+class UdpPacer:
+    """限速排队的UDP回包：到预约时间再发出（回包分发线程为所有会话共用，不能在其中等待）"""
+
+    def __init__(self):
+        self.heap = []  # (发送时间, 序号, socket, 数据, 客户端地址)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, sock, data, address):
+        """delay秒后经sock把data发给address"""
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), sock, data, address))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.cond.wait(timeout)
+                _, _, sock, data, address = heapq.heappop(self.heap)
+            try:
+                sock.sendto(data, address)
+            except OSError:
+                pass
+
+
+class BalanceStrategy(abc.ABC):
+    """分流策略接口：由--mode选择，select返回(目标索引, 是否小包)"""
+    name = None
+    description = ''
+    # 是否需要先读取TCP首包再选择线路；不需要时连接建立后立即连接目标
+    needs_first_packet = False
+
+    def __init__(self, balancer):
+        self.lb = balancer
+
+    @abc.abstractmethod
+    def select(self, protocol, client_address, packet_size):
+        """为新连接/新会话选择目标线路（未读取首包的TCP连接packet_size为None）"""
+
+    def classify(self, packet_size):
+        """是否小包，未读取首包时为None"""
+        return None if packet_size is None else packet_size < self.lb.small_packet_size
+
+    def label(self, protocol, is_small):
+        """日志标签"""
+        return f"{protocol.upper()}{self.description}"
+
+    def rules(self):
+        """启动信息中的规则说明"""
+        return [f"所有连接按{self.description}分配"]
+
+    def candidates(self, lines):
+        """快照中可分配的线路（已考虑健康检查）"""
+        allowed = self.lb.preferred_targets(lines)
+        return allowed if allowed is not None else list(range(len(lines.targets)))
+
+    def failover_order(self, client_address, first_index, lines):
+        """TCP连接失败时依次尝试的线路"""
+        return self.lb.failover_order(first_index, lines)
+
+
+class RoundRobinStrategy(BalanceStrategy):
+    """自动轮询（从主线路开始）"""
+    name = 'auto'
+    description = '自动轮询分流'
+
+    def select(self, protocol, client_address, packet_size):
+        _, target_index = self.lb.get_next_target(protocol)
+        return target_index, self.classify(packet_size)
+
+    def label(self, protocol, is_small):
+        if self.lb.weighted:
+            return f"{protocol.upper()}加权轮询"
+        count = self.lb.tcp_connection_count if protocol == 'tcp' else self.lb.udp_connection_count
+        return f"{protocol.upper()}轮询#{(count % self.lb.target_count) + 1}"
+
+    def rules(self):
+        if self.lb.weighted:
+            return ["所有连接按权重平滑轮询分配"]
+        return ["所有连接自动轮询分配（从主线路开始）"]
+
+
+class SizeStrategy(BalanceStrategy):
+    """按首包大小分流：小包走主线路，大包轮询"""
+    name = 'size'
+    description = '按包大小分流'
+    needs_first_packet = True
+
+    def select(self, protocol, client_address, packet_size):
+        if packet_size is None:
+            # 等待首包超时（如服务端先发言的协议）：走主线路
+            self.lb.counters.add(('size_none',))
+            _, target_index = self.lb.get_primary_target(protocol)
+            return target_index, None
+        self.lb.counters.add(('size_bucket', bisect.bisect_right(PACKET_SIZE_BUCKETS, packet_size)))
+        if packet_size < self.lb.small_packet_size:
+            _, target_index = self.lb.get_primary_target(protocol)
+            return target_index, True
+        _, target_index = self.lb.get_next_target(protocol)
+        return target_index, False
+
+    def label(self, protocol, is_small):
+        if is_small is None:
+            return f"{protocol.upper()}首包超时"
+        return f"{protocol.upper()}{'小' if is_small else '大'}包"
+
+    def rules(self):
+        rules = [
+            f"包 < {self.lb.small_packet_size}B -> 主线路(目标{self.lb.primary_index + 1})",
+            f"包 >= {self.lb.small_packet_size}B -> 轮询所有线路",
+            f"TCP {self.lb.peek_timeout}秒内未收到首包 -> 主线路(目标{self.lb.primary_index + 1})"
+        ]
+        if self.lb.size_target:
+            rules.append(f"阈值每{self.lb.size_adapt_interval:g}秒按首包大小分布自适应调整，"
+                         f"目标主线路流量占比 {self.lb.size_target * 100:.0f}%")
+        return rules
+
+
+class LeastConnectionsStrategy(BalanceStrategy):
+    """最少活跃连接：选择活跃流/权重最小的线路，相同时按轮询顺序"""
+    name = 'least-conn'
+    description = '最少连接'
+
+    def select(self, protocol, client_address, packet_size):
+        lines = self.lb.lines
+        candidates = self.candidates(lines)
+        active = self.lb.active_flow_counts(lines.targets)
+        # 以轮询位置作为起点打破平局，避免总是落在编号最小的线路
+        _, start = self.lb.get_next_target(protocol)
+        n = len(lines.targets)
+        weights = lines.weights
+        target_index = min(candidates, key=lambda i: (active[i] / weights[i], (i - start) % n))
+        return target_index, self.classify(packet_size)
+
+
+class PowerOfTwoStrategy(BalanceStrategy):
+    """随机二选一：随机取两条线路，选择活跃流/权重较小的一条"""
+    name = 'p2c'
+    description = '随机二选一'
+
+    def select(self, protocol, client_address, packet_size):
+        lines = self.lb.lines
+        candidates = self.candidates(lines)
+        if len(candidates) < 2:
+            return candidates[0], self.classify(packet_size)
+        a, b = random.sample(candidates, 2)
+        active = self.lb.active_flow_counts(lines.targets)
+        weights = lines.weights
+        target_index = a if active[a] / weights[a] <= active[b] / weights[b] else b
+        return target_index, self.classify(packet_size)
+
+
+class RendezvousHashStrategy(BalanceStrategy):
+    """加权最高随机权重（rendezvous）哈希：按客户端地址固定线路，不保存任何客户端状态
+
+    每条线路对客户端键打分 权重 / -ln(u)，u为 (线路地址, 客户端键) 哈希到(0,1)的值，取分数最高者。
+    哈希与进程无关，重启后分配不变；增减或剔除一条线路时只有原本落在（或改落到）该线路的约1/N客户端迁移，
+    各线路分得的客户端比例与权重成正比。
+    """
+    name = 'hash'
+    description = '客户端哈希'
+
+    def client_key(self, client_address):
+        if self.lb.hash_key == 'ip:port':
+            return f"{client_address[0]}:{client_address[1]}".encode()
+        return client_address[0].encode()
+
+    def ranking(self, client_address, lines):
+        """客户端对快照中各线路的偏好顺序：未剔除的线路按分数从高到低在前，已剔除的在后
+
+        只排除已剔除的线路，不按RTT筛选，延迟抖动不会让客户端换线路。
+        """
+        key = self.client_key(client_address)
+        scores = []
+        for i, ((host, port), weight) in enumerate(zip(lines.targets, lines.weights)):
+            digest = hashlib.blake2b(f"{host}:{port}|".encode() + key, digest_size=8).digest()
+            u = (int.from_bytes(digest, 'big') + 0.5) / 2 ** 64
+            scores.append((self.lb.is_ejected(i, lines), -weight / -math.log(u), i))
+        return [i for _, _, i in sorted(scores)]
+
+    def select(self, protocol, client_address, packet_size):
+        return self.ranking(client_address, self.lb.lines)[0], self.classify(packet_size)
+
+    def failover_order(self, client_address, first_index, lines):
+        """按该客户端的分数次序故障转移，同一客户端总是转移到同一条线路"""
+        ranking = self.ranking(client_address, lines)
+        ranking.remove(first_index)
+        return [first_index] + ranking
+
+    def rules(self):
+        key_desc = "客户端IP:端口" if self.lb.hash_key == 'ip:port' else "客户端IP"
+        weight_desc = "（按权重分配比例）" if self.lb.weighted else ""
+        return [f"按{key_desc}做rendezvous哈希{weight_desc}，同一客户端固定走同一线路",
+                "线路增减或被剔除时只迁移约1/N的客户端，连接失败时按该客户端的分数次序故障转移"]
+
+
+# --mode 可选的分流策略
+STRATEGIES = {
+    cls.name: cls for cls in (RoundRobinStrategy, SizeStrategy, LeastConnectionsStrategy, PowerOfTwoStrategy,
+                              RendezvousHashStrategy)
+}
+# hash模式可选的客户端键
+HASH_KEYS = ('ip', 'ip:port')
+
+
+# 线路配置快照：重载配置时整体替换，选择与连接线路时一次取用，下标始终与同一份配置对应
+LineSet = collections.namedtuple('LineSet', ['targets', 'weights', 'health', 'pools', 'primary'])
+
+
+class TargetHealth:
+    """线路健康状态：连接RTT与失败率的EWMA，连续失败达到阈值后暂时剔除"""
+
+    def __init__(self):
+        self.rtt = None
+        self.fail_rate = 0.0
+        self.failures = 0  # 连续失败次数
+        self.ejected_until = 0.0
+
+
+class UpstreamPool:
+    """单条线路的预连接池：保存已完成握手的空闲连接，取用时校验TTL与存活"""
+
+    def __init__(self, min_size, max_size, idle_ttl):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.want = min_size  # 目标空闲数，未命中时增长，空闲过期时回落
+        self.idle = collections.deque()  # (socket, 建立时间)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_seconds = 0.0
+
+    @staticmethod
+    def is_alive(sock):
+        """非阻塞窥探：对端已关闭或出错返回False，有数据或暂无数据均视为存活"""
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def acquire(self):
+        """取出一条可用连接，没有时返回None并唤醒补充线程"""
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                sock, created = self.idle.pop()
+                if now - created <= self.idle_ttl and self.is_alive(sock):
+                    self.hits += 1
+                    return sock
+                sock.close()
+            self.misses += 1
+            self.want = min(self.max_size, self.want + 1)
+        self.wakeup.set()
+        return None
+
+    def put(self, sock, seconds):
+        """放入一条新建连接"""
+        with self.lock:
+            self.idle.append((sock, time.time()))
+            self.refills += 1
+            self.refill_seconds += seconds
+
+    def prune(self):
+        """清理过期和已断开的空闲连接，返回还需补充的数量"""
+        now = time.time()
+        with self.lock:
+            kept = collections.deque()
+            for sock, created in self.idle:
+                if now - created > self.idle_ttl:
+                    sock.close()
+                    self.want = max(self.min_size, self.want - 1)
+                elif not self.is_alive(sock):
+                    sock.close()
+                else:
+                    kept.append((sock, created))
+            self.idle = kept
+            return self.want - len(self.idle)
+
+    def close(self):
+        """关闭所有空闲连接"""
+        with self.lock:
+            while self.idle:
+                self.idle.pop()[0].close()
+
+
+class UdpSession:
+    """UDP会话：客户端绑定的目标线路及其长期上游socket
+
+    双向任一方向有数据都刷新last_seen，服务端持续推送（一问多答、流媒体、游戏状态）的会话不会因客户端安静而超时。
+    """
+    __slots__ = ('client', 'target', 'target_index', 'last_seen', 'sock', 'timeout')
+
+    def __init__(self, client, target, target_index, sock, timeout):
+        self.client = client
+        self.target = target
+        self.target_index = target_index
+        self.last_seen = time.monotonic()
+        self.sock = sock
+        self.timeout = timeout  # 空闲超时（秒），可按目标端口单独设置
+
+
+class ChannelLogHandler(logging.Handler):
+    """工作进程的日志处理器：日志经上报通道交给主进程写出，日志文件只由主进程写入和轮转"""
+
+    def __init__(self, send):
+        super().__init__()
+        self.send = send
+
+    def emit(self, record):
+        try:
+            self.send({'log': [record.levelno, record.getMessage(), record.created]})
+        except Exception:
+            self.handleError(record)
+
+
+class UdpSessionShard:
+    """会话表分片：会话按最近使用排序（LRU），并挂在时间轮上等待超时检查"""
+    __slots__ = ('lock', 'sessions', 'wheel', 'tick', 'evicted', 'expired')
+
+    def __init__(self, slots, now_tick):
+        self.lock = threading.Lock()
+        self.sessions = collections.OrderedDict()  # client -> UdpSession，最近使用的在末尾
+        self.wheel = [[] for _ in range(slots)]
+        self.tick = now_tick  # 已处理到的时间轮刻度
+        self.evicted = 0
+        self.expired = 0
+
+
+class UdpSessionTable:
+    """UDP会话表：按客户端地址分片加锁，超出容量时淘汰全表最久未用的会话，空闲超时由时间轮检查
+
+    时间轮每秒一格。收包只更新会话的last_seen，不移动时间轮上的位置；
+    到期的格子被处理时再按last_seen重新计算，未超时的会话挂到新的格子上。
+    每个会话在每个超时周期内只被检查常数次，与会话总数无关。超时时长取自各会话的timeout。
+    容量按全表计数：超出时比较各分片LRU队首，淘汰其中last_seen最早的会话。
+    """
+    WHEEL_SLOTS = 64
+
+    def __init__(self, max_sessions=0, shard_count=16):
+        self.max_sessions = max_sessions
+        self.size = 0  # 全表会话数，在分片锁内加减，锁顺序为 分片锁 -> size_lock
+        self.size_lock = threading.Lock()
+        now_tick = int(time.monotonic())
+        self.shards = [UdpSessionShard(self.WHEEL_SLOTS, now_tick) for _ in range(shard_count)]
+
+    def shard(self, client):
+        return self.shards[hash(client) % len(self.shards)]
+
+    def schedule(self, shard, session, now):
+        """将会话挂到其超时时刻对应的格子（超出一圈的先挂在一圈后，届时再重排）"""
+        tick = min(int(session.last_seen + session.timeout) + 1, int(now) + self.WHEEL_SLOTS)
+        shard.wheel[tick % self.WHEEL_SLOTS].append(session)
+
+    def resize(self, delta):
+        """调整全表会话数，调用方需持有对应分片的锁"""
+        with self.size_lock:
+            self.size += delta
+
+    def get_or_create(self, client, create):
+        """查找会话并刷新其活跃时间，不存在时调用create()新建
+
+        返回 (会话, 是否新建, 因容量上限被淘汰的会话列表)
+        """
+        shard = self.shard(client)
+        with shard.lock:
+            session = shard.sessions.get(client)
+            if session is not None:
+                session.last_seen = time.monotonic()
+                shard.sessions.move_to_end(client)
+                return session, False, []
+            
+            session = create()
+            shard.sessions[client] = session
+            self.schedule(shard, session, session.last_seen)
+            self.resize(1)
+        
+        evicted = []
+        while self.max_sessions and self.size > self.max_sessions:
+            victim = self.evict_oldest()
+            if victim is None:
+                break
+            evicted.append(victim)
+        return session, True, evicted
+
+    def touch(self, session):
+        """回包刷新会话的活跃时间及LRU位置（会话已被淘汰或替换时忽略）"""
+        shard = self.shard(session.client)
+        with shard.lock:
+            if shard.sessions.get(session.client) is session:
+                session.last_seen = time.monotonic()
+                shard.sessions.move_to_end(session.client)
+
+    def evict_oldest(self):
+        """淘汰全表最久未用的会话（各分片LRU队首中last_seen最早者），已不超容量或无可淘汰时返回None"""
+        while True:
+            oldest = None
+            for shard in self.shards:
+                with shard.lock:
+                    if shard.sessions:
+                        head = next(iter(shard.sessions.values()))
+                        if oldest is None or head.last_seen < oldest[1].last_seen:
+                            oldest = (shard, head)
+            if oldest is None:
+                return None
+            shard, head = oldest
+            with shard.lock:
+                if not shard.sessions or next(iter(shard.sessions.values())) is not head:
+                    continue  # 比较期间队首已变化，重新查找
+                with self.size_lock:
+                    # 并发新建时只由一方淘汰，避免多淘汰
+                    if self.size <= self.max_sessions:
+                        return None
+                    self.size -= 1
+                shard.sessions.popitem(last=False)
+                shard.evicted += 1
+                return head
+
+    def expire(self):
+        """推进时间轮，移除并返回所有空闲超时的会话"""
+        now = time.monotonic()
+        now_tick = int(now)
+        expired = []
+        for shard in self.shards:
+            with shard.lock:
+                # 落后超过一圈时每个格子只需处理一次
+                start = max(shard.tick + 1, now_tick - self.WHEEL_SLOTS + 1)
+                for tick in range(start, now_tick + 1):
+                    index = tick % self.WHEEL_SLOTS
+                    due, shard.wheel[index] = shard.wheel[index], []
+                    for session in due:
+                        if shard.sessions.get(session.client) is not session:
+                            continue  # 已被淘汰或替换
+                        if now - session.last_seen >= session.timeout:
+                            del shard.sessions[session.client]
+                            self.resize(-1)
+                            expired.append(session)
+                            shard.expired += 1
+                        else:
+                            self.schedule(shard, session, now)
+                shard.tick = now_tick
+        return expired
+
+    def clear(self):
+        """移除并返回全部会话（服务停止时关闭其上游socket）"""
+        sessions = []
+        for shard in self.shards:
+            with shard.lock:
+                sessions.extend(shard.sessions.values())
+                self.resize(-len(shard.sessions))
+                shard.sessions.clear()
+                shard.wheel = [[] for _ in range(self.WHEEL_SLOTS)]
+        return sessions
+
+    def __len__(self):
+        return self.size
+
+    def counts(self):
+        """返回 (淘汰数, 超时数)"""
+        return (sum(shard.evicted for shard in self.shards),
+                sum(shard.expired for shard in self.shards))
+
+
+class BondLink:
+    """绑定会话中的一条子连接：独立的发送队列，并按实际发送耗时估计线路速率"""
+
+    def __init__(self, session, index, sock, rate, target):
+        self.session = session
+        self.index = index
+        self.target = target  # 子连接所在线路的目标地址（服务端为None）
+        self.sock = sock
+        self.queue = collections.deque()
+        self.queued = 0
+        self.rate = rate  # 字节/秒（EWMA）
+        self.window_bytes = 0
+        self.window_time = 0.0
+
+    def cost(self, size):
+        """再排入size字节后，本线路发完队列的预计耗时"""
+        return (self.queued + size) / self.rate
+
+    def run_sender(self):
+        """发送线程：依次发出队列中的帧"""
+        session = self.session
+        cond = session.cond
+        # 服务端的子连接来自对端各线路，本端不限速
+        shaper = session.balancer.line_shaper(self.index) if not session.server else None
+        try:
+            while True:
+                with cond:
+                    while not self.queue and not session.closed:
+                        cond.wait()
+                    if session.closed:
+                        return
+                    frame = self.queue[0]
+                start = time.perf_counter()
+                if shaper:
+                    # 限速等待计入发送耗时，速率估计随之反映限速后的实际速率
+                    wait = session.balancer.shaping_wait(shaper, ('bytes_in', 'tcp', self.target), len(frame))
+                    if wait:
+                        time.sleep(wait)
+                self.sock.sendall(frame)
+                elapsed = time.perf_counter() - start
+                with cond:
+                    self.queue.popleft()
+                    self.queued -= len(frame)
+                    # 发送阻塞说明线路已饱和，此时的 字节/耗时 即为线路实际速率
+                    self.window_bytes += len(frame)
+                    self.window_time += elapsed
+                    if self.window_time >= BOND_RATE_WINDOW:
+                        sample = self.window_bytes / self.window_time
+                        self.rate += EWMA_ALPHA * (sample - self.rate)
+                        self.window_bytes, self.window_time = 0, 0.0
+                    cond.notify_all()
+                session.count(True, self.target, len(frame) - BOND_FRAME.size)
+                session.maybe_finish()
+        except OSError:
+            session.close()
+
+    def run_reader(self):
+        """接收线程：读取对端的帧交给会话重组"""
+        session = self.session
+        session.ready.wait()
+        try:
+            while not session.closed:
+                seq, length, flags = BOND_FRAME.unpack(recv_exact(self.sock, BOND_FRAME.size))
+                payload = bytes(recv_exact(self.sock, length)) if length else b''
+                session.count(False, self.target, length)
+                if not session.deliver(seq, payload, flags & BOND_FIN):
+                    return
+        except EOFError:
+            # 对端发完后会关闭全部子连接，FIN帧可能还在其他线路上；
+            # 只有所有子连接都已关闭仍未收到FIN帧，才说明对端异常终止
+            with session.cond:
+                session.readers -= 1
+                aborted = session.readers == 0 and not session.peer_finished
+            if aborted:
+                session.close()
+        except OSError:
+            session.close()
+
+
+class BondSession:
+    """多线路绑定会话：一条TCP流按序号切块分散到各线路的子连接，对端按序号重组
+
+    两个方向对称：本端从peer读取数据切块发出，同时把收到的帧按序写回peer。
+    """
+
+    def __init__(self, balancer, session_id, server=False):
+        self.balancer = balancer
+        self.id = session_id
+        self.server = server
+        # 统计记到哪个目标：客户端按子连接所在线路，服务端固定记到后端（连接后端后设置）
+        self.stat_target = None
+        self.peer = None
+        self.links = []
+        self.cond = threading.Condition()
+        self.ready = threading.Event()
+        self.send_seq = 0
+        self.recv_seq = 0
+        self.pending = {}  # 乱序到达的帧：seq -> (payload, fin)
+        self.pending_bytes = 0
+        self.fin_sent = False
+        self.fin_received = False
+        self.peer_finished = False  # 已收到对端的FIN帧（尚未必按序写出）
+        self.flow_targets = []  # 计入活跃流的目标地址，会话关闭时归还
+        self.readers = 0  # 尚未读到EOF的子连接数
+        self.closed = False
+
+    def count(self, sent, target, n):
+        """记录子连接收发的字节数（服务端方向相反：发出的是后端回给客户端的数据）"""
+        if not self.server:
+            key = ('bytes_in' if sent else 'bytes_out', 'tcp', target)
+        else:
+            key = ('bytes_out' if sent else 'bytes_in', 'tcp', self.stat_target)
+        self.balancer.counters.add(key, n)
+
+    def add_link(self, index, sock, rate, target=None):
+        """加入一条子连接并启动其收发线程（target为子连接所在线路的目标地址）"""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, BOND_NOTSENT_LOWAT)
+        with self.cond:
+            if self.closed:
+                sock.close()
+                return
+            link = BondLink(self, index, sock, rate, target)
+            self.links.append(link)
+            self.readers += 1
+        threading.Thread(target=link.run_sender, daemon=True).start()
+        threading.Thread(target=link.run_reader, daemon=True).start()
+
+    def start(self, peer):
+        """绑定本端socket并开始双向转发（在调用线程中切块发送）"""
+        self.peer = peer
+        self.ready.set()
+        threading.Thread(target=self.run_writer, daemon=True).start()
+        self.pump()
+
+    def pump(self):
+        """读取peer数据，切块后分配到预计最早发完的线路"""
+        buf = bytearray(self.balancer.bond_chunk)
+        try:
+            while True:
+                n = self.peer.recv_into(buf)
+                if not self.enqueue(bytes(buf[:n]), fin=not n) or not n:
+                    return
+        except OSError:
+            self.close()
+
+    def enqueue(self, payload, fin=False):
+        """为数据块分配序号并排入某条线路，所有线路队列都满时等待"""
+        with self.cond:
+            while not self.closed:
+                candidates = [link for link in self.links if link.queued < BOND_QUEUE_LIMIT]
+                if candidates:
+                    break
+                self.cond.wait()
+            if self.closed:
+                return False
+            frame = BOND_FRAME.pack(self.send_seq, len(payload), BOND_FIN if fin else 0) + payload
+            link = min(candidates, key=lambda l: l.cost(len(frame)))
+            link.queue.append(frame)
+            link.queued += len(frame)
+            self.send_seq += 1
+            self.fin_sent = fin
+            self.cond.notify_all()
+        return True
+
+    def deliver(self, seq, payload, fin):
+        """放入一个收到的帧；乱序缓冲超限时，非下一个待写的帧需等待"""
+        with self.cond:
+            while seq != self.recv_seq and self.pending_bytes > BOND_REORDER_LIMIT and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self.pending[seq] = (payload, fin)
+            self.pending_bytes += len(payload)
+            if fin:
+                self.peer_finished = True
+            self.cond.notify_all()
+        return True
+
+    def run_writer(self):
+        """写出线程：按序号顺序把数据写回peer，收到FIN后半关闭peer"""
+        try:
+            while True:
+                with self.cond:
+                    while self.recv_seq not in self.pending and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    payload, fin = self.pending.pop(self.recv_seq)
+                    self.pending_bytes -= len(payload)
+                    self.recv_seq += 1
+                    self.cond.notify_all()
+                if fin:
+                    self.peer.shutdown(socket.SHUT_WR)
+                    with self.cond:
+                        self.fin_received = True
+                    self.maybe_finish()
+                    return
+                self.peer.sendall(payload)
+        except OSError:
+            self.close()
+
+    def maybe_finish(self):
+        """两个方向都已结束且发送队列已清空时关闭会话"""
+        with self.cond:
+            done = self.fin_sent and self.fin_received and not any(link.queue for link in self.links)
+        if done:
+            self.close()
+
+    def close(self):
+        """关闭会话的全部连接（可重复调用）"""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.ready.set()
+        for sock in [link.sock for link in self.links] + [self.peer]:
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self.balancer.bond_session_closed(self)
+
+
 class MultiLineLoadBalancer:
     def __init__(self, listen_host, listen_port, targets, small_packet_size=1024, 
-                 mode='auto', protocols=['tcp', 'udp'], daemon=False, log_file=None, primary=1):
+                 mode='auto', protocols=['tcp', 'udp'], daemon=False, log_file=None, primary=1,
+                 engine='thread', relay='copy', tcp_buffer_size=8192, udp_buffer_size=65535,
+                 buffer_pool_size=1024, workers=1, health_check=0, connect_timeout=5.0,
+                 eject_failures=3, eject_time=30, latency_factor=2.0, weights=None,
+                 pool_min=0, pool_max=16, pool_idle_ttl=30, metrics_port=0, metrics_host='127.0.0.1',
+                 log_sample=1, log_queue_size=10000, udp_timeout=60, max_udp_sessions=65536,
+                 bond=None, bond_chunk=16384, peek_timeout=1.0, race_delay=0,
+                 config_loader=None, upgrade=False, drain_timeout=60,
+                 max_tcp_conns=0, max_udp_handlers=0, max_flows_per_ip=0, overload='reject',
+                 queue_timeout=1.0, backlog=100, listen_sockopt=None, target_sockopt=None,
+                 line_rate=None, shape_policy='queue', shape_max_delay=0.1, udp_port_timeouts=None,
+                 hash_key='ip', size_target=0, size_adapt_interval=10):
         """
         多线路负载均衡器（支持最多6条线路）
         :param targets: 目标服务器列表 [(host, port), ...]
         :param daemon: 是否后台运行
         :param log_file: 日志文件路径
         :param primary: 默认主线路编号（1-6）
+        :param engine: TCP转发引擎 thread=每连接线程, asyncio=单事件循环协程
+        :param relay: TCP转发方式 copy=用户态拷贝, splice=内核零拷贝（不可用时自动回退）
+        :param tcp_buffer_size: TCP转发缓冲区大小
+        :param udp_buffer_size: UDP收包缓冲区大小（应不小于最大数据报）
+        :param buffer_pool_size: 每种协议缓冲池保留的最大缓冲区数
+        :param workers: 工作进程数，大于1时以SO_REUSEPORT多进程方式运行
+        :param health_check: 主动健康检查间隔（秒），0为关闭
+        :param connect_timeout: 连接目标超时（秒），超时后故障转移到下一条线路
+        :param eject_failures: 连续失败多少次后剔除线路
+        :param eject_time: 线路剔除时长（秒）
+        :param latency_factor: RTT超过最优线路该倍数的线路不参与分配，0为关闭
+        :param weights: 每条线路的权重（与targets一一对应），默认均为1
+        :param pool_min: 每条线路预建立的最少空闲TCP连接数，0为关闭预连接池
+        :param pool_max: 每条线路最多保留的空闲连接数
+        :param pool_idle_ttl: 空闲连接最长保留时间（秒）
+        :param metrics_port: Prometheus指标HTTP端口，0为关闭
+        :param metrics_host: 指标服务监听地址
+        :param log_sample: 每连接/每会话日志采样，每N条记录1条
+        :param log_queue_size: 日志队列长度，队列满时丢弃
+        :param udp_timeout: UDP会话空闲超时（秒），上下行任一方向有数据即刷新
+        :param udp_port_timeouts: 按目标端口设置的UDP会话空闲超时 [(起始端口, 结束端口, 秒数)]，先匹配者优先
+        :param hash_key: hash模式的客户端键 ip=客户端IP, ip:port=客户端IP和端口
+        :param size_target: size模式下主线路的目标流量占比（0-1），设置后按首包大小分布自适应调整小包阈值，0为固定阈值
+        :param size_adapt_interval: 自适应阈值的调整周期（秒）
+        :param max_udp_sessions: UDP会话数上限，超出时淘汰最久未用的会话，0为不限制
+        :param bond: 多线路绑定模式，'client'将每条TCP连接拆分到所有线路，'server'重组后转发到唯一的目标
+        :param bond_chunk: 绑定模式的切块大小（字节）
+        :param peek_timeout: 按包大小分流时等待TCP首包的时间（秒），超时走主线路
+        :param race_delay: 连接竞速间隔（秒），选中线路在此时间内未完成握手则并行连接下一条线路，0为关闭
+        :param config_loader: 重载配置（SIGHUP/控制命令reload）时调用，返回(targets, weights, primary)，None为不支持重载
+        :param upgrade: 平滑升级：启动时通过控制socket从运行中的旧进程接管监听socket
+        :param drain_timeout: 交出监听socket后等待在途连接结束的最长时间（秒）
+        :param max_tcp_conns: 同时转发的TCP连接数上限，0为不限制
+        :param max_udp_handlers: 同时处理中的UDP数据包数上限，0为不限制
+        :param max_flows_per_ip: 单个客户端IP的活跃TCP连接+UDP会话数上限，0为不限制（超出时总是拒绝）
+        :param overload: 超出并发上限时的策略 reject=立即拒绝, queue=排队等待, shed=排队且队列满时丢弃最早的
+        :param queue_timeout: 排队最长等待时间（秒）
+        :param backlog: TCP监听队列长度（listen backlog）
+        :param listen_sockopt: 监听socket的选项规格（见SocketProfile），接受的连接继承这些选项
+        :param target_sockopt: 连接目标线路的socket选项规格列表，每项为 SPEC（所有线路）或 N:SPEC（线路N，覆盖同名项）
+        :param line_rate: 线路限速规格列表（见LineShaper），每项为 SPEC（所有线路，各线路分别计）或 N:SPEC（线路N）
+        :param shape_policy: UDP超出限速时的策略 drop=直接丢弃, queue=排队（等待超过shape_max_delay时丢弃）
+        :param shape_max_delay: UDP排队最长等待时间（秒）
         """
         self.listen_host = listen_host
         self.listen_port = listen_port
         self.targets = targets
         self.target_count = len(targets)
+        self.weights = list(weights) if weights else [1] * self.target_count
+        self.weighted = len(set(self.weights)) > 1
         self.small_packet_size = small_packet_size
+        self.peek_timeout = peek_timeout
+        self.race_delay = race_delay
+        self.race_reaper = None  # 观察落败连接的选择器（首次竞速时创建）
+        self.race_lock = threading.Lock()
         self.mode = mode
         self.protocols = [p.lower() for p in protocols]
         self.daemon = daemon
         
+        # 多线路绑定（仅TCP，收发线程较多，使用线程引擎）
+        self.bond = bond
+        self.bond_chunk = bond_chunk
+        self.bond_sessions = {}  # 服务端：会话ID -> BondSession
+        self.bond_lock = threading.Lock()
+        if bond:
+            self.protocols = ['tcp']
+            engine = 'thread'
+        self.engine = engine
+        self.relay = relay
+        self.use_splice = relay == 'splice' and SPLICE_AVAILABLE
+        
+        # 多进程模式
+        self.workers = max(1, workers)
+        self.worker_id = None
+        self.reuse_port = False
+        
+        # 缓冲池（按协议分别配置大小）
+        self.tcp_buffer_size = tcp_buffer_size
+        self.udp_buffer_size = udp_buffer_size
+        self.buffer_pools = {
+            'tcp': BufferPool(tcp_buffer_size, buffer_pool_size),
+            'udp': BufferPool(udp_buffer_size, buffer_pool_size)
+        }
+        
         # 设置主线路（转换为索引，从0开始）
         self.primary_index = primary - 1
         if self.primary_index < 0 or self.primary_index >= self.target_count:
             self.primary_index = 0
         
-        # 设置日志
+        # 设置日志（业务线程只入队，由后台线程写文件/控制台）
+        self.log_sample = max(1, log_sample)
+        self.flow_log_seq = itertools.count()
+        self.log_queue_size = log_queue_size
+        self.log_queue_handler = None
+        self.log_listener = None
         self.setup_logging(log_file, daemon)
         
-        # UDP会话管理
-        self.client_sessions = {}
-        self.session_lock = threading.Lock()
-        self.session_timeout = 60
+        # 线路健康状态
+        self.health_check = health_check
+        self.connect_timeout = connect_timeout
+        self.eject_failures = eject_failures
+        self.eject_time = eject_time
+        self.latency_factor = latency_factor
+        self.health = [TargetHealth() for _ in targets]
+        self.health_lock = threading.Lock()
+        
+        # 上游预连接池
+        self.upstream_pools = [
+            UpstreamPool(pool_min, max(pool_min, pool_max), pool_idle_ttl) for _ in targets
+        ] if pool_min > 0 else None
+        self.lines = LineSet(self.targets, self.weights, self.health, self.upstream_pools, self.primary_index)
+        
+        # 每个目标地址当前活跃的TCP连接/UDP会话数（按地址计，重载配置后在途连接仍能正确归还）
+        self.active_flows = {'tcp': collections.Counter(), 'udp': collections.Counter()}
+        self.flow_lock = threading.Lock()
+        
+        # 准入控制：并发上限与过载策略（多进程模式下每个工作进程分别计）
+        self.backlog = backlog
+        self.overload = overload
+        self.queue_timeout = queue_timeout
+        self.max_flows_per_ip = max_flows_per_ip
+        self.client_flows = collections.Counter()  # 客户端IP -> 活跃TCP连接+UDP会话数（受flow_lock保护）
+        self.tcp_gate = AdmissionGate(max_tcp_conns, overload, queue_timeout, self.drop_tcp_client) if max_tcp_conns > 0 else None
+        self.udp_gate = AdmissionGate(max_udp_handlers, overload, queue_timeout, self.drop_udp_packet) if max_udp_handlers > 0 else None
+        
+        # socket选项配置：监听socket及各线路的上游socket
+        self.listen_profile = SocketProfile.parse(listen_sockopt) if listen_sockopt else None
+        # target_profile为所有线路共用的配置，line_profiles为 线路编号（从1开始）-> 合并后的配置
+        self.target_profile, self.line_profiles = parse_line_specs(
+            target_sockopt or [], self.target_count, SocketProfile.parse, SocketProfile.merged, 'socket选项')
+        # 上游fastopen使connect不经握手立即成功：竞速无从比较、预连接池存入的连接未必可用
+        if any(self.line_fastopen(i) for i in range(self.target_count)) and (self.race_delay or self.upstream_pools):
+            raise ValueError("连接目标启用fastopen时不能同时使用连接竞速(--race-delay)或预连接池(--pool-min)")
+        self.sockopt_warned = set()  # 已提示过设置失败的 (线路, 选项)
+        
+        # 线路限速：按线路编号（从1开始）的令牌桶，多进程模式下各工作进程平分
+        self.shape_policy = shape_policy
+        self.shape_max_delay = shape_max_delay
+        self.shape_default, shape_lines = parse_line_specs(
+            line_rate or [], self.target_count, LineShaper.parse, lambda a, b: {**a, **b}, '限速')
+        self.shapers = {number: LineShaper(options, 1 / self.workers) for number, options in shape_lines.items()}
+        self.add_line_shapers()
+        self.udp_pacer = UdpPacer()
+        
+        # 分流策略
+        self.hash_key = hash_key
+        if not 0 <= size_target <= 1:
+            raise ValueError(f"主线路目标占比必须在0-1之间: {size_target}")
+        self.size_target = size_target if mode == 'size' else 0
+        self.size_adapt_interval = size_adapt_interval
+        self.size_predicted = None  # 按最近首包大小分布预计的主线路流量占比
+        self.strategy = STRATEGIES[mode](self)
+        
+        # UDP会话管理（分片会话表 + 时间轮超时）
+        self.udp_timeout = udp_timeout
+        self.udp_port_timeouts = list(udp_port_timeouts or [])
+        self.client_sessions = UdpSessionTable(max_udp_sessions)
+        # 所有会话上游socket的回包由同一个选择器线程统一读取
+        self.udp_selector = selectors.DefaultSelector()
         
         # TCP连接计数器 - 从主线路开始
         self.tcp_connection_count = self.primary_index
@@ -62,33 +1419,49 @@ class MultiLineLoadBalancer:
         self.udp_connection_count = self.primary_index
         self.udp_count_lock = threading.Lock()
         
-        # 统计信息 - 为每个目标创建统计
-        self.stats = {
-            'tcp': {
-                'total': 0,
-                'small_packets': 0,
-                'large_packets': 0,
-                'targets': [0] * self.target_count
-            },
-            'udp': {
-                'total': 0,
-                'small_packets': 0,
-                'large_packets': 0,
-                'targets': [0] * self.target_count
-            }
-        }
-        self.stats_lock = threading.Lock()
+        # 平滑加权轮询的当前权重（各协议独立）
+        self.swrr_current = {'tcp': [0] * self.target_count, 'udp': [0] * self.target_count}
+        
+        # 统计信息 - 按线程分片计数，读取时合并
+        self.counters = ShardedCounters()
+        
+        # Prometheus指标服务
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.merged_snapshot = None  # 多进程模式下主进程汇总的最新统计
+        self.started_at = time.time()
+        self.rates = RateTracker()  # 供控制命令stats计算最近1/10/60秒的速率
         
         # 服务器socket
         self.tcp_server = None
         self.udp_server = None
         self.running = True
         
+        # asyncio引擎：事件循环及存活的连接任务（保持引用防止被回收）
+        self.loop = None
+        self.tcp_tasks = set()
+        
         # PID文件
         self.pid_file = f'/tmp/loadbalancer_{self.listen_port}.pid'
+        
+        # 重载配置与平滑升级
+        self.config_loader = config_loader
+        self.upgrade = upgrade
+        self.drain_timeout = drain_timeout
+        self.draining = False  # 已停止接受新连接（监听socket已交给新进程），等待在途连接结束
+        self.inherited_listeners = {}  # 从旧进程接管的监听socket：协议 -> socket
+        self.control_path = f'/tmp/loadbalancer_{self.listen_port}.sock'
+        self.control_server = None
+        self.metrics_server = None
+        self.worker_procs = {}  # 多进程模式：工作进程编号 -> {'pid', 'channel', ...}
 
     def setup_logging(self, log_file, daemon):
         """设置日志系统"""
+        self.logger = logging.getLogger(__name__)
+        if logging.getLogger().handlers:
+            # 调用方已配置日志（如基准测试），不再接管
+            return
+        
         if daemon:
             # 后台模式：写入日志文件
             if not log_file:
@@ -108,26 +1481,42 @@ class MultiLineLoadBalancer:
                 maxBytes=10*1024*1024,  # 10MB
                 backupCount=5
             )
-            formatter = logging.Formatter(
-                '%(asctime)s [%(levelname)s] %(message)s',
-                datefmt='%Y-%m-%d %H:%M:%S'
-            )
-            handler.setFormatter(formatter)
-            
-            logging.basicConfig(
-                level=logging.INFO,
-                handlers=[handler]
-            )
-            self.logger = logging.getLogger(__name__)
-            self.logger.info(f"日志文件: {log_file}")
         else:
             # 前台模式：输出到控制台
-            logging.basicConfig(
-                level=logging.INFO,
-                format='%(asctime)s [%(levelname)s] %(message)s',
-                datefmt='%Y-%m-%d %H:%M:%S'
-            )
-            self.logger = logging.getLogger(__name__)
+            handler = logging.StreamHandler()
+        
+        formatter = logging.Formatter(
+            '%(asctime)s [%(levelname)s] %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+        handler.setFormatter(formatter)
+        self.log_handler = handler
+        logging.getLogger().setLevel(logging.INFO)
+        self.start_log_listener()
+        if daemon:
+            self.logger.info("日志文件: %s", log_file)
+
+    def start_log_listener(self):
+        """建立日志队列及写出线程（fork后需重新调用，线程不会被子进程继承）"""
+        root = logging.getLogger()
+        if self.log_queue_handler:
+            root.removeHandler(self.log_queue_handler)
+        self.log_queue_handler = DroppingQueueHandler(self.log_queue_size)
+        root.addHandler(self.log_queue_handler)
+        self.log_listener = QueueListener(self.log_queue_handler.queue, self.log_handler)
+        self.log_listener.start()
+
+    def stop_log_listener(self):
+        """停止写出线程，并写完队列中剩余的日志"""
+        if self.log_listener:
+            self.log_listener.stop()
+            self.log_listener = None
+
+    def sample_flow_log(self):
+        """每连接/每会话日志是否记录本条（按log_sample采样）"""
+        if not self.logger.isEnabledFor(logging.INFO):
+            return False
+        return self.log_sample == 1 or next(self.flow_log_seq) % self.log_sample == 0
 
     def log(self, message, level='info'):
         """统一日志接口"""
@@ -141,83 +1530,845 @@ class MultiLineLoadBalancer:
             self.logger.debug(message)
 
     def get_next_tcp_target(self):
-        """TCP轮询获取目标"""
+        """TCP轮询获取目标（跳过已剔除及高延迟线路）"""
+        allowed = self.preferred_targets()
         with self.tcp_count_lock:
-            self.tcp_connection_count += 1
-            target_index = self.tcp_connection_count % self.target_count
+            if self.weighted:
+                self.tcp_connection_count += 1
+                target_index = self.smooth_weighted_select('tcp', allowed)
+                return self.targets[target_index], target_index
+            for _ in range(self.target_count):
+                self.tcp_connection_count += 1
+                target_index = self.tcp_connection_count % self.target_count
+                if allowed is None or target_index in allowed:
+                    break
             return self.targets[target_index], target_index
 
     def get_next_udp_target(self):
-        """UDP轮询获取目标"""
+        """UDP轮询获取目标（跳过已剔除及高延迟线路）"""
+        allowed = self.preferred_targets()
         with self.udp_count_lock:
-            self.udp_connection_count += 1
-            target_index = self.udp_connection_count % self.target_count
+            if self.weighted:
+                self.udp_connection_count += 1
+                target_index = self.smooth_weighted_select('udp', allowed)
+                return self.targets[target_index], target_index
+            for _ in range(self.target_count):
+                self.udp_connection_count += 1
+                target_index = self.udp_connection_count % self.target_count
+                if allowed is None or target_index in allowed:
+                    break
             return self.targets[target_index], target_index
 
-    def update_stats(self, protocol, target_index, is_small_packet=None):
-        """更新统计"""
-        with self.stats_lock:
-            self.stats[protocol]['total'] += 1
-            self.stats[protocol]['targets'][target_index] += 1
-            if is_small_packet is not None:
-                self.stats[protocol]['small_packets' if is_small_packet else 'large_packets'] += 1
+    def smooth_weighted_select(self, protocol, allowed):
+        """平滑加权轮询（nginx算法），调用方需持有对应协议的计数锁"""
+        current = self.swrr_current[protocol]
+        indices = range(self.target_count)
+        if allowed is not None:
+            # allowed在取锁前计算，期间重载配置缩减线路时去掉已越界的下标
+            indices = [i for i in allowed if i < self.target_count] or indices
+        total = 0
+        best = None
+        for i in indices:
+            current[i] += self.weights[i]
+            total += self.weights[i]
+            if best is None or current[i] > current[best]:
+                best = i
+        current[best] -= total
+        return best
+
+    def get_next_target(self, protocol):
+        """按协议轮询获取目标"""
+        return self.get_next_tcp_target() if protocol == 'tcp' else self.get_next_udp_target()
+
+    def get_primary_target(self, protocol):
+        """获取主线路，主线路被剔除时改为轮询"""
+        lines = self.lines
+        if self.is_ejected(lines.primary, lines):
+            return self.get_next_target(protocol)
+        return lines.targets[lines.primary], lines.primary
+
+    def resolve_line(self, target_index):
+        """取当前线路配置快照并校验下标：选择线路后遇到缩减线路的重载时，越界的下标改用主线路
+
+        返回 (快照, 下标)
+        """
+        lines = self.lines
+        if target_index >= len(lines.targets):
+            target_index = lines.primary
+        return lines, target_index
+
+    def flow_started(self, protocol, target_index):
+        """活跃流计数+1，返回计数所用的目标地址（结束时交给flow_finished）"""
+        lines, target_index = self.resolve_line(target_index)
+        target = lines.targets[target_index]
+        with self.flow_lock:
+            self.active_flows[protocol][target] += 1
+        return target
+
+    def flow_finished(self, protocol, target):
+        """活跃流计数-1"""
+        with self.flow_lock:
+            self.active_flows[protocol][target] -= 1
+
+    # ========== 准入控制 ==========
+    def client_flow_started(self, client_address):
+        """单IP上限：该IP的活跃TCP连接+UDP会话数未达上限时计入并返回True"""
+        if not self.max_flows_per_ip:
+            return True
+        ip = client_address[0]
+        with self.flow_lock:
+            if self.client_flows[ip] >= self.max_flows_per_ip:
+                return False
+            self.client_flows[ip] += 1
+            return True
+
+    def client_flow_finished(self, client_address):
+        """归还单IP名额"""
+        if not self.max_flows_per_ip:
+            return
+        ip = client_address[0]
+        with self.flow_lock:
+            self.client_flows[ip] -= 1
+            if self.client_flows[ip] <= 0:
+                del self.client_flows[ip]
+
+    def drop_tcp_client(self, item, reason):
+        """拒绝一条TCP连接：以RST关闭，客户端立即得知而不必等待超时"""
+        client_socket, client_address = item
+        try:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+        client_socket.close()
+        if reason != 'per_ip':
+            self.client_flow_finished(client_address)
+        self.counters.add(('overload', 'tcp', reason))
+
+    def drop_udp_packet(self, item, reason):
+        """丢弃一个UDP数据包并归还其缓冲区"""
+        data, _, buf = item
+        data.release()
+        self.buffer_pools['udp'].release(buf)
+        self.counters.add(('overload', 'udp', reason))
+
+    def spawn_admitted(self, gate, handler, item):
+        """在新线程中处理条目；设置了并发上限时先申请名额，未获得的已排队或被拒绝"""
+        if gate is None:
+            threading.Thread(target=handler, args=item, daemon=True).start()
+        elif gate.admit(item):
+            threading.Thread(target=self.run_admitted, args=(gate, handler, item), daemon=True).start()
+
+    def run_admitted(self, gate, handler, item):
+        """处理完一个条目后直接接手排队中的下一个，队列为空时归还名额"""
+        while item is not None:
+            handler(*item)
+            item = gate.release()
+
+    def expire_admission_queues(self):
+        """定期丢弃排队超过期限的连接/数据包（名额迟迟不空出时）"""
+        interval = min(1.0, self.queue_timeout / 2)
+        while self.running:
+            time.sleep(interval)
+            for gate in (self.tcp_gate, self.udp_gate):
+                if gate:
+                    gate.expire()
+
+    def active_flow_counts(self, targets):
+        """各目标地址的活跃流总数（TCP连接 + UDP会话），与targets一一对应"""
+        with self.flow_lock:
+            return [self.active_flows['tcp'][t] + self.active_flows['udp'][t] for t in targets]
+
+    # ========== 重载配置 ==========
+    def reload_config(self):
+        """重新加载线路配置：新连接使用新配置，在途连接不受影响；返回错误信息，成功时为None"""
+        if not self.config_loader:
+            error = '未指定配置文件(-c)，无法重载'
+            self.log(f"[重载] {error}", 'warning')
+            return error
+        try:
+            targets, weights, primary = self.config_loader()
+        except (OSError, ValueError, TypeError) as e:
+            self.log(f"[重载] 配置无效，保持原配置: {e}", 'error')
+            return str(e)
+        self.apply_targets(targets, weights, primary)
+        lines = ", ".join(f"T{i+1}:{host}:{port}@{weight}" for i, ((host, port), weight) in enumerate(zip(targets, weights)))
+        self.log(f"[重载] 已应用新配置：{lines}，主线路 目标{primary}")
+        if self.workers > 1 and self.worker_id is None:
+            # 主进程：通知各工作进程各自重载
+            for worker in list(self.worker_procs.values()):
+                try:
+                    os.kill(worker['pid'], signal.SIGHUP)
+                except OSError:
+                    pass
+        return None
+
+    def apply_targets(self, targets, weights, primary):
+        """原地替换线路配置：仍存在的目标保留健康状态、预连接池及加权轮询进度"""
+        added = []
+        removed = []
+        with self.tcp_count_lock, self.udp_count_lock, self.health_lock:
+            previous = {target: i for i, target in enumerate(self.targets)}
+            kept = [previous.get(target) for target in targets]
+            count = len(targets)
+            if count < self.target_count:
+                # 先缩小线路数，其他线程按线路数取下标时不会越界
+                self.target_count = count
+            self.health = [self.health[i] if i is not None else TargetHealth() for i in kept]
+            self.swrr_current = {
+                proto: [current[i] if i is not None else 0 for i in kept]
+                for proto, current in self.swrr_current.items()
+            }
+            if self.upstream_pools:
+                template = self.upstream_pools[0]
+                pools = [
+                    self.upstream_pools[i] if i is not None
+                    else UpstreamPool(template.min_size, template.max_size, template.idle_ttl)
+                    for i in kept
+                ]
+                added = [pool for pool, i in zip(pools, kept) if i is None]
+                removed = [pool for pool in self.upstream_pools if pool not in pools]
+                self.upstream_pools = pools
+            self.weights = list(weights)
+            self.weighted = len(set(self.weights)) > 1
+            self.targets = list(targets)
+            self.target_count = count
+            self.primary_index = primary - 1
+            self.tcp_connection_count = self.udp_connection_count = self.primary_index
+            self.lines = LineSet(self.targets, self.weights, self.health, self.upstream_pools, self.primary_index)
+        self.add_line_shapers()
+        for pool in removed:
+            pool.wakeup.set()
+        if self.workers == 1 or self.worker_id is not None:
+            # 主进程不转发流量，不维护预连接池
+            for pool in added:
+                threading.Thread(target=self.refill_upstream_pool, args=(pool,), daemon=True).start()
+
+    # ========== 健康检查 ==========
+    def is_ejected(self, index, lines=None):
+        """线路当前是否被剔除（下标按lines快照解释，默认为当前配置；已移除的线路视为未剔除）"""
+        health = (lines or self.lines).health
+        return index < len(health) and health[index].ejected_until > time.time()
+
+    def preferred_targets(self, lines=None):
+        """可分配的线路集合：排除已剔除线路并优先低延迟线路，None表示不限制（下标按lines快照解释）"""
+        if not self.health_check:
+            return None
+        health = (lines or self.lines).health
+        now = time.time()
+        with self.health_lock:
+            healthy = [i for i, h in enumerate(health) if h.ejected_until <= now]
+            if not healthy:
+                return None
+            rtts = [health[i].rtt for i in healthy if health[i].rtt is not None]
+            if rtts and self.latency_factor > 0:
+                best = min(rtts)
+                limit = max(best * self.latency_factor, best + LATENCY_SLACK)
+                fast = [i for i in healthy if health[i].rtt is None or health[i].rtt <= limit]
+                healthy = fast or healthy
+        return healthy
+
+    def record_connect_success(self, index, rtt):
+        """记录一次成功连接（延迟直方图按目标地址计）"""
+        with self.health_lock:
+            if index >= len(self.health):
+                return  # 线路已在重载配置时移除
+            h = self.health[index]
+            target = self.targets[index]
+            add = self.counters.add
+            add(('connect_bucket', target, bisect.bisect_left(CONNECT_LATENCY_BUCKETS, rtt)))
+            add(('connect_sum', target), rtt)
+            add(('connect_count', target))
+            h.rtt = rtt if h.rtt is None else h.rtt + EWMA_ALPHA * (rtt - h.rtt)
+            h.fail_rate -= EWMA_ALPHA * h.fail_rate
+            h.failures = 0
+            recovered = h.ejected_until > 0
+            h.ejected_until = 0.0
+        if recovered:
+            self.log(f"[健康检查] 目标{index+1} {target} 已恢复 (RTT {rtt*1000:.1f}ms)")
+
+    def record_connect_failure(self, index):
+        """记录一次失败连接，连续失败达到阈值时剔除线路"""
+        ejected = False
+        with self.health_lock:
+            if index >= len(self.health):
+                return
+            h = self.health[index]
+            target = self.targets[index]
+            h.fail_rate += EWMA_ALPHA * (1 - h.fail_rate)
+            h.failures += 1
+            now = time.time()
+            if self.health_check and h.failures >= self.eject_failures and h.ejected_until <= now:
+                h.ejected_until = now + self.eject_time
+                ejected = True
+        if ejected:
+            self.log(f"[健康检查] 目标{index+1} {target} 连续失败{h.failures}次，剔除{self.eject_time}秒", 'warning')
+
+    def failover_order(self, first_index, lines):
+        """故障转移顺序：先选中线路，再依次尝试快照中的其余线路（未剔除的优先）"""
+        count = len(lines.targets)
+        others = [(first_index + i) % count for i in range(1, count)]
+        return [first_index] + sorted(others, key=lambda i: self.is_ejected(i, lines))
+
+    def line_profile(self, index):
+        """线路的socket配置，未配置时为None"""
+        return self.line_profiles.get(index + 1, self.target_profile)
+
+    def add_line_shapers(self):
+        """为尚未单独配置限速的线路套用所有线路共用的限速（重载配置增加线路时同样调用）"""
+        if self.shape_default:
+            for number in range(1, self.target_count + 1):
+                if number not in self.shapers:
+                    self.shapers[number] = LineShaper(self.shape_default, 1 / self.workers)
+
+    def line_shaper(self, index):
+        """线路的限速器，未限速时为None"""
+        return self.shapers.get(index + 1)
+
+    def shaping_wait(self, shaper, counter_key, size):
+        """TCP发送前预约令牌，返回需等待的秒数（计入该线路的限速等待时间）"""
+        wait = shaper.reserve('up' if counter_key[0] == 'bytes_in' else 'down', size)
+        if wait:
+            self.counters.add(('throttle', 'tcp', counter_key[2]), wait)
+        return wait
+
+    def shape_udp_packet(self, index, target, direction, size):
+        """UDP数据包发送前预约令牌：返回需等待的秒数，按策略丢弃时返回None（计数）"""
+        shaper = self.shapers.get(index + 1)
+        if shaper is None:
+            return 0.0
+        max_wait = self.shape_max_delay if self.shape_policy == 'queue' else 0.0
+        wait = shaper.reserve(direction, size, packet=True, max_wait=max_wait)
+        if wait is None:
+            self.counters.add(('shape_drop', direction, target))
+        elif wait:
+            self.counters.add(('throttle', 'udp', target), wait)
+        return wait
+
+    def line_fastopen(self, index):
+        """线路的上游socket是否启用了TCP_FASTOPEN_CONNECT（connect立即返回，握手耗时不可测）"""
+        profile = self.line_profile(index)
+        return bool(profile and profile.options.get('fastopen'))
+
+    def upstream_socket(self, index, target):
+        """创建连接目标线路用的TCP socket，并应用该线路的socket配置"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        profile = self.line_profile(index)
+        if profile:
+            for key, error in profile.apply(sock):
+                if (index, key) not in self.sockopt_warned:
+                    self.sockopt_warned.add((index, key))
+                    self.log(f"[socket选项] T{index+1}:{target} 无法设置 {key}: {error}", 'warning')
+        return sock
+
+    def connect_line(self, index, target):
+        """阻塞连接目标线路，返回已连接的socket，失败时抛出OSError"""
+        sock = self.upstream_socket(index, target)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect(target)
+        except:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def connect_upstream(self, target_index, client_address):
+        """连接目标线路，失败时故障转移到下一条线路，返回(socket, 实际线路)"""
+        lines, target_index = self.resolve_line(target_index)
+        if lines.pools:
+            sock = lines.pools[target_index].acquire()
+            if sock is not None:
+                return sock, target_index
+        if self.race_delay:
+            return self.connect_upstream_race(target_index, client_address, lines)
+        
+        last_error = None
+        for index in self.strategy.failover_order(client_address, target_index, lines):
+            target = lines.targets[index]
+            sock = self.upstream_socket(index, target)
+            sock.settimeout(self.connect_timeout)
+            start = time.perf_counter()
+            try:
+                sock.connect(target)
+            except OSError as e:
+                sock.close()
+                self.record_connect_failure(index)
+                self.log(f"[TCP故障转移] {client_address} T{index+1}:{target} 连接失败: {e}", 'warning')
+                last_error = e
+                continue
+            if not self.line_fastopen(index):
+                self.record_connect_success(index, time.perf_counter() - start)
+            sock.settimeout(None)
+            return sock, index
+        raise last_error
+
+    async def connect_upstream_async(self, target_index, client_address):
+        """协程方式连接目标线路（故障转移逻辑同connect_upstream）"""
+        loop = self.loop
+        lines, target_index = self.resolve_line(target_index)
+        if lines.pools:
+            sock = lines.pools[target_index].acquire()
+            if sock is not None:
+                sock.setblocking(False)
+                return sock, target_index
+        if self.race_delay:
+            return await self.connect_upstream_race_async(target_index, client_address, lines)
+        
+        last_error = None
+        for index in self.strategy.failover_order(client_address, target_index, lines):
+            target = lines.targets[index]
+            sock = self.upstream_socket(index, target)
+            sock.setblocking(False)
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, target), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                sock.close()
+                self.record_connect_failure(index)
+                self.log(f"[TCP故障转移] {client_address} T{index+1}:{target} 连接失败: {e or '超时'}", 'warning')
+                last_error = e if isinstance(e, OSError) else socket.timeout('timed out')
+                continue
+            if not self.line_fastopen(index):
+                self.record_connect_success(index, time.perf_counter() - start)
+            return sock, index
+        raise last_error
+
+    # ========== 连接竞速 ==========
+    def record_race(self, winner_index, winner_target, launched, client_address):
+        """记录一次竞速结果（至少发起了两条线路的连接）"""
+        self.counters.add(('race_total',))
+        self.counters.add(('race_win', winner_target))
+        if self.sample_flow_log():
+            self.logger.info("[TCP竞速] %s 同时连接%d条线路，T%d:%s 胜出",
+                             client_address, launched, winner_index + 1, winner_target)
+
+    def record_race_saved(self, saved):
+        """记录竞速节省的时间：首选线路实际完成（或超时/失败）时刻与胜出时刻之差"""
+        self.counters.add(('race_saved_sum',), max(saved, 0.0))
+        self.counters.add(('race_saved_count',))
+
+    def connect_upstream_race(self, target_index, client_address, lines):
+        """连接竞速：当前尝试在race_delay内未完成握手时，并行连接故障转移顺序中的下一条线路，先完成者胜出"""
+        targets = lines.targets
+        order = self.strategy.failover_order(client_address, target_index, lines)
+        selector = selectors.DefaultSelector()
+        pending = {}  # socket -> (线路, 发起时刻)
+        first = None
+        launched = 0
+        last_error = None
+        start = time.perf_counter()
+        deadline = start + self.connect_timeout
+        next_launch = start
+        try:
+            while True:
+                now = time.perf_counter()
+                if order and (now >= next_launch or not pending):
+                    index = order.pop(0)
+                    sock = self.upstream_socket(index, targets[index])
+                    sock.setblocking(False)
+                    err = sock.connect_ex(targets[index])
+                    if err not in (0, errno.EINPROGRESS):
+                        sock.close()
+                        self.record_connect_failure(index)
+                        last_error = OSError(err, os.strerror(err))
+                        self.log(f"[TCP竞速] {client_address} T{index+1}:{targets[index]} 连接失败: {last_error}", 'warning')
+                        continue
+                    pending[sock] = (index, now)
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    first = first or sock
+                    launched += 1
+                    next_launch = now + self.race_delay
+                    continue
+                
+                if not pending:
+                    raise last_error or socket.timeout('timed out')
+                if now >= deadline:
+                    for index, _ in pending.values():
+                        self.record_connect_failure(index)
+                    raise socket.timeout('timed out')
+                
+                wait = min(deadline, next_launch) - now if order else deadline - now
+                for key, _ in selector.select(max(wait, 0)):
+                    sock = key.fileobj
+                    index, began = pending.pop(sock)
+                    selector.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err:
+                        sock.close()
+                        self.record_connect_failure(index)
+                        last_error = OSError(err, os.strerror(err))
+                        self.log(f"[TCP竞速] {client_address} T{index+1}:{targets[index]} 连接失败: {last_error}", 'warning')
+                        next_launch = 0  # 失败时立即尝试下一条线路
+                        continue
+                    
+                    finished = time.perf_counter()
+                    self.record_connect_success(index, finished - began)
+                    if launched > 1:
+                        self.record_race(index, targets[index], launched, client_address)
+                        if first in pending:
+                            # 首选线路仍在握手：交给后台继续观察，得出实际节省的时间
+                            first_index, first_began = pending.pop(first)
+                            selector.unregister(first)
+                            self.race_reaper_add(first, first_index, first_began, finished)
+                    sock.setblocking(True)
+                    return sock, index
+        finally:
+            for sock in pending:
+                sock.close()
+            selector.close()
+
+    def race_reaper_add(self, sock, index, began, won_at):
+        """登记一个竞速中落败、仍在握手的首选线路连接"""
+        with self.race_lock:
+            if self.race_reaper is None:
+                self.race_reaper = selectors.DefaultSelector()
+                threading.Thread(target=self.run_race_reaper, daemon=True).start()
+            self.race_reaper.register(sock, selectors.EVENT_WRITE, (index, began, won_at))
+
+    def run_race_reaper(self):
+        """后台观察落败的首选线路连接直到完成或超时，记录节省时间及该线路的健康结果后关闭"""
+        while self.running:
+            events = self.race_reaper.select(timeout=0.2)
+            now = time.perf_counter()
+            with self.race_lock:
+                done = [(key, False) for key, _ in events]
+                done += [
+                    (key, True) for key in self.race_reaper.get_map().values()
+                    if now - key.data[1] >= self.connect_timeout and all(key is not d for d, _ in done)
+                ]
+                for key, _ in done:
+                    self.race_reaper.unregister(key.fileobj)
+            for key, timed_out in done:
+                sock = key.fileobj
+                index, began, won_at = key.data
+                if timed_out or sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    self.record_connect_failure(index)
+                    self.record_race_saved(min(now, began + self.connect_timeout) - won_at)
+                else:
+                    self.record_connect_success(index, now - began)
+                    self.record_race_saved(now - won_at)
+                sock.close()
+
+    async def connect_upstream_race_async(self, target_index, client_address, lines):
+        """协程方式连接竞速（逻辑同connect_upstream_race）"""
+        loop = self.loop
+        targets = lines.targets
+        order = self.strategy.failover_order(client_address, target_index, lines)
+        attempts = {}  # task -> (线路, socket, 发起时刻)
+        first = None
+        launched = 0
+        last_error = None
+        start = time.perf_counter()
+        deadline = start + self.connect_timeout
+        next_launch = start
+        
+        def discard(task, sock):
+            # 取消后待任务结束再关闭socket，避免事件循环仍在监听已关闭的描述符
+            task.cancel()
+            task.add_done_callback(lambda _: sock.close())
+        
+        try:
+            while True:
+                now = time.perf_counter()
+                if order and (now >= next_launch or not attempts):
+                    index = order.pop(0)
+                    sock = self.upstream_socket(index, targets[index])
+                    sock.setblocking(False)
+                    task = loop.create_task(loop.sock_connect(sock, targets[index]))
+                    attempts[task] = (index, sock, now)
+                    first = first or task
+                    launched += 1
+                    next_launch = now + self.race_delay
+                    continue
+                
+                if not attempts:
+                    raise last_error or socket.timeout('timed out')
+                if now >= deadline:
+                    for index, _, _ in attempts.values():
+                        self.record_connect_failure(index)
+                    raise socket.timeout('timed out')
+                
+                wait = min(deadline, next_launch) - now if order else deadline - now
+                done, _ = await asyncio.wait(list(attempts), timeout=max(wait, 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    index, sock, began = attempts.pop(task)
+                    if task.exception() is not None or winner is not None:
+                        if task.exception() is not None:
+                            self.record_connect_failure(index)
+                            last_error = task.exception()
+                            self.log(f"[TCP竞速] {client_address} T{index+1}:{targets[index]} 连接失败: {last_error}", 'warning')
+                            next_launch = 0
+                        sock.close()
+                        continue
+                    winner = (sock, index, began)
+                if winner is None:
+                    continue
+                
+                sock, index, began = winner
+                finished = time.perf_counter()
+                self.record_connect_success(index, finished - began)
+                if launched > 1:
+                    self.record_race(index, targets[index], launched, client_address)
+                    if first in attempts:
+                        first_index, first_sock, first_began = attempts.pop(first)
+                        self.watch_race_loser_async(first, first_index, first_sock, first_began, finished)
+                return sock, index
+        finally:
+            for task, (_, sock, _) in attempts.items():
+                discard(task, sock)
+
+    def watch_race_loser_async(self, task, index, sock, began, won_at):
+        """协程方式观察落败的首选线路连接（同run_race_reaper）"""
+        timer = self.loop.call_later(max(began + self.connect_timeout - time.perf_counter(), 0), task.cancel)
+        
+        def finished(task):
+            timer.cancel()
+            now = time.perf_counter()
+            if task.cancelled() or task.exception() is not None:
+                self.record_connect_failure(index)
+                self.record_race_saved(min(now, began + self.connect_timeout) - won_at)
+            else:
+                self.record_connect_success(index, now - began)
+                self.record_race_saved(now - won_at)
+            sock.close()
+        
+        task.add_done_callback(finished)
+
+    def refill_upstream_pool(self, pool):
+        """后台补充单条线路的预连接池（线路在重载配置时被移除后退出）"""
+        while self.running:
+            with self.health_lock:
+                if pool not in self.upstream_pools:
+                    break
+                index = self.upstream_pools.index(pool)
+                target = self.targets[index]
+            missing = pool.prune()
+            while missing > 0 and self.running and not self.is_ejected(index):
+                start = time.perf_counter()
+                try:
+                    sock = self.connect_line(index, target)
+                except OSError:
+                    self.record_connect_failure(index)
+                    break
+                elapsed = time.perf_counter() - start
+                self.record_connect_success(index, elapsed)
+                pool.put(sock, elapsed)
+                missing -= 1
+            pool.wakeup.wait(1.0)
+            pool.wakeup.clear()
+        pool.close()
+
+    def probe_target(self, index, target):
+        """对单条线路做一次TCP连接探测"""
+        start = time.perf_counter()
+        try:
+            socket.create_connection(target, timeout=self.connect_timeout).close()
+        except OSError:
+            self.record_connect_failure(index)
+            return
+        self.record_connect_success(index, time.perf_counter() - start)
+
+    def probe_targets(self):
+        """主动健康检查：定期并行探测所有线路"""
+        while self.running:
+            probes = [
+                threading.Thread(target=self.probe_target, args=(i, target), daemon=True)
+                for i, target in enumerate(self.lines.targets)
+            ]
+            for probe in probes:
+                probe.start()
+            for probe in probes:
+                probe.join()
+            time.sleep(self.health_check)
+
+    # ========== 自适应小包阈值 ==========
+    def adapt_size_threshold(self):
+        """定期按最近的首包大小分布调整小包阈值，使主线路的流量占比接近size_target
+
+        直方图由累计计数逐周期求差得到，旧周期按SIZE_ADAPT_DECAY衰减，跟随流量构成的变化。
+        """
+        buckets = len(PACKET_SIZE_BUCKETS) + 1
+        smoothed, smoothed_none = [0.0] * buckets, 0.0
+        last, last_none = [0] * buckets, 0
+        while self.running:
+            time.sleep(self.size_adapt_interval)
+            counters = self.counters.snapshot()
+            current = [counters.get(('size_bucket', b), 0) for b in range(buckets)]
+            none = counters.get(('size_none',), 0)
+            smoothed = [old * SIZE_ADAPT_DECAY + new - prev for old, new, prev in zip(smoothed, current, last)]
+            smoothed_none = smoothed_none * SIZE_ADAPT_DECAY + none - last_none
+            last, last_none = current, none
+            if sum(smoothed) >= SIZE_ADAPT_MIN_SAMPLES:
+                self.update_size_threshold(smoothed, smoothed_none)
+
+    def update_size_threshold(self, histogram, timeouts):
+        """按直方图求阈值：预计占比已在目标的滞回范围内时保持不变
+
+        小于阈值的流走主线路，其余加权轮询（主线路按权重分得一份），未读到首包的TCP连接也走主线路，
+        故主线路占比 = q + (1-q)·(F + (1-F)·wp)，q为首包超时比例，F为小于阈值的比例，wp为主线路的权重占比。
+        """
+        total = sum(histogram)
+        q = timeouts / (total + timeouts)
+        lines = self.lines
+        wp = lines.weights[lines.primary] / sum(lines.weights)
+        
+        def share(fraction):
+            return q + (1 - q) * (fraction + (1 - fraction) * wp)
+        
+        # 候选阈值为各桶边界：阈值取 PACKET_SIZE_BUCKETS[k] 时，桶 0..k 内的流走主线路
+        candidates = [(0, 0.0)]
+        cumulative = 0.0
+        for bound, count in zip(PACKET_SIZE_BUCKETS, histogram):
+            cumulative += count
+            candidates.append((bound, cumulative / total))
+        current = sum(histogram[:bisect.bisect_right(PACKET_SIZE_BUCKETS, self.small_packet_size)]) / total
+        self.size_predicted = share(current)
+        if abs(self.size_predicted - self.size_target) <= SIZE_ADAPT_HYSTERESIS:
+            return
+        threshold, fraction = min(candidates, key=lambda c: abs(share(c[1]) - self.size_target))
+        if threshold == self.small_packet_size:
+            return
+        self.log(f"[自适应阈值] {self.small_packet_size}B -> {threshold}B（目标主线路占比 {self.size_target * 100:.0f}%，"
+                 f"调整前预计 {self.size_predicted * 100:.1f}%，调整后预计 {share(fraction) * 100:.1f}%）")
+        self.small_packet_size = threshold
+        self.size_predicted = share(fraction)
+
+    def update_stats(self, protocol, target, is_small_packet=None):
+        """更新统计（写入本线程的计数分片，按目标地址计）"""
+        add = self.counters.add
+        add(('total', protocol, target))
+        if is_small_packet is not None:
+            add(('small' if is_small_packet else 'large', protocol))
 
     # ========== TCP处理方法 ==========
+    def select_tcp_target(self, client_address, packet_size):
+        """根据分流策略为TCP连接选择目标"""
+        target_index, is_small = self.strategy.select('tcp', client_address, packet_size)
+        lines, target_index = self.resolve_line(target_index)
+        target = lines.targets[target_index]
+        if self.sample_flow_log():
+            self.logger.info("[%s] %s -> T%d:%s (%s)", self.strategy.label('tcp', is_small),
+                             client_address, target_index + 1, target,
+                             f"{packet_size}B" if packet_size is not None else "未读首包")
+        return target, target_index, is_small
+
+    def forward(self, src, dst, counter_key, shaper=None):
+        """单向转发（用户态拷贝，复用缓冲池中的缓冲区），字节数计入counter_key；线路限速时按令牌桶匀速发送"""
+        add = self.counters.add
+        pool = self.buffer_pools['tcp']
+        buf = pool.acquire()
+        view = memoryview(buf)
+        eof = False
+        try:
+            while True:
+                n = src.recv_into(view)
+                if not n:
+                    eof = True
+                    break
+                if shaper:
+                    wait = self.shaping_wait(shaper, counter_key, n)
+                    if wait:
+                        time.sleep(wait)
+                dst.sendall(view[:n])
+                add(counter_key, n)
+        except:
+            pass
+        finally:
+            view.release()
+            pool.release(buf)
+            self.end_forward(src, dst, eof)
+
+    def end_forward(self, src, dst, eof):
+        """单向转发结束：源端正常EOF时向目的端传递FIN（半关闭），出错时中断整条连接"""
+        try:
+            if eof:
+                dst.shutdown(socket.SHUT_WR)
+                return
+            src.shutdown(socket.SHUT_RDWR)
+            dst.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def forward_splice(self, src, dst, counter_key, shaper=None):
+        """单向转发（splice零拷贝：socket -> pipe -> socket）"""
+        try:
+            pipe_r, pipe_w = os.pipe()
+        except OSError:
+            return self.forward(src, dst, counter_key, shaper)
+        
+        fallback = False
+        moved = False
+        eof = False
+        try:
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            while True:
+                try:
+                    n = os.splice(src_fd, pipe_w, SPLICE_CHUNK, flags=os.SPLICE_F_MOVE)
+                except OSError as e:
+                    # 内核或socket类型不支持splice时，退回拷贝转发
+                    fallback = not moved and e.errno in (errno.EINVAL, errno.ENOSYS)
+                    break
+                if n == 0:
+                    eof = True
+                    break
+                moved = True
+                self.counters.add(counter_key, n)
+                if shaper:
+                    wait = self.shaping_wait(shaper, counter_key, n)
+                    if wait:
+                        time.sleep(wait)
+                while n > 0:
+                    n -= os.splice(pipe_r, dst_fd, n, flags=os.SPLICE_F_MOVE)
+        except OSError:
+            pass
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+        
+        if fallback:
+            return self.forward(src, dst, counter_key, shaper)
+        self.end_forward(src, dst, eof)
+
     def handle_tcp_client(self, client_socket, client_address):
         """处理TCP连接"""
         target_socket = None
+        flow_target = None
         try:
-            # 接收第一个数据包
-            client_socket.settimeout(5)
-            first_data = client_socket.recv(8192)
-            client_socket.settimeout(None)
-            
-            if not first_data:
-                client_socket.close()
-                return
-            
-            packet_size = len(first_data)
+            # 按包大小分流时先读取首包，超时（服务端先发言的协议）则不再等待
+            first_data = None
+            if self.strategy.needs_first_packet:
+                client_socket.settimeout(self.peek_timeout)
+                try:
+                    first_data = client_socket.recv(self.tcp_buffer_size)
+                except socket.timeout:
+                    pass
+                client_socket.settimeout(None)
+                if first_data == b'':
+                    client_socket.close()
+                    return
             
             # 根据模式选择目标
-            if self.mode == 'auto':
-                target, target_index = self.get_next_tcp_target()
-                is_small = packet_size < self.small_packet_size
-                self.log(f"[TCP轮询#{(self.tcp_connection_count % self.target_count) + 1}] {client_address} -> T{target_index+1}:{target} ({packet_size}B)")
-            else:
-                if packet_size < self.small_packet_size:
-                    target, target_index = self.targets[self.primary_index], self.primary_index
-                    is_small = True
-                    self.log(f"[TCP小包] {client_address} -> T{target_index+1}:{target} ({packet_size}B)")
-                else:
-                    target, target_index = self.get_next_tcp_target()
-                    is_small = False
-                    self.log(f"[TCP大包] {client_address} -> T{target_index+1}:{target} ({packet_size}B)")
-            
-            self.update_stats('tcp', target_index, is_small)
+            packet_size = len(first_data) if first_data else None
+            _, selected_index, is_small = self.select_tcp_target(client_address, packet_size)
             
-            # 连接目标并转发
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.connect(target)
-            target_socket.sendall(first_data)
+            # 连接目标（失败时故障转移）并转发
+            target_socket, target_index = self.connect_upstream(selected_index, client_address)
+            flow_target = self.flow_started('tcp', target_index)
+            self.update_stats('tcp', flow_target, is_small)
+            shaper = self.line_shaper(target_index)
+            if first_data:
+                wait = self.shaping_wait(shaper, ('bytes_in', 'tcp', flow_target), len(first_data)) if shaper else 0
+                if wait:
+                    time.sleep(wait)
+                target_socket.sendall(first_data)
+                self.counters.add(('bytes_in', 'tcp', flow_target), len(first_data))
             
             # 双向转发
-            def forward(src, dst, direction):
-                try:
-                    while True:
-                        data = src.recv(8192)
-                        if not data:
-                            break
-                        dst.sendall(data)
-                except:
-                    pass
-                finally:
-                    try:
-                        src.shutdown(socket.SHUT_RDWR)
-                    except:
-                        pass
-            
-            t1 = threading.Thread(target=forward, args=(client_socket, target_socket, "C->T"))
-            t2 = threading.Thread(target=forward, args=(target_socket, client_socket, "T->C"))
+            forward = self.forward_splice if self.use_splice else self.forward
+            t1 = threading.Thread(target=forward, args=(client_socket, target_socket, ('bytes_in', 'tcp', flow_target), shaper))
+            t2 = threading.Thread(target=forward, args=(target_socket, client_socket, ('bytes_out', 'tcp', flow_target), shaper))
             t1.daemon = t2.daemon = True
             t1.start()
             t2.start()
@@ -227,137 +2378,854 @@ class MultiLineLoadBalancer:
         except Exception as e:
             self.log(f"[TCP错误] {client_address}: {e}", 'error')
         finally:
+            if flow_target is not None:
+                self.flow_finished('tcp', flow_target)
+            try:
+                if client_socket:
+                    client_socket.close()
+                if target_socket:
+                    target_socket.close()
+            except:
+                pass
+
+    # ========== 多线路绑定 ==========
+    def connect_bond_line(self, index, lines):
+        """为绑定会话连接一条线路（下标按lines快照解释），失败返回None"""
+        if lines.pools:
+            sock = lines.pools[index].acquire()
+            if sock is not None:
+                return sock
+        start = time.perf_counter()
+        try:
+            sock = self.connect_line(index, lines.targets[index])
+        except OSError as e:
+            self.record_connect_failure(index)
+            self.log(f"[绑定] T{index+1}:{lines.targets[index]} 连接失败: {e}", 'warning')
+            return None
+        if not self.line_fastopen(index):
+            self.record_connect_success(index, time.perf_counter() - start)
+        return sock
+
+    def handle_bond_client(self, client_socket, client_address):
+        """绑定客户端：把一条TCP连接拆分到所有可用线路"""
+        lines = self.lines
+        preferred = self.preferred_targets(lines)
+        indices = preferred if preferred is not None else list(range(len(lines.targets)))
+        socks = [None] * len(lines.targets)
+        
+        def connect(index):
+            socks[index] = self.connect_bond_line(index, lines)
+        
+        threads = [threading.Thread(target=connect, args=(i,), daemon=True) for i in indices]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        connected = [(i, sock) for i, sock in enumerate(socks) if sock is not None]
+        if not connected:
+            self.log(f"[绑定] {client_address}: 所有线路均无法连接", 'error')
+            client_socket.close()
+            return
+        
+        session = BondSession(self, os.urandom(16))
+        for index, sock in connected:
+            try:
+                sock.sendall(BOND_HELLO.pack(BOND_MAGIC, session.id, index, len(connected)))
+            except OSError as e:
+                self.log(f"[绑定] T{index+1}:{lines.targets[index]} 握手失败: {e}", 'warning')
+                sock.close()
+                continue
+            session.flow_targets.append(self.flow_started('tcp', index))
+            self.counters.add(('bond_links', lines.targets[index]))
+            session.add_link(index, sock, lines.weights[index] * BOND_RATE_PRIOR, lines.targets[index])
+        if not session.links:
+            client_socket.close()
+            return
+        # 一条客户端连接只计一次，子连接按线路单独计数
+        self.counters.add(('bond_sessions',))
+        if self.sample_flow_log():
+            self.logger.info("[绑定] %s -> %d条线路 %s", client_address, len(session.links),
+                             [f"T{link.index+1}" for link in session.links])
+        session.start(client_socket)
+
+    def handle_bond_subflow(self, sock, address):
+        """绑定服务端：接收一条子连接，按会话ID归入绑定会话，新会话连接后端"""
+        try:
+            sock.settimeout(self.connect_timeout)
+            magic, session_id, line, _ = BOND_HELLO.unpack(recv_exact(sock, BOND_HELLO.size))
+            sock.settimeout(None)
+            if magic != BOND_MAGIC:
+                raise ValueError('非绑定协议连接')
+        except (OSError, EOFError, ValueError) as e:
+            self.log(f"[绑定] {address}: 握手失败: {e}", 'warning')
+            sock.close()
+            return
+        
+        with self.bond_lock:
+            session = self.bond_sessions.get(session_id)
+            is_new = session is None
+            if is_new:
+                session = BondSession(self, session_id, server=True)
+                self.bond_sessions[session_id] = session
+        session.add_link(line, sock, BOND_RATE_PRIOR)
+        if not is_new:
+            return
+        
+        try:
+            backend, _ = self.connect_upstream(0, address)
+        except OSError as e:
+            self.log(f"[绑定] {address}: 后端连接失败: {e}", 'error')
+            session.close()
+            return
+        session.stat_target = self.flow_started('tcp', 0)
+        session.flow_targets.append(session.stat_target)
+        self.update_stats('tcp', session.stat_target)
+        self.counters.add(('bond_sessions',))
+        if self.sample_flow_log():
+            self.logger.info("[绑定] 会话 %s 来自 %s -> %s", session_id.hex()[:8], address[0], self.targets[0])
+        session.start(backend)
+
+    def bond_session_closed(self, session):
+        """绑定会话关闭后的清理"""
+        if session.server:
+            with self.bond_lock:
+                self.bond_sessions.pop(session.id, None)
+        for target in session.flow_targets:
+            self.flow_finished('tcp', target)
+
+    # ========== asyncio引擎 ==========
+    async def forward_async(self, src, dst, counter_key, shaper=None):
+        """协程方式单向转发（复用缓冲池中的缓冲区），线路限速时按令牌桶匀速发送"""
+        loop = self.loop
+        add = self.counters.add
+        pool = self.buffer_pools['tcp']
+        buf = pool.acquire()
+        view = memoryview(buf)
+        eof = False
+        try:
+            while True:
+                n = await loop.sock_recv_into(src, view)
+                if not n:
+                    eof = True
+                    break
+                if shaper:
+                    wait = self.shaping_wait(shaper, counter_key, n)
+                    if wait:
+                        await asyncio.sleep(wait)
+                await loop.sock_sendall(dst, view[:n])
+                add(counter_key, n)
+        except Exception:
+            pass
+        finally:
+            view.release()
+            pool.release(buf)
+            self.end_forward(src, dst, eof)
+
+    async def wait_fd(self, fd, writable=False):
+        """等待文件描述符可读/可写"""
+        loop = self.loop
+        future = loop.create_future()
+        
+        def ready():
+            if not future.done():
+                future.set_result(None)
+        
+        if writable:
+            loop.add_writer(fd, ready)
+        else:
+            loop.add_reader(fd, ready)
+        try:
+            await future
+        finally:
+            if writable:
+                loop.remove_writer(fd)
+            else:
+                loop.remove_reader(fd)
+
+    async def forward_splice_async(self, src, dst, counter_key, shaper=None):
+        """协程方式splice零拷贝转发（非阻塞splice + 事件循环等待就绪）"""
+        try:
+            pipe_r, pipe_w = os.pipe()
+        except OSError:
+            return await self.forward_async(src, dst, counter_key, shaper)
+        
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        fallback = False
+        moved = False
+        eof = False
+        try:
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            while True:
+                try:
+                    n = os.splice(src_fd, pipe_w, SPLICE_CHUNK, flags=flags)
+                except BlockingIOError:
+                    await self.wait_fd(src_fd)
+                    continue
+                except OSError as e:
+                    fallback = not moved and e.errno in (errno.EINVAL, errno.ENOSYS)
+                    break
+                if n == 0:
+                    eof = True
+                    break
+                moved = True
+                self.counters.add(counter_key, n)
+                if shaper:
+                    wait = self.shaping_wait(shaper, counter_key, n)
+                    if wait:
+                        await asyncio.sleep(wait)
+                while n > 0:
+                    try:
+                        n -= os.splice(pipe_r, dst_fd, n, flags=flags)
+                    except BlockingIOError:
+                        await self.wait_fd(dst_fd, writable=True)
+        except OSError:
+            pass
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+        
+        if fallback:
+            return await self.forward_async(src, dst, counter_key, shaper)
+        self.end_forward(src, dst, eof)
+
+    async def handle_tcp_client_async(self, client_socket, client_address):
+        """协程方式处理TCP连接（与handle_tcp_client语义一致）"""
+        loop = self.loop
+        target_socket = None
+        flow_target = None
+        try:
+            # 按包大小分流时先读取首包，超时（服务端先发言的协议）则不再等待
+            first_data = None
+            if self.strategy.needs_first_packet:
+                try:
+                    first_data = await asyncio.wait_for(
+                        loop.sock_recv(client_socket, self.tcp_buffer_size), self.peek_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                if first_data == b'':
+                    return
+            
+            # 根据模式选择目标
+            packet_size = len(first_data) if first_data else None
+            _, selected_index, is_small = self.select_tcp_target(client_address, packet_size)
+            
+            # 连接目标（失败时故障转移）并转发
+            target_socket, target_index = await self.connect_upstream_async(selected_index, client_address)
+            flow_target = self.flow_started('tcp', target_index)
+            self.update_stats('tcp', flow_target, is_small)
+            shaper = self.line_shaper(target_index)
+            if first_data:
+                wait = self.shaping_wait(shaper, ('bytes_in', 'tcp', flow_target), len(first_data)) if shaper else 0
+                if wait:
+                    await asyncio.sleep(wait)
+                await loop.sock_sendall(target_socket, first_data)
+                self.counters.add(('bytes_in', 'tcp', flow_target), len(first_data))
+            
+            # 双向转发
+            forward = self.forward_splice_async if self.use_splice else self.forward_async
+            await asyncio.gather(
+                forward(client_socket, target_socket, ('bytes_in', 'tcp', flow_target), shaper),
+                forward(target_socket, client_socket, ('bytes_out', 'tcp', flow_target), shaper)
+            )
+            
+        except Exception as e:
+            self.log(f"[TCP错误] {client_address}: {e}", 'error')
+        finally:
+            if flow_target is not None:
+                self.flow_finished('tcp', flow_target)
             try:
-                if client_socket:
-                    client_socket.close()
+                client_socket.close()
                 if target_socket:
                     target_socket.close()
             except:
                 pass
 
-    # ========== UDP处理方法 ==========
-    def get_udp_target(self, client_address, packet_size):
-        """获取UDP客户端对应的目标（保持会话一致性）"""
-        with self.session_lock:
-            if client_address in self.client_sessions:
-                target, target_index, _ = self.client_sessions[client_address]
-                self.client_sessions[client_address] = (target, target_index, time.time())
-                return target, target_index, False
+    async def run_tcp_client_async(self, item):
+        """协程方式处理获准的TCP连接，完成后接手排队中的下一条，队列为空时归还名额"""
+        try:
+            while item is not None:
+                try:
+                    await self.handle_tcp_client_async(*item)
+                finally:
+                    # 被取消时同样归还名额
+                    self.client_flow_finished(item[1])
+                    item = self.tcp_gate.release() if self.tcp_gate else None
+        except asyncio.CancelledError:
+            # 停止时被取消：转交过来的排队连接不再处理，直接关闭并归还名额
+            while item is not None:
+                item[0].close()
+                self.client_flow_finished(item[1])
+                item = self.tcp_gate.release()
+            raise
+
+    async def start_tcp_server_async(self):
+        """协程方式接受TCP连接"""
+        loop = self.loop
+        self.tcp_server.setblocking(False)
+        while self.running and not self.draining:
+            try:
+                client_socket, client_address = await asyncio.wait_for(
+                    loop.sock_accept(self.tcp_server), 1.0)
+            except asyncio.TimeoutError:
+                continue
+            except Exception as e:
+                if self.running:
+                    self.log(f"[TCP错误] {e}", 'error')
+                break
+            client_socket.setblocking(False)
+            item = (client_socket, client_address)
+            if not self.client_flow_started(client_address):
+                self.drop_tcp_client(item, 'per_ip')
+                continue
+            if self.tcp_gate and not self.tcp_gate.admit(item):
+                continue
+            task = loop.create_task(self.run_tcp_client_async(item))
+            self.tcp_tasks.add(task)
+            task.add_done_callback(self.tcp_tasks.discard)
+        
+        # 交接后等待在途连接结束（超时后running置为False），停止时取消仍在转发的连接
+        while self.draining and self.running and self.tcp_tasks:
+            await asyncio.sleep(0.5)
+        for task in list(self.tcp_tasks):
+            task.cancel()
+        if self.tcp_tasks:
+            await asyncio.gather(*self.tcp_tasks, return_exceptions=True)
+
+    def run_asyncio_engine(self):
+        """在独立事件循环中运行TCP服务"""
+        try:
+            self.tcp_server = self.create_listener(socket.SOCK_STREAM)
+            self.log(f"[TCP] 监听在 {self.listen_host}:{self.listen_port} (asyncio引擎)")
             
-            # 新会话
-            if self.mode == 'auto':
-                target, target_index = self.get_next_udp_target()
-                is_small = packet_size < self.small_packet_size
-            else:
-                if packet_size < self.small_packet_size:
-                    target, target_index = self.targets[self.primary_index], self.primary_index
-                    is_small = True
-                else:
-                    target, target_index = self.get_next_udp_target()
-                    is_small = False
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start_tcp_server_async())
+        except Exception as e:
+            self.log(f"[TCP启动错误] {e}", 'error')
+        finally:
+            if self.loop:
+                self.loop.close()
+            if self.tcp_server:
+                self.tcp_server.close()
+
+    # ========== UDP处理方法 ==========
+    def get_udp_session(self, client_address, packet_size):
+        """获取UDP客户端对应的会话（保持会话一致性）"""
+        def create():
+            if not self.client_flow_started(client_address):
+                raise AdmissionRejected(client_address)
+            target_index, _ = self.strategy.select('udp', client_address, packet_size)
+            lines, target_index = self.resolve_line(target_index)
+            target = lines.targets[target_index]
             
-            self.client_sessions[client_address] = (target, target_index, time.time())
-            return target, target_index, True
+            # 每个会话独占一个已connect的上游socket，只接收该目标的回包（会话存续期间持续转发）
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            session = UdpSession(client_address, target, target_index, sock, self.udp_session_timeout(target))
+            try:
+                sock.setblocking(False)
+                sock.connect(target)
+                self.udp_selector.register(sock, selectors.EVENT_READ, (self, session))
+            except:
+                sock.close()
+                self.client_flow_finished(client_address)
+                raise
+            self.flow_started('udp', target_index)
+            return session
+        
+        session, is_new, evicted = self.client_sessions.get_or_create(client_address, create)
+        for old in evicted:
+            self.close_udp_session(old)
+        return session, is_new
+
+    def udp_session_timeout(self, target):
+        """目标端口对应的会话空闲超时，未单独设置时为udp_timeout"""
+        port = target[1]
+        for first, last, seconds in self.udp_port_timeouts:
+            if first <= port <= last:
+                return seconds
+        return self.udp_timeout
+
+    def close_udp_session(self, session):
+        """关闭会话的上游socket"""
+        try:
+            self.udp_selector.unregister(session.sock)
+        except (KeyError, ValueError):
+            pass
+        session.sock.close()
+        self.flow_finished('udp', session.target)
+        self.client_flow_finished(session.client)
 
-    def handle_udp_packet(self, data, client_address):
-        """处理UDP数据包"""
+    def handle_udp_packet(self, data, client_address, buf=None):
+        """处理UDP数据包（data为缓冲池缓冲区的memoryview切片，处理完后归还）"""
         try:
             packet_size = len(data)
-            target, target_index, is_new = self.get_udp_target(client_address, packet_size)
+            session, is_new = self.get_udp_session(client_address, packet_size)
+            target, target_index = session.target, session.target_index
             
             if is_new:
                 is_small = packet_size < self.small_packet_size
-                self.update_stats('udp', target_index, is_small)
-                if self.mode == 'auto':
-                    self.log(f"[UDP轮询#{(self.udp_connection_count % self.target_count) + 1}] {client_address} -> T{target_index+1}:{target} ({packet_size}B)")
-                else:
-                    self.log(f"[UDP{'小' if is_small else '大'}包] {client_address} -> T{target_index+1}:{target} ({packet_size}B)")
+                self.update_stats('udp', target, is_small)
+                self.counters.add(('udp_new', target))
+                if self.sample_flow_log():
+                    self.logger.info("[%s] %s -> T%d:%s (%dB)", self.strategy.label('udp', is_small),
+                                     client_address, target_index + 1, target, packet_size)
             else:
-                self.update_stats('udp', target_index)
-            
-            # 转发
-            forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            forward_socket.sendto(data, target)
+                self.update_stats('udp', target)
             
-            # 接收响应
-            def handle_response():
-                try:
-                    forward_socket.settimeout(5)
-                    resp_data, _ = forward_socket.recvfrom(65535)
-                    if self.udp_server:
-                        self.udp_server.sendto(resp_data, client_address)
-                except:
-                    pass
-                finally:
-                    forward_socket.close()
+            # 线路限速：超速时按策略排队（本线程等待）或丢弃
+            if self.shapers:
+                wait = self.shape_udp_packet(target_index, target, 'up', packet_size)
+                if wait is None:
+                    return
+                if wait:
+                    time.sleep(wait)
             
-            threading.Thread(target=handle_response, daemon=True).start()
+            # 转发（回包由dispatch_udp_replies统一处理）
+            session.sock.send(data)
+            self.counters.add(('bytes_in', 'udp', target), packet_size)
             
+        except AdmissionRejected:
+            self.counters.add(('overload', 'udp', 'per_ip'))
         except Exception as e:
             self.log(f"[UDP错误] {client_address}: {e}", 'error')
+        finally:
+            if buf is not None:
+                data.release()
+                self.buffer_pools['udp'].release(buf)
+
+    def dispatch_udp_replies(self):
+        """统一读取所有会话上游socket的回包并经udp_server发回客户端"""
+        buf = self.buffer_pools['udp'].acquire()
+        view = memoryview(buf)
+        while self.running:
+            try:
+                events = self.udp_selector.select(timeout=1.0)
+            except OSError:
+                break
+            relay_udp_replies(events, view)
 
     def clean_udp_sessions(self):
-        """清理过期UDP会话"""
+        """每秒推进会话表时间轮，关闭空闲超时的会话"""
         while self.running:
-            time.sleep(30)
-            current_time = time.time()
-            with self.session_lock:
-                expired = [
-                    client for client, (_, _, last_seen) in self.client_sessions.items()
-                    if current_time - last_seen > self.session_timeout
-                ]
-                for client in expired:
-                    del self.client_sessions[client]
+            time.sleep(1)
+            for session in self.client_sessions.expire():
+                self.close_udp_session(session)
+
+    def snapshot_stats(self):
+        """生成可序列化的统计快照（多进程模式下用于汇总）"""
+        counters = self.counters.snapshot()
+        # 按线路计的计数器以目标地址为键，重载配置调整线路顺序后仍对应同一目标
+        lines = self.lines
+        snapshot = {}
+        for proto in ('tcp', 'udp'):
+            targets = [counters.get(('total', proto, t), 0) for t in lines.targets]
+            snapshot[proto] = {
+                'total': sum(targets),
+                'small_packets': counters.get(('small', proto), 0),
+                'large_packets': counters.get(('large', proto), 0),
+                'targets': targets,
+                'bytes_in': [counters.get(('bytes_in', proto, t), 0) for t in lines.targets],
+                'bytes_out': [counters.get(('bytes_out', proto, t), 0) for t in lines.targets]
+            }
+        snapshot['udp']['new_sessions'] = [counters.get(('udp_new', t), 0) for t in lines.targets]
+        if self.mode == 'size':
+            # 首包大小直方图（各桶计数，桶上界见PACKET_SIZE_BUCKETS，最后一格为65536B以上）及当前阈值
+            snapshot['packet_sizes'] = {
+                'buckets': [counters.get(('size_bucket', b), 0) for b in range(len(PACKET_SIZE_BUCKETS) + 1)],
+                'timeouts': counters.get(('size_none',), 0)
+            }
+            snapshot['size_adapt'] = {
+                'threshold': self.small_packet_size,
+                'target': self.size_target,
+                'predicted': round(self.size_predicted, 4) if self.size_predicted is not None else None
+            }
+        snapshot['connect_latency'] = {
+            'buckets': [
+                [counters.get(('connect_bucket', t, b), 0) for b in range(len(CONNECT_LATENCY_BUCKETS) + 1)]
+                for t in lines.targets
+            ],
+            'sum': [counters.get(('connect_sum', t), 0) for t in lines.targets],
+            'count': [counters.get(('connect_count', t), 0) for t in lines.targets]
+        }
+        snapshot['bond'] = {
+            'sessions': counters.get(('bond_sessions',), 0),
+            'links': [counters.get(('bond_links', t), 0) for t in lines.targets]
+        }
+        snapshot['race'] = {
+            'total': counters.get(('race_total',), 0),
+            'wins': [counters.get(('race_win', t), 0) for t in lines.targets],
+            'saved_sum': counters.get(('race_saved_sum',), 0),
+            'saved_count': counters.get(('race_saved_count',), 0)
+        }
+        snapshot['overload'] = {
+            proto: {reason: counters.get(('overload', proto, reason), 0) for reason in OVERLOAD_REASONS}
+            for proto in ('tcp', 'udp')
+        }
+        snapshot['admission'] = {
+            proto: {
+                'limit': gate.limit if gate else 0,
+                'active': gate.active if gate else 0,
+                'waiting': len(gate.waiting) if gate else 0,
+                'queued': gate.queued if gate else 0
+            }
+            for proto, gate in (('tcp', self.tcp_gate), ('udp', self.udp_gate))
+        }
+        snapshot['shaping'] = {
+            'throttle_seconds': {proto: [counters.get(('throttle', proto, t), 0) for t in lines.targets] for proto in ('tcp', 'udp')},
+            'dropped': {direction: [counters.get(('shape_drop', direction, t), 0) for t in lines.targets] for direction in ('up', 'down')}
+        }
+        snapshot['udp_sessions'] = len(self.client_sessions)
+        snapshot['udp_sessions_evicted'], snapshot['udp_sessions_expired'] = self.client_sessions.counts()
+        snapshot['log_dropped'] = self.log_queue_handler.dropped if self.log_queue_handler else 0
+        with self.flow_lock:
+            snapshot['active'] = {
+                proto: [counts[t] for t in self.targets] for proto, counts in self.active_flows.items()
+            }
+        with self.health_lock:
+            snapshot['health'] = [
+                {
+                    'rtt_ms': round(h.rtt * 1000, 2) if h.rtt is not None else None,
+                    'fail_rate': round(h.fail_rate, 4),
+                    'ejected': h.ejected_until > time.time()
+                }
+                for h in lines.health
+            ]
+        if lines.pools:
+            snapshot['upstream_pools'] = [
+                {
+                    'hits': pool.hits,
+                    'misses': pool.misses,
+                    'idle': len(pool.idle),
+                    'refills': pool.refills,
+                    'refill_seconds': pool.refill_seconds
+                }
+                for pool in lines.pools
+            ]
+        snapshot['buffer_pools'] = {
+            proto: {'hits': pool.hits, 'misses': pool.misses, 'free': len(pool.free)}
+            for proto, pool in self.buffer_pools.items()
+        }
+        return snapshot
+
+    def format_stats(self, snapshot, workers_alive=None):
+        """将统计快照格式化为统计报告"""
+        msg = f"\n{'='*60}\n"
+        msg += f"负载均衡统计 [模式:{self.mode}] - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        msg += f"{'='*60}\n"
+        
+        if workers_alive is not None:
+            msg += f"\n工作进程: {workers_alive}/{self.workers}\n"
+        
+        for proto in self.protocols:
+            total = snapshot[proto]['total']
+            if total > 0:
+                msg += f"\n{proto.upper()}协议:\n"
+                msg += f"  总连接/包数: {total}\n"
+                total_weight = sum(self.weights)
+                
+                for i in range(self.target_count):
+                    count = snapshot[proto]['targets'][i]
+                    percentage = (count / total * 100) if total > 0 else 0
+                    primary_mark = " [主线路]" if i == self.primary_index else ""
+                    active = snapshot['active'][proto][i]
+                    expected = f"，期望 {self.weights[i] / total_weight * 100:.1f}%" if self.mode != 'size' else ""
+                    traffic = f"上行 {format_bytes(snapshot[proto]['bytes_in'][i])} / 下行 {format_bytes(snapshot[proto]['bytes_out'][i])}"
+                    msg += f"  目标{i+1} {self.targets[i]}: {count} ({percentage:.1f}%{expected})，活跃 {active}，{traffic}{primary_mark}\n"
+                
+                if self.mode == 'size':
+                    msg += f"  小包: {snapshot[proto]['small_packets']}\n"
+                    msg += f"  大包: {snapshot[proto]['large_packets']}\n"
+        
+        if self.bond:
+            msg += f"\n多线路绑定: 会话 {snapshot['bond']['sessions']}\n"
+            if self.bond == 'client':
+                for i in range(self.target_count):
+                    traffic = f"上行 {format_bytes(snapshot['tcp']['bytes_in'][i])} / 下行 {format_bytes(snapshot['tcp']['bytes_out'][i])}"
+                    msg += (f"  目标{i+1} {self.targets[i]}: 子连接 {snapshot['bond']['links'][i]}，"
+                            f"活跃 {snapshot['active']['tcp'][i]}，{traffic}\n")
+        if self.mode == 'size' and sum(snapshot['packet_sizes']['buckets']):
+            adapt = snapshot['size_adapt']
+            buckets = snapshot['packet_sizes']['buckets']
+            quantiles = "，".join(f"p{int(q * 100)} <{format_bytes(histogram_quantile(buckets, q))}" for q in (0.5, 0.9, 0.99))
+            msg += f"\n首包大小: {quantiles}（未读到首包 {snapshot['packet_sizes']['timeouts']}）\n"
+            msg += f"小包阈值: {adapt['threshold']}B"
+            if adapt['target']:
+                predicted = f"{adapt['predicted'] * 100:.1f}%" if adapt['predicted'] is not None else "样本不足"
+                msg += f"（自适应，目标主线路占比 {adapt['target'] * 100:.0f}%，当前预计 {predicted}）"
+            msg += "\n"
+        
+        if 'udp' in self.protocols:
+            msg += f"\nUDP活跃会话: {snapshot['udp_sessions']}"
+            msg += f"（超时 {snapshot['udp_sessions_expired']}，超限淘汰 {snapshot['udp_sessions_evicted']}）\n"
+        if snapshot['log_dropped']:
+            msg += f"\n日志丢弃: {snapshot['log_dropped']}（日志队列已满）\n"
+        
+        if self.health_check:
+            msg += "\n线路健康:\n"
+            for i, h in enumerate(snapshot['health']):
+                rtt = f"{h['rtt_ms']:.1f}ms" if h['rtt_ms'] is not None else "-"
+                ejected_mark = " [已剔除]" if h['ejected'] else ""
+                msg += f"  目标{i+1} {self.targets[i]}: RTT {rtt}，失败率 {h['fail_rate']*100:.1f}%{ejected_mark}\n"
+        
+        if self.tcp_gate or self.udp_gate or self.max_flows_per_ip:
+            msg += f"\n准入控制 [策略:{self.overload}]:\n"
+            for proto in self.protocols:
+                admission, dropped = snapshot['admission'][proto], snapshot['overload'][proto]
+                limit = f"并发 {admission['active']}/{admission['limit']}，" if admission['limit'] else ""
+                queued = f"排队中 {admission['waiting']}（累计 {admission['queued']}），" if self.overload != 'reject' and admission['limit'] else ""
+                msg += (f"  {proto.upper()}: {limit}{queued}拒绝 {dropped['reject']}，排队超时 {dropped['timeout']}，"
+                        f"淘汰 {dropped['shed']}，单IP超限 {dropped['per_ip']}\n")
+        
+        if self.shapers:
+            shaping = snapshot['shaping']
+            msg += "\n线路限速（累计等待为各流等待时间之和）:\n"
+            for i in range(self.target_count):
+                shaper = self.line_shaper(i)
+                if not shaper:
+                    continue
+                throttle = shaping['throttle_seconds']
+                msg += f"  目标{i+1} {self.targets[i]}: {shaper.describe()}，累计等待 TCP {throttle['tcp'][i]:.1f}秒"
+                if 'udp' in self.protocols:
+                    msg += (f" / UDP {throttle['udp'][i]:.1f}秒，"
+                            f"UDP超速丢弃 上行 {shaping['dropped']['up'][i]} / 下行 {shaping['dropped']['down'][i]}")
+                msg += "\n"
+        
+        if self.race_delay:
+            race = snapshot['race']
+            saved_ms = race['saved_sum'] / race['saved_count'] * 1000 if race['saved_count'] else 0
+            msg += f"\n连接竞速: {race['total']} 次，首选线路落败时平均节省 {saved_ms:.1f}ms\n"
+            for i, wins in enumerate(race['wins']):
+                msg += f"  目标{i+1} {self.targets[i]}: 胜出 {wins}\n"
+        
+        if self.upstream_pools:
+            msg += "\n预连接池:\n"
+            for i, pool in enumerate(snapshot['upstream_pools']):
+                used = pool['hits'] + pool['misses']
+                hit_rate = pool['hits'] / used * 100 if used else 0
+                refill_ms = pool['refill_seconds'] / pool['refills'] * 1000 if pool['refills'] else 0
+                msg += (f"  目标{i+1} {self.targets[i]}: 命中率 {hit_rate:.1f}% ({pool['hits']}/{used})，"
+                        f"空闲 {pool['idle']}，平均建连 {refill_ms:.1f}ms\n")
+        
+        msg += "\n缓冲池:\n"
+        for proto in self.protocols:
+            pool = snapshot['buffer_pools'][proto]
+            msg += f"  {proto.upper()} ({self.buffer_pools[proto].buffer_size}B): 命中 {pool['hits']} / 未命中 {pool['misses']}，空闲 {pool['free']}\n"
+        
+        msg += f"{'='*60}\n"
+        return msg
+
+    def render_metrics(self, snapshot):
+        """将统计快照渲染为Prometheus文本格式"""
+        return format_metrics(self.metric_families(snapshot))
+
+    def metric_families(self, snapshot):
+        """把统计快照整理为指标族列表 [(名称, 类型, 说明, [(名称后缀, 标签, 值)])]"""
+        families = []
+        
+        def metric(name, metric_type, help_text, samples):
+            families.append((name, metric_type, help_text, [('', labels, value) for labels, value in samples]))
+        
+        def line_labels(i, **extra):
+            host, port = self.targets[i]
+            return dict(line=str(i + 1), target=f"{host}:{port}", **extra)
+        
+        indices = range(self.target_count)
+        metric('bs2_routed_total', 'counter', '分配到各线路的TCP连接数/UDP数据包数',
+               [(line_labels(i, protocol=p), snapshot[p]['targets'][i]) for p in self.protocols for i in indices])
+        metric('bs2_packets_by_size_total', 'counter', '按首包大小分类的连接/会话数',
+               [({'protocol': p, 'size': size}, snapshot[p][f'{size}_packets'])
+                for p in self.protocols for size in ('small', 'large')])
+        metric('bs2_bytes_total', 'counter', '各线路转发字节数（in=客户端到目标，out=目标到客户端）',
+               [(line_labels(i, protocol=p, direction=d), snapshot[p][f'bytes_{d}'][i])
+                for p in self.protocols for d in ('in', 'out') for i in indices])
+        if self.mode == 'size':
+            samples = []
+            cumulative = 0
+            # 内部按bisect_right分桶（第k格为[上一界, 界)），首包大小为整数，导出为Prometheus要求的含上界 le = 界-1
+            bounds = tuple(bound - 1 for bound in PACKET_SIZE_BUCKETS) + ('+Inf',)
+            for bound, count in zip(bounds, snapshot['packet_sizes']['buckets']):
+                cumulative += count
+                samples.append(('_bucket', {'le': str(bound)}, cumulative))
+            samples.append(('_count', {}, cumulative))
+            families.append(('bs2_first_packet_bytes', 'histogram', 'size模式下新连接/新会话的首包大小（字节）', samples))
+            metric('bs2_size_threshold_bytes', 'gauge', 'size模式当前的小包阈值', [({}, snapshot['size_adapt']['threshold'])])
+        metric('bs2_active_flows', 'gauge', '各线路当前活跃的TCP连接/UDP会话数',
+               [(line_labels(i, protocol=p), snapshot['active'][p][i]) for p in self.protocols for i in indices])
+        if self.bond:
+            metric('bs2_bond_sessions_total', 'counter', '多线路绑定会话数（每条客户端连接计一次）',
+                   [({}, snapshot['bond']['sessions'])])
+        if self.bond == 'client':
+            metric('bs2_bond_links_total', 'counter', '多线路绑定在各线路上建立的子连接数',
+                   [(line_labels(i), snapshot['bond']['links'][i]) for i in indices])
+        if 'udp' in self.protocols:
+            metric('bs2_udp_sessions', 'gauge', 'UDP活跃会话数', [({}, snapshot['udp_sessions'])])
+            metric('bs2_udp_sessions_closed_total', 'counter', '已关闭的UDP会话数（expired=空闲超时，evicted=超出上限被淘汰）',
+                   [({'reason': 'expired'}, snapshot['udp_sessions_expired']),
+                    ({'reason': 'evicted'}, snapshot['udp_sessions_evicted'])])
+        
+        latency = snapshot['connect_latency']
+        samples = []
+        for i in indices:
+            cumulative = 0
+            for bound, count in zip(CONNECT_LATENCY_BUCKETS + ('+Inf',), latency['buckets'][i]):
+                cumulative += count
+                samples.append(('_bucket', line_labels(i, le=str(bound)), cumulative))
+            samples.append(('_sum', line_labels(i), latency['sum'][i]))
+            samples.append(('_count', line_labels(i), latency['count'][i]))
+        families.append(('bs2_connect_latency_seconds', 'histogram', '连接目标线路的握手耗时', samples))
+        
+        if self.health_check:
+            metric('bs2_line_up', 'gauge', '线路是否可用（0=已被健康检查剔除）',
+                   [(line_labels(i), 0 if snapshot['health'][i]['ejected'] else 1) for i in indices])
+        if self.tcp_gate or self.udp_gate or self.max_flows_per_ip:
+            metric('bs2_overload_dropped_total', 'counter',
+                   '准入控制拒绝的连接/数据包（reject=超出上限，timeout=排队超时，shed=排队时被淘汰，per_ip=单IP超限）',
+                   [({'protocol': p, 'reason': r}, snapshot['overload'][p][r]) for p in self.protocols for r in OVERLOAD_REASONS])
+            metric('bs2_admission_active', 'gauge', '已获准入、正在处理的TCP连接/UDP数据包数',
+                   [({'protocol': p}, snapshot['admission'][p]['active']) for p in self.protocols])
+            metric('bs2_admission_waiting', 'gauge', '排队等待准入的TCP连接/UDP数据包数',
+                   [({'protocol': p}, snapshot['admission'][p]['waiting']) for p in self.protocols])
+        if self.shapers:
+            shaped = [i for i in indices if self.line_shaper(i)]
+            metric('bs2_throttle_seconds_total', 'counter', '线路限速时各流等待令牌的累计时间',
+                   [(line_labels(i, protocol=p), snapshot['shaping']['throttle_seconds'][p][i])
+                    for p in self.protocols for i in shaped])
+            if 'udp' in self.protocols:
+                metric('bs2_shaped_dropped_total', 'counter', '超出线路限速被丢弃的UDP数据包（up=客户端到目标，down=目标到客户端）',
+                       [(line_labels(i, direction=d), snapshot['shaping']['dropped'][d][i])
+                        for d in ('up', 'down') for i in shaped])
+        if self.race_delay:
+            race = snapshot['race']
+            metric('bs2_race_total', 'counter', '发起了多条线路连接的竞速次数', [({}, race['total'])])
+            metric('bs2_race_wins_total', 'counter', '各线路在竞速中胜出的次数',
+                   [(line_labels(i), race['wins'][i]) for i in indices])
+            metric('bs2_race_saved_seconds', 'summary', '首选线路落败时竞速节省的握手时间',
+                   [({'quantity': 'sum'}, race['saved_sum']), ({'quantity': 'count'}, race['saved_count'])])
+        if self.upstream_pools:
+            metric('bs2_upstream_pool_hits_total', 'counter', '预连接池命中次数',
+                   [(line_labels(i), snapshot['upstream_pools'][i]['hits']) for i in indices])
+            metric('bs2_upstream_pool_misses_total', 'counter', '预连接池未命中次数',
+                   [(line_labels(i), snapshot['upstream_pools'][i]['misses']) for i in indices])
+        metric('bs2_log_dropped_total', 'counter', '日志队列已满而丢弃的日志条数',
+               [({}, snapshot['log_dropped'])])
+        metric('bs2_buffer_pool_hits_total', 'counter', '缓冲池命中次数',
+               [({'protocol': p}, snapshot['buffer_pools'][p]['hits']) for p in self.protocols])
+        metric('bs2_buffer_pool_misses_total', 'counter', '缓冲池未命中次数',
+               [({'protocol': p}, snapshot['buffer_pools'][p]['misses']) for p in self.protocols])
+        return families
+
+    def start_metrics_server(self, snapshot_func, render=None):
+        """启动Prometheus指标HTTP服务，GET /metrics 返回snapshot_func()经render（默认render_metrics）渲染的结果"""
+        render = render or self.render_metrics
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                snapshot = snapshot_func()
+                if snapshot is None:
+                    self.send_error(503, 'stats not ready')
+                    return
+                body = render(snapshot).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        try:
+            server = ThreadingHTTPServer((self.metrics_host, self.metrics_port), MetricsHandler)
+        except OSError as e:
+            self.log(f"[指标] 无法启动指标服务: {e}", 'error')
+            return
+        server.daemon_threads = True
+        self.metrics_server = server
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.log(f"[指标] Prometheus指标: http://{self.metrics_host}:{self.metrics_port}/metrics")
 
     def print_stats(self):
         """打印统计"""
         while self.running:
             time.sleep(60)  # 每分钟统计一次
-            with self.stats_lock:
-                msg = f"\n{'='*60}\n"
-                msg += f"负载均衡统计 [模式:{self.mode}] - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                msg += f"{'='*60}\n"
-                
-                for proto in self.protocols:
-                    total = self.stats[proto]['total']
-                    if total > 0:
-                        msg += f"\n{proto.upper()}协议:\n"
-                        msg += f"  总连接/包数: {total}\n"
-                        
-                        for i in range(self.target_count):
-                            count = self.stats[proto]['targets'][i]
-                            percentage = (count / total * 100) if total > 0 else 0
-                            primary_mark = " [主线路]" if i == self.primary_index else ""
-                            msg += f"  目标{i+1} {self.targets[i]}: {count} ({percentage:.1f}%){primary_mark}\n"
-                        
-                        if self.mode == 'size':
-                            msg += f"  小包: {self.stats[proto]['small_packets']}\n"
-                            msg += f"  大包: {self.stats[proto]['large_packets']}\n"
-                
-                if 'udp' in self.protocols:
-                    msg += f"\nUDP活跃会话: {len(self.client_sessions)}\n"
-                
-                msg += f"{'='*60}\n"
-                self.log(msg)
+            self.log(self.format_stats(self.snapshot_stats()))
+
+    def track_rates(self, snapshot_func):
+        """每秒记录一次snapshot_func()的累计计数，供控制命令stats计算速率"""
+        while self.running:
+            snapshot = snapshot_func()
+            if snapshot is not None:
+                self.rates.record(rate_totals(snapshot), self.targets)
+            time.sleep(1)
+
+    def status_report(self):
+        """控制命令stats的回复：运行信息、统计快照及各线路最近1/10/60秒的速率"""
+        if self.workers > 1 and self.worker_id is None:
+            snapshot = self.merged_snapshot
+        else:
+            snapshot = self.snapshot_stats()
+        if snapshot is None:
+            return {'ok': False, 'error': '统计尚未就绪'}
+        return {
+            'ok': True,
+            'version': __version__,
+            'pid': os.getpid(),
+            'listen': f"{self.listen_host}:{self.listen_port}",
+            'mode': self.mode,
+            'engine': self.engine,
+            'protocols': self.protocols,
+            'workers': self.workers,
+            'uptime': round(time.time() - self.started_at, 1),
+            'draining': self.draining,
+            'targets': [f"{host}:{port}" for host, port in self.targets],
+            'weights': self.weights,
+            'primary': self.primary_index + 1,
+            'rates': self.rates.rates(),
+            'stats': snapshot
+        }
+
+    def create_listener(self, sock_type):
+        """创建并绑定监听socket（多进程模式下开启SO_REUSEPORT），已从旧进程接管的直接复用"""
+        inherited = self.inherited_listeners.get('tcp' if sock_type == socket.SOCK_STREAM else 'udp')
+        if inherited is not None:
+            return inherited
+        sock = socket.socket(socket.AF_INET, sock_type)
+        try:
+            if sock_type == socket.SOCK_STREAM:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # 接收缓冲区须在listen前设置才能协商窗口扩大；接受的连接继承监听socket的选项
+            if self.listen_profile:
+                for key, error in self.listen_profile.apply(sock, listener=True):
+                    self.log(f"[socket选项] 监听socket无法设置 {key}: {error}", 'warning')
+            sock.bind((self.listen_host, self.listen_port))
+            if sock_type == socket.SOCK_STREAM:
+                sock.listen(self.backlog)
+        except:
+            sock.close()
+            raise
+        if self.listen_profile and {'sndbuf', 'rcvbuf'} & set(self.listen_profile.options):
+            # 内核会调整缓冲区大小（Linux为设置值的2倍并受net.core.*mem_max限制），记录实际值
+            sndbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+            rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            proto = 'TCP' if sock_type == socket.SOCK_STREAM else 'UDP'
+            self.log(f"[socket选项] {proto}监听socket实际缓冲区: sndbuf={format_bytes(sndbuf)}, rcvbuf={format_bytes(rcvbuf)}")
+        return sock
 
     def start_tcp_server(self):
         """启动TCP服务"""
         try:
-            self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.tcp_server.bind((self.listen_host, self.listen_port))
-            self.tcp_server.listen(100)
+            self.tcp_server = self.create_listener(socket.SOCK_STREAM)
             self.log(f"[TCP] 监听在 {self.listen_host}:{self.listen_port}")
             
-            while self.running:
+            while self.running and not self.draining:
                 try:
                     self.tcp_server.settimeout(1.0)
-                    client_socket, client_address = self.tcp_server.accept()
-                    threading.Thread(
-                        target=self.handle_tcp_client,
-                        args=(client_socket, client_address),
-                        daemon=True
-                    ).start()
+                    self.accept_tcp_client()
                 except socket.timeout:
                     continue
                 except Exception as e:
@@ -370,25 +3238,51 @@ class MultiLineLoadBalancer:
             if self.tcp_server:
                 self.tcp_server.close()
 
+    def accept_tcp_client(self):
+        """接受一个TCP连接并交给处理线程（经准入控制）"""
+        client_socket, client_address = self.tcp_server.accept()
+        if self.bond:
+            # 绑定模式的连接由会话内的收发线程转发，处理函数很快返回，不计入准入上限
+            handler = self.handle_bond_client if self.bond == 'client' else self.handle_bond_subflow
+            threading.Thread(target=handler, args=(client_socket, client_address), daemon=True).start()
+            return
+        if not self.client_flow_started(client_address):
+            self.drop_tcp_client((client_socket, client_address), 'per_ip')
+            return
+        self.spawn_admitted(self.tcp_gate, self.run_tcp_client, (client_socket, client_address))
+
+    def run_tcp_client(self, client_socket, client_address):
+        """处理一条TCP连接，结束后归还单IP名额"""
+        try:
+            self.handle_tcp_client(client_socket, client_address)
+        finally:
+            self.client_flow_finished(client_address)
+
+    def receive_udp_packet(self):
+        """接收一个UDP数据包并交给处理线程"""
+        pool = self.buffer_pools['udp']
+        buf = pool.acquire()
+        try:
+            n, client_address = self.udp_server.recvfrom_into(buf)
+        except:
+            pool.release(buf)
+            raise
+        self.spawn_admitted(self.udp_gate, self.handle_udp_packet, (memoryview(buf)[:n], client_address, buf))
+
     def start_udp_server(self):
         """启动UDP服务"""
         try:
-            self.udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.udp_server.bind((self.listen_host, self.listen_port))
+            self.udp_server = self.create_listener(socket.SOCK_DGRAM)
             self.log(f"[UDP] 监听在 {self.listen_host}:{self.listen_port}")
             
-            # 启动会话清理线程
+            # 启动会话清理线程和回包分发线程
             threading.Thread(target=self.clean_udp_sessions, daemon=True).start()
+            threading.Thread(target=self.dispatch_udp_replies, daemon=True).start()
             
-            while self.running:
+            while self.running and not self.draining:
                 try:
                     self.udp_server.settimeout(1.0)
-                    data, client_address = self.udp_server.recvfrom(65535)
-                    threading.Thread(
-                        target=self.handle_udp_packet,
-                        args=(data, client_address),
-                        daemon=True
-                    ).start()
+                    self.receive_udp_packet()
                 except socket.timeout:
                     continue
                 except Exception as e:
@@ -398,8 +3292,11 @@ class MultiLineLoadBalancer:
         except Exception as e:
             self.log(f"[UDP启动错误] {e}", 'error')
         finally:
-            if self.udp_server:
+            # 交接后仍需经该socket把在途会话的回包发给客户端，进程退出时再关闭
+            if self.udp_server and not self.draining:
                 self.udp_server.close()
+            for session in self.client_sessions.clear():
+                self.close_udp_session(session)
 
     def write_pid_file(self):
         """写入PID文件"""
@@ -411,9 +3308,9 @@ class MultiLineLoadBalancer:
             self.log(f"无法写入PID文件: {e}", 'error')
 
     def remove_pid_file(self):
-        """删除PID文件"""
+        """删除PID文件（平滑升级后PID文件已属于新进程，不删除）"""
         try:
-            if os.path.exists(self.pid_file):
+            if read_pid(self.pid_file) == os.getpid():
                 os.remove(self.pid_file)
         except:
             pass
@@ -443,6 +3340,10 @@ class MultiLineLoadBalancer:
             self.log(f"第二次fork失败: {e}", 'error')
             sys.exit(1)
         
+        # 日志写出线程未随fork保留，重新建立
+        if self.log_listener:
+            self.start_log_listener()
+        
         # 重定向标准文件描述符
         sys.stdout.flush()
         sys.stderr.flush()
@@ -459,20 +3360,225 @@ class MultiLineLoadBalancer:
         self.log(f"收到信号 {signum}，正在关闭...")
         self.running = False
 
+    def reload_handler(self, signum, frame):
+        """SIGHUP：重新加载线路配置（在后台线程中执行）"""
+        self.log(f"收到信号 {signum}，重新加载配置...")
+        threading.Thread(target=self.reload_config, daemon=True).start()
+
+    def drain_handler(self, signum, frame):
+        """SIGUSR2（交接后由主进程发给工作进程）：停止接受新连接，在途连接结束后退出"""
+        self.start_draining()
+
+    # ========== 控制socket与平滑升级 ==========
+    def start_control_server(self):
+        """启动控制socket，每条连接读取一行命令并回复一行JSON"""
+        if os.path.exists(self.control_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.control_path)
+                self.log(f"[控制] {self.control_path} 已被运行中的实例占用，未启动控制socket", 'warning')
+                return
+            except OSError:
+                os.remove(self.control_path)  # 上次异常退出遗留的文件
+            finally:
+                probe.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.control_path)
+            os.chmod(self.control_path, 0o600)
+            server.listen(16)
+        except OSError as e:
+            server.close()
+            self.log(f"[控制] 无法启动控制socket: {e}", 'error')
+            return
+        self.control_server = server
+        threading.Thread(target=self.serve_control, args=(server,), daemon=True).start()
+
+    def stop_control_server(self):
+        """关闭控制socket并删除其路径"""
+        server, self.control_server = self.control_server, None
+        if server:
+            server.close()
+            try:
+                os.remove(self.control_path)
+            except OSError:
+                pass
+
+    def serve_control(self, server):
+        """接受控制连接"""
+        server.settimeout(1.0)
+        while self.running and self.control_server is server:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self.handle_control, args=(conn,), daemon=True).start()
+
+    def handle_control(self, conn):
+        """处理一条控制命令：reload=重载配置，handoff=交出监听socket，stop=停止本监听，stats=实时统计"""
+        try:
+            conn.settimeout(CONTROL_TIMEOUT)
+            command = recv_line(conn)
+            if command == 'handoff':
+                self.hand_off_listeners(conn)
+                return
+            if command == 'reload':
+                error = self.reload_config()
+                reply = {'ok': error is None}
+                if error:
+                    reply['error'] = error
+                else:
+                    reply['targets'] = [f"{host}:{port}@{weight}" for (host, port), weight in zip(self.targets, self.weights)]
+                    reply['primary'] = self.primary_index + 1
+            elif command == 'stats':
+                reply = self.status_report()
+            elif command == 'stop':
+                self.log("收到停止命令，正在关闭...")
+                self.running = False
+                reply = {'ok': True}
+            else:
+                reply = {'ok': False, 'error': f'未知命令: {command}'}
+            conn.sendall((json.dumps(reply, ensure_ascii=False) + '\n').encode())
+        except (OSError, EOFError, ValueError) as e:
+            self.log(f"[控制] 命令处理失败: {e}", 'warning')
+        finally:
+            conn.close()
+
+    def hand_off_listeners(self, conn):
+        """平滑升级（旧进程）：把监听socket传给新进程，新进程就绪后停止接受新连接并等待在途连接结束"""
+        listeners = [(proto, sock) for proto, sock in (('tcp', self.tcp_server), ('udp', self.udp_server)) if sock]
+        # 多进程模式下各工作进程各自绑定，无法传递，由新进程以SO_REUSEPORT并行绑定
+        header = {'listeners': [proto for proto, _ in listeners], 'reuse_port': self.workers > 1}
+        send_fds(conn, (json.dumps(header) + '\n').encode(), [sock.fileno() for _, sock in listeners])
+        try:
+            ready = recv_line(conn)
+        except (OSError, EOFError, ValueError):
+            ready = None
+        if ready != 'ready':
+            self.log("[交接] 新进程未就绪，继续正常服务", 'warning')
+            return
+        # 让出控制socket路径和指标端口，由新进程接管
+        self.stop_control_server()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        self.start_draining()
+        conn.sendall(b'ok\n')
+
+    def start_draining(self):
+        """停止接受新连接，在途连接结束或超过drain_timeout后退出"""
+        self.draining = True
+        self.log(f"[交接] 已停止接受新连接，等待在途连接结束（最长{self.drain_timeout}秒）")
+        if self.workers > 1 and self.worker_id is None:
+            for worker in list(self.worker_procs.values()):
+                try:
+                    os.kill(worker['pid'], signal.SIGUSR2)
+                except OSError:
+                    pass
+
+    def drain(self):
+        """等待在途TCP连接/UDP会话结束（最长drain_timeout秒）"""
+        deadline = time.time() + self.drain_timeout
+        while self.running:
+            with self.flow_lock:
+                remaining = sum(sum(counts.values()) for counts in self.active_flows.values())
+            if not remaining:
+                self.log("[交接] 在途连接已全部结束")
+                break
+            if time.time() >= deadline:
+                self.log(f"[交接] 等待超时，关闭剩余 {remaining} 条连接/会话", 'warning')
+                break
+            time.sleep(0.5)
+        self.running = False
+
+    def take_over_listeners(self):
+        """平滑升级（新进程）：从旧进程接管监听socket，完成后旧进程停止接受新连接"""
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(CONTROL_TIMEOUT)
+        try:
+            try:
+                conn.connect(self.control_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.log("[升级] 未找到运行中的旧进程，按正常方式启动", 'warning')
+                return
+            conn.sendall(b'handoff\n')
+            data, fds = recv_fds(conn, 4096, 2)
+            header = json.loads(data)
+            for proto, fd in zip(header['listeners'], fds):
+                sock = socket.socket(fileno=fd)
+                if proto in self.protocols:
+                    self.inherited_listeners[proto] = sock
+                else:
+                    sock.close()
+            # 旧进程为多进程模式（或未提供某协议的监听）：自行绑定，与旧进程的SO_REUSEPORT监听并存
+            if header['reuse_port']:
+                self.reuse_port = True
+            for proto in self.protocols:
+                if proto not in self.inherited_listeners:
+                    sock_type = socket.SOCK_STREAM if proto == 'tcp' else socket.SOCK_DGRAM
+                    self.inherited_listeners[proto] = self.create_listener(sock_type)
+            conn.sendall(b'ready\n')
+            try:
+                confirmed = recv_line(conn) == 'ok'
+            except (OSError, EOFError, ValueError):
+                confirmed = False
+            if not confirmed:
+                self.log("[升级] 旧进程未确认交接，请检查其是否仍在运行", 'warning')
+        finally:
+            conn.close()
+        self.log(f"[升级] 已接管监听socket: {', '.join(p.upper() for p in header['listeners']) or '无（SO_REUSEPORT并行绑定）'}")
+
     def start(self):
         """启动负载均衡器"""
         # 后台化
         if self.daemon:
             self.daemonize()
         
+        # 平滑升级：先从旧进程接管监听socket
+        if self.upgrade:
+            self.take_over_listeners()
+        
         # 写入PID文件
         self.write_pid_file()
+        self.start_control_server()
         
         # 注册信号处理
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGHUP, self.reload_handler)
+        
+        self.log(self.startup_banner())
         
-        mode_desc = "自动轮询分流" if self.mode == 'auto' else f"按包大小分流(阈值:{self.small_packet_size}B)"
+        if self.relay == 'splice' and not self.use_splice:
+            self.log("当前系统不支持splice，已回退为用户态拷贝转发", 'warning')
+        
+        try:
+            if self.workers > 1:
+                self.run_supervisor()
+            else:
+                # 启动统计线程
+                threading.Thread(target=self.print_stats, daemon=True).start()
+                threading.Thread(target=self.track_rates, args=(self.snapshot_stats,), daemon=True).start()
+                if self.metrics_port:
+                    self.start_metrics_server(self.snapshot_stats)
+                self.serve()
+        except KeyboardInterrupt:
+            self.log("收到中断信号，正在关闭...")
+            self.running = False
+            time.sleep(1)
+        finally:
+            self.stop_control_server()
+            self.remove_pid_file()
+            self.log("负载均衡器已关闭")
+            self.stop_log_listener()
+
+    def startup_banner(self):
+        """启动信息"""
+        adapt_desc = "，自适应" if self.size_target else ""
+        mode_desc = f"按包大小分流(阈值:{self.small_packet_size}B{adapt_desc})" if self.mode == 'size' else self.strategy.description
         protocols_desc = " + ".join([p.upper() for p in self.protocols])
         
         msg = f"\n{'='*60}\n"
@@ -485,24 +3591,94 @@ class MultiLineLoadBalancer:
         msg += f"[主线路] 目标{self.primary_index + 1}\n"
         for i, target in enumerate(self.targets):
             primary_mark = " [主线路-单线程默认]" if i == self.primary_index else ""
-            msg += f"[目标{i+1}] {target}{primary_mark}\n"
-        if self.mode == 'size':
-            msg += f"[规则] 包 < {self.small_packet_size}B -> 主线路(目标{self.primary_index + 1})\n"
-            msg += f"[规则] 包 >= {self.small_packet_size}B -> 轮询所有线路\n"
-        else:
-            msg += f"[规则] 所有连接自动轮询分配（从主线路开始）\n"
+            weight_mark = f" 权重{self.weights[i]}" if self.weighted else ""
+            msg += f"[目标{i+1}] {target}{weight_mark}{primary_mark}\n"
+        for rule in self.strategy.rules():
+            msg += f"[规则] {rule}\n"
+        if self.bond == 'client':
+            msg += f"[绑定] 客户端：每条TCP连接按{self.bond_chunk}B切块分散到所有线路（按实测速率调度）\n"
+        elif self.bond == 'server':
+            msg += f"[绑定] 服务端：重组各线路子连接后转发到 {self.targets[0]}\n"
+        msg += f"[引擎] {self.engine}\n"
+        msg += f"[转发] {'splice零拷贝' if self.use_splice else '用户态拷贝'}\n"
+        if self.health_check:
+            msg += f"[健康检查] 每{self.health_check}秒，连续失败{self.eject_failures}次剔除{self.eject_time}秒\n"
+        msg += f"[连接超时] {self.connect_timeout}秒（失败自动切换线路）\n"
+        if 'udp' in self.protocols:
+            port_desc = "".join(
+                f"，端口{first if first == last else f'{first}-{last}'} {seconds:g}秒"
+                for first, last, seconds in self.udp_port_timeouts)
+            msg += f"[UDP会话] 空闲超时 {self.udp_timeout:g}秒{port_desc}（按目标端口，上下行任一方向有数据即刷新）\n"
+        if self.race_delay:
+            msg += f"[连接竞速] 选中线路{self.race_delay * 1000:.0f}ms内未完成握手时并行连接下一条线路\n"
+        if self.tcp_gate or self.udp_gate or self.max_flows_per_ip:
+            limits = []
+            if self.tcp_gate:
+                limits.append(f"TCP并发≤{self.tcp_gate.limit}")
+            if self.udp_gate:
+                limits.append(f"UDP处理≤{self.udp_gate.limit}")
+            if self.max_flows_per_ip:
+                limits.append(f"单IP≤{self.max_flows_per_ip}")
+            policy_desc = {
+                'reject': '立即拒绝',
+                'queue': f'排队最长{self.queue_timeout}秒',
+                'shed': f'排队最长{self.queue_timeout}秒，队列满时淘汰最早的'
+            }[self.overload]
+            msg += f"[准入控制] {' / '.join(limits)}，超出时{policy_desc}，backlog {self.backlog}\n"
+        for i in range(self.target_count):
+            shaper = self.line_shaper(i)
+            if shaper:
+                msg += f"[目标{i+1} 限速] {shaper.describe()}\n"
+        if self.shapers:
+            udp_desc = f"排队最长{self.shape_max_delay * 1000:.0f}ms，超出丢弃" if self.shape_policy == 'queue' else "直接丢弃"
+            share_desc = f"，{self.workers}个工作进程各分得1/{self.workers}" if self.workers > 1 else ""
+            msg += f"[限速策略] TCP按令牌桶匀速发送，UDP超速时{udp_desc}{share_desc}\n"
+        if self.listen_profile:
+            msg += f"[监听socket] {self.listen_profile.describe()}\n"
+        for i in range(self.target_count):
+            profile = self.line_profile(i)
+            if profile:
+                msg += f"[目标{i+1} socket] {profile.describe()}\n"
+        if self.upstream_pools:
+            pool = self.upstream_pools[0]
+            msg += f"[预连接池] 每线路 {pool.min_size}-{pool.max_size} 条，空闲TTL {pool.idle_ttl}秒\n"
+        if self.workers > 1:
+            msg += f"[工作进程] {self.workers} (SO_REUSEPORT)\n"
+        if self.control_server:
+            reload_desc = "reload（或SIGHUP）重新加载配置文件中的线路 / " if self.config_loader else ""
+            msg += f"[控制] {self.control_path}：stats 实时统计 / {reload_desc}handoff 平滑升级 / stop 停止\n"
         msg += f"[后台] {'是' if self.daemon else '否'}\n"
         msg += f"{'='*60}\n"
-        self.log(msg)
+        return msg
+
+    def start_line_tasks(self):
+        """启动健康检查、预连接池补充、排队过期及自适应阈值线程"""
+        if self.health_check:
+            threading.Thread(target=self.probe_targets, daemon=True).start()
+        
+        if self.upstream_pools:
+            for pool in self.upstream_pools:
+                threading.Thread(target=self.refill_upstream_pool, args=(pool,), daemon=True).start()
         
-        # 启动统计线程
-        threading.Thread(target=self.print_stats, daemon=True).start()
+        if self.overload != 'reject' and (self.tcp_gate or self.udp_gate):
+            threading.Thread(target=self.expire_admission_queues, daemon=True).start()
+        
+        if self.size_target:
+            threading.Thread(target=self.adapt_size_threshold, daemon=True).start()
+
+    def serve(self):
+        """启动服务器线程并等待其结束"""
+        self.start_line_tasks()
         
-        # 启动服务器线程
         server_threads = []
         
         if 'tcp' in self.protocols:
-            tcp_thread = threading.Thread(target=self.start_tcp_server)
+            if self.engine == 'asyncio':
+                # 每个连接占用2个文件描述符，尽量放宽上限以承载上万并发
+                raise_nofile_limit(self.log)
+                tcp_thread = threading.Thread(target=self.run_asyncio_engine)
+            else:
+                tcp_thread = threading.Thread(target=self.start_tcp_server)
             tcp_thread.daemon = True
             tcp_thread.start()
             server_threads.append(tcp_thread)
@@ -513,20 +3689,657 @@ class MultiLineLoadBalancer:
             udp_thread.start()
             server_threads.append(udp_thread)
         
+        # 等待所有服务器线程；交接监听socket后服务线程不再接受新连接，等待在途连接结束
+        for thread in server_threads:
+            while thread.is_alive() and not self.draining:
+                thread.join(1.0)
+        if self.draining:
+            self.drain()
+        for thread in server_threads:
+            thread.join()
+
+    # ========== 多进程模式 ==========
+    def spawn_worker(self, worker_id):
+        """fork一个工作进程，返回(pid, 统计上报通道)"""
+        parent_channel, child_channel = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_channel.close()
+            code = 0
+            try:
+                self.run_worker(worker_id, child_channel)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        child_channel.close()
+        parent_channel.setblocking(False)
+        return pid, parent_channel
+
+    def run_worker(self, worker_id, channel):
+        """工作进程：以SO_REUSEPORT绑定同一端口，定期向主进程上报统计"""
+        self.worker_id = worker_id
+        self.reuse_port = True
+        self.running = True
+        signal.signal(signal.SIGUSR2, self.drain_handler)
+        # epoll实例会随fork共享，工作进程必须使用自己的选择器
+        self.udp_selector = selectors.DefaultSelector()
+        
+        send_lock = threading.Lock()
+        
+        def send(message):
+            data = (json.dumps(message) + '\n').encode()
+            with send_lock:
+                channel.sendall(data)
+        
+        # 多个进程各自轮转同一日志文件会丢失或打乱日志，工作进程的日志交给主进程写出
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        if self.log_listener:
+            self.log_handler = ChannelLogHandler(send)
+            self.start_log_listener()
+        else:
+            root.addHandler(ChannelLogHandler(send))
+        
+        def report():
+            while self.running:
+                time.sleep(WORKER_REPORT_INTERVAL)
+                try:
+                    send({'stats': self.snapshot_stats()})
+                except OSError:
+                    break
+        
+        threading.Thread(target=report, daemon=True).start()
+        self.log(f"工作进程 W{worker_id} 已启动 (PID: {os.getpid()})")
+        try:
+            self.serve()
+        finally:
+            try:
+                send({'stats': self.snapshot_stats()})
+            except OSError:
+                pass
+            channel.close()
+            self.stop_log_listener()
+
+    def run_supervisor(self):
+        """主进程：管理工作进程、自动重启并汇总统计"""
+        selector = selectors.DefaultSelector()
+        workers = self.worker_procs  # worker_id -> {'pid', 'channel', 'buffer', 'snapshot'}
+        retired = []  # 已退出工作进程的最终统计
+        restart_at = {}
+        restart_delay = {}  # worker_id -> 下次重启前等待的秒数
+        
+        def start_worker(worker_id):
+            pid, channel = self.spawn_worker(worker_id)
+            workers[worker_id] = {'pid': pid, 'channel': channel, 'buffer': b'', 'snapshot': None,
+                                  'started': time.time()}
+            selector.register(channel, selectors.EVENT_READ, worker_id)
+        
+        def read_channel(worker_id):
+            worker = workers[worker_id]
+            try:
+                data = worker['channel'].recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b''
+            if not data:
+                selector.unregister(worker['channel'])
+                worker['channel'].close()
+                worker['channel'] = None
+                return
+            worker['buffer'] += data
+            *lines, worker['buffer'] = worker['buffer'].split(b'\n')
+            for line in lines:
+                message = json.loads(line)
+                if 'log' in message:
+                    level, text, created = message['log']
+                    self.logger.handle(logging.makeLogRecord({
+                        'name': self.logger.name, 'levelno': level, 'levelname': logging.getLevelName(level),
+                        'msg': f"[W{worker_id}] {text}", 'created': created
+                    }))
+                else:
+                    worker['snapshot'] = message['stats']
+        
+        def merge_workers():
+            # 重载配置改变了线路数时，只合并已按新线路数上报的快照
+            matches = lambda snapshot: len(snapshot['health']) == self.target_count
+            live = [w['snapshot'] for w in workers.values() if w['snapshot'] and matches(w['snapshot'])]
+            done = [snapshot for snapshot in retired if matches(snapshot)]
+            if not live and not done:
+                return None
+            merged = merge_stats(done + live)
+            # 会话数、活跃流与空闲缓冲只统计存活的工作进程
+            merged['udp_sessions'] = sum(snapshot['udp_sessions'] for snapshot in live)
+            for proto in merged['active']:
+                merged['active'][proto] = [
+                    sum(snapshot['active'][proto][i] for snapshot in live) for i in range(self.target_count)
+                ]
+            for proto, pool in merged['buffer_pools'].items():
+                pool['free'] = sum(snapshot['buffer_pools'][proto]['free'] for snapshot in live)
+            for proto, admission in merged['admission'].items():
+                for key in ('limit', 'active', 'waiting'):
+                    admission[key] = sum(snapshot['admission'][proto][key] for snapshot in live)
+            return merged
+        
+        for worker_id in range(1, self.workers + 1):
+            start_worker(worker_id)
+        self.log(f"[多进程] 已启动 {self.workers} 个工作进程 (SO_REUSEPORT)")
+        
+        if self.metrics_port:
+            self.start_metrics_server(lambda: self.merged_snapshot)
+        threading.Thread(target=self.track_rates, args=(lambda: self.merged_snapshot,), daemon=True).start()
+        
+        last_report = time.time()
+        while self.running:
+            events = selector.select(timeout=1.0)
+            for key, _ in events:
+                read_channel(key.data)
+            
+            # 回收退出的工作进程
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if pid == 0:
+                    break
+                for worker_id, worker in list(workers.items()):
+                    if worker['pid'] != pid:
+                        continue
+                    if worker['channel'] is not None:
+                        read_channel(worker_id)
+                        if worker['channel'] is not None:
+                            selector.unregister(worker['channel'])
+                            worker['channel'].close()
+                    if worker['snapshot']:
+                        retired.append(worker['snapshot'])
+                    del workers[worker_id]
+                    if self.running and not self.draining:
+                        if time.time() - worker['started'] >= WORKER_STABLE_UPTIME:
+                            restart_delay[worker_id] = 1
+                        delay = restart_delay.get(worker_id, 1)
+                        # 反复启动即退出时逐次加倍重启间隔，避免每秒重启
+                        restart_delay[worker_id] = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+                        self.log(f"[多进程] 工作进程 W{worker_id} (PID: {pid}) 退出，状态 {status}，{delay}秒后重启", 'warning')
+                        restart_at[worker_id] = time.time() + delay
+            
+            # 重启已退出的工作进程
+            for worker_id, when in list(restart_at.items()):
+                if self.running and not self.draining and time.time() >= when:
+                    del restart_at[worker_id]
+                    start_worker(worker_id)
+            
+            # 已交接监听socket：工作进程全部结束后退出
+            if self.draining and not workers:
+                break
+            
+            self.merged_snapshot = merge_workers()
+            
+            if time.time() - last_report >= 60:
+                last_report = time.time()
+                merged = merge_workers()
+                if merged:
+                    self.log(self.format_stats(merged, workers_alive=len(workers)))
+        
+        # 停止所有工作进程
+        for worker in workers.values():
+            try:
+                os.kill(worker['pid'], signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + 5
+        while workers and time.time() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.1)
+                continue
+            for worker_id, worker in list(workers.items()):
+                if worker['pid'] == pid:
+                    del workers[worker_id]
+        for worker in workers.values():
+            try:
+                os.kill(worker['pid'], signal.SIGKILL)
+            except OSError:
+                pass
+        selector.close()
+
+
+class ListenerGroup:
+    """单进程承载多个监听：共用一个接受循环、一个asyncio事件循环、UDP回包/会话清理线程及统计与指标服务"""
+
+    def __init__(self, balancers):
+        """
+        :param balancers: 各监听对应的负载均衡器（第一个负责后台化、日志和指标服务）
+        """
+        self.balancers = balancers
+        self.lead = balancers[0]
+        self.log = self.lead.log
+        self.running = True
+        # 所有监听的UDP会话上游socket由同一个选择器线程统一读取回包
+        self.udp_selector = selectors.DefaultSelector()
+        for lb in balancers:
+            # 各负载均衡器构造时自建的选择器尚未注册任何socket，关闭后替换为共用的
+            lb.udp_selector.close()
+            lb.udp_selector = self.udp_selector
+
+    def signal_handler(self, signum, frame):
+        """信号处理：停止所有监听"""
+        self.log(f"收到信号 {signum}，正在关闭...")
+        for lb in self.balancers:
+            lb.running = False
+
+    def reload_handler(self, signum, frame):
+        """SIGHUP：各监听分别重新加载线路配置"""
+        self.log(f"收到信号 {signum}，重新加载配置...")
+        for lb in self.balancers:
+            if lb.running and not lb.draining:
+                threading.Thread(target=lb.reload_config, daemon=True).start()
+
+    def start(self):
+        """启动所有监听"""
+        if self.lead.daemon:
+            self.lead.daemonize()
+        
+        # 每个监听各自的PID文件和控制socket，--status/--stop/--reload/--upgrade 按端口操作
+        for lb in self.balancers:
+            if lb.upgrade:
+                lb.take_over_listeners()
+            lb.write_pid_file()
+            lb.start_control_server()
+        
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGHUP, self.reload_handler)
+        
+        for lb in self.balancers:
+            self.log(lb.startup_banner())
+            if lb.relay == 'splice' and not lb.use_splice:
+                self.log(f"[监听 {lb.listen_port}] 当前系统不支持splice，已回退为用户态拷贝转发", 'warning')
+        self.log(f"[多监听] 单进程承载 {len(self.balancers)} 个监听: "
+                 f"{', '.join(str(lb.listen_port) for lb in self.balancers)}")
+        
+        try:
+            threading.Thread(target=self.print_stats, daemon=True).start()
+            threading.Thread(target=self.track_rates, daemon=True).start()
+            if self.lead.metrics_port:
+                self.lead.start_metrics_server(self.snapshot_stats, render=self.render_metrics)
+            self.serve()
+        except KeyboardInterrupt:
+            self.log("收到中断信号，正在关闭...")
+            for lb in self.balancers:
+                lb.running = False
+            time.sleep(1)
+        finally:
+            self.running = False
+            for lb in self.balancers:
+                lb.stop_control_server()
+                lb.remove_pid_file()
+            self.log("负载均衡器已关闭")
+            self.lead.stop_log_listener()
+
+    def serve(self):
+        """在主线程中用一个选择器接受所有线程引擎监听的TCP连接和UDP数据包，直到所有监听都已停止"""
+        selector = selectors.DefaultSelector()
+        registered = collections.defaultdict(list)  # 监听 -> 注册到选择器的socket
+        async_balancers = []
+        for lb in self.balancers:
+            lb.start_line_tasks()
+            if 'tcp' in lb.protocols:
+                lb.tcp_server = lb.create_listener(socket.SOCK_STREAM)
+                if lb.engine == 'asyncio':
+                    async_balancers.append(lb)
+                    self.log(f"[TCP] 监听在 {lb.listen_host}:{lb.listen_port} (asyncio引擎)")
+                else:
+                    lb.tcp_server.setblocking(False)
+                    selector.register(lb.tcp_server, selectors.EVENT_READ, lb.accept_tcp_client)
+                    registered[lb].append(lb.tcp_server)
+                    self.log(f"[TCP] 监听在 {lb.listen_host}:{lb.listen_port}")
+            if 'udp' in lb.protocols:
+                lb.udp_server = lb.create_listener(socket.SOCK_DGRAM)
+                lb.udp_server.setblocking(False)
+                selector.register(lb.udp_server, selectors.EVENT_READ, lb.receive_udp_packet)
+                registered[lb].append(lb.udp_server)
+                self.log(f"[UDP] 监听在 {lb.listen_host}:{lb.listen_port}")
+        
+        loop_thread = None
+        if async_balancers:
+            raise_nofile_limit(self.log)
+            loop_thread = threading.Thread(target=self.run_event_loop, args=(async_balancers,), daemon=True)
+            loop_thread.start()
+        threading.Thread(target=self.clean_udp_sessions, daemon=True).start()
+        threading.Thread(target=self.dispatch_udp_replies, daemon=True).start()
+        
+        active = list(self.balancers)
+        drain_threads = []
+        while active:
+            for key, _ in selector.select(timeout=1.0):
+                try:
+                    key.data()
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError as e:
+                    self.log(f"[接受错误] {e}", 'error')
+            
+            # 已停止（--stop）或已交出监听socket（平滑升级）的监听退出接受循环
+            for lb in [lb for lb in active if not lb.running or lb.draining]:
+                active.remove(lb)
+                for sock in registered.pop(lb, ()):
+                    selector.unregister(sock)
+                if lb.running:
+                    thread = threading.Thread(target=self.drain_listener, args=(lb,), daemon=True)
+                    thread.start()
+                    drain_threads.append(thread)
+                else:
+                    self.close_listener(lb)
+        
+        for thread in drain_threads:
+            thread.join()
+        if loop_thread:
+            loop_thread.join(5)
+        selector.close()
+
+    def drain_listener(self, lb):
+        """已交出监听socket的监听：等待在途连接结束后关闭"""
+        if lb.engine != 'asyncio' and lb.tcp_server:
+            lb.tcp_server.close()  # 新进程持有同一监听socket，这里只关闭本进程的引用
+        lb.drain()
+        self.close_listener(lb)
+
+    def close_listener(self, lb):
+        """关闭一个监听的socket、控制socket和PID文件，其余监听继续服务"""
+        lb.running = False
+        # asyncio引擎的监听socket由事件循环中的接受协程退出时关闭
+        if lb.engine != 'asyncio' and lb.tcp_server:
+            lb.tcp_server.close()
+        if lb.udp_server:
+            lb.udp_server.close()
+        lb.stop_control_server()
+        lb.remove_pid_file()
+        self.log(f"[多监听] 监听 {lb.listen_host}:{lb.listen_port} 已关闭")
+
+    def run_event_loop(self, balancers):
+        """在同一个事件循环中运行所有asyncio引擎监听的TCP服务"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for lb in balancers:
+            lb.loop = loop
+        
+        async def serve(lb):
+            try:
+                await lb.start_tcp_server_async()
+            except Exception as e:
+                lb.log(f"[TCP错误] {e}", 'error')
+            finally:
+                lb.tcp_server.close()
+        
         try:
-            # 等待所有服务器线程
-            for thread in server_threads:
-                thread.join()
-        except KeyboardInterrupt:
-            self.log("收到中断信号，正在关闭...")
-            self.running = False
-            time.sleep(1)
+            loop.run_until_complete(asyncio.gather(*(serve(lb) for lb in balancers)))
         finally:
-            self.remove_pid_file()
-            self.log("负载均衡器已关闭")
+            loop.close()
+
+    def dispatch_udp_replies(self):
+        """统一读取所有监听的会话上游socket的回包"""
+        view = memoryview(bytearray(max(lb.udp_buffer_size for lb in self.balancers)))
+        while self.running:
+            try:
+                events = self.udp_selector.select(timeout=1.0)
+            except OSError:
+                break
+            relay_udp_replies(events, view)
+
+    def clean_udp_sessions(self):
+        """每秒推进所有监听的会话表时间轮，关闭空闲超时的会话"""
+        while self.running:
+            time.sleep(1)
+            for lb in self.balancers:
+                for session in lb.client_sessions.expire():
+                    lb.close_udp_session(session)
+
+    def snapshot_stats(self):
+        """各运行中监听的统计快照：端口 -> 快照"""
+        return {lb.listen_port: lb.snapshot_stats() for lb in self.balancers if lb.running}
+
+    def render_metrics(self, snapshots):
+        """合并各监听的指标族，样本加上listener标签"""
+        families = {}
+        for lb in self.balancers:
+            if lb.listen_port not in snapshots:
+                continue
+            listener = str(lb.listen_port)
+            for name, metric_type, help_text, samples in lb.metric_families(snapshots[lb.listen_port]):
+                family = families.setdefault(name, (name, metric_type, help_text, []))
+                family[3].extend((suffix, {'listener': listener, **labels}, value) for suffix, labels, value in samples)
+        return format_metrics(families.values())
+
+    def track_rates(self):
+        """每秒记录一次各监听的累计计数，供控制命令stats计算速率"""
+        while self.running:
+            for lb in self.balancers:
+                if lb.running:
+                    lb.rates.record(rate_totals(lb.snapshot_stats()), lb.targets)
+            time.sleep(1)
+
+    def print_stats(self):
+        """每分钟打印各监听的统计"""
+        while self.running:
+            time.sleep(60)
+            for lb in self.balancers:
+                if lb.running:
+                    self.log(f"\n[监听 {lb.listen_host}:{lb.listen_port}]" + lb.format_stats(lb.snapshot_stats()))
+
+
+def relay_udp_replies(events, view):
+    """把就绪的会话上游socket的回包经所属监听的udp_server发回客户端（view为收包缓冲区），回包刷新会话的活跃时间"""
+    for key, _ in events:
+        balancer, session = key.data
+        client_address, target, target_index = session.client, session.target, session.target_index
+        try:
+            n = key.fileobj.recv_into(view)
+            balancer.client_sessions.touch(session)
+            if not balancer.udp_server:
+                continue
+            wait = balancer.shape_udp_packet(target_index, target, 'down', n) if balancer.shapers else 0.0
+            if wait is None:
+                continue
+            if wait:
+                balancer.udp_pacer.schedule(wait, balancer.udp_server, bytes(view[:n]), client_address)
+            else:
+                balancer.udp_server.sendto(view[:n], client_address)
+            balancer.counters.add(('bytes_out', 'udp', target), n)
+        except OSError:
+            # 会话已被清理，或目标返回ICMP不可达
+            pass
+
+
+def recv_exact(sock, n):
+    """读取恰好n字节，对端提前关闭时抛出EOFError"""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise EOFError('连接已关闭')
+        view = view[received:]
+    return buf
+
+
+def recv_line(sock, limit=65536):
+    """读取一行（不含换行符），对端提前关闭时抛出EOFError"""
+    data = bytearray()
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(1)
+        if not chunk:
+            raise EOFError('连接已关闭')
+        data += chunk
+        if len(data) > limit:
+            raise ValueError('行过长')
+    return data[:-1].decode()
+
+
+def send_fds(sock, data, fds):
+    """经Unix socket发送数据及文件描述符（SCM_RIGHTS）"""
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    sock.sendmsg([data], ancdata)
+
+
+def recv_fds(sock, bufsize, maxfds):
+    """接收send_fds发送的数据及文件描述符，返回(data, fds)"""
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, cmsg_type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    return data, list(fds)
+
+
+def format_bytes(n):
+    """字节数转为易读格式"""
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n < 1024 or unit == 'TB':
+            return f"{n:.1f}{unit}" if unit != 'B' else f"{n}B"
+        n /= 1024
+
+
+def parse_size(value):
+    """解析字节数，可带K/M/G后缀（1024进制），如 4M、1.5G"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    scale = units.get(value[-1:].upper(), 1)
+    size = float(value[:-1] if scale > 1 else value) * scale
+    if size <= 0:
+        raise ValueError(value)
+    return size
+
+
+def parse_port_timeouts(specs):
+    """解析按端口的超时规格，如 53=10、27015-27030=300，返回 [(起始端口, 结束端口, 秒数)]"""
+    rules = []
+    for spec in specs:
+        ports, sep, seconds = str(spec).partition('=')
+        first, _, last = ports.partition('-')
+        try:
+            rule = (int(first), int(last or first), float(seconds))
+        except ValueError:
+            raise ValueError(f"端口超时格式应为 端口=秒数 或 起始端口-结束端口=秒数: {spec}")
+        if not sep or not 1 <= rule[0] <= rule[1] <= 65535 or rule[2] <= 0:
+            raise ValueError(f"端口超时无效: {spec}")
+        rules.append(rule)
+    return rules
+
+
+def parse_line_specs(specs, line_count, parse, merge, what):
+    """解析按线路的规格列表：每项为 SPEC（所有线路）或 N:SPEC（线路N，覆盖同名项）
+
+    返回 (所有线路共用的配置或None, {线路编号（从1开始）: 与共用配置合并后的配置})
+    """
+    common = None
+    lines = {}
+    for spec in specs:
+        line, sep, rest = spec.partition(':')
+        if sep and line.strip().isdigit():
+            number = int(line)
+            if number < 1 or number > line_count:
+                raise ValueError(f"{what}指定的线路编号必须在1-{line_count}之间: {spec}")
+            parsed = parse(rest)
+            lines[number] = merge(lines[number], parsed) if number in lines else parsed
+        else:
+            parsed = parse(spec)
+            common = merge(common, parsed) if common else parsed
+    if common:
+        lines = {number: merge(common, parsed) for number, parsed in lines.items()}
+    return common, lines
+
+
+def histogram_quantile(buckets, q):
+    """首包大小直方图的分位数，返回所在桶的上界（字节）"""
+    total = sum(buckets)
+    cumulative = 0
+    for bound, count in zip(PACKET_SIZE_BUCKETS + (65536,), buckets):
+        cumulative += count
+        if cumulative >= q * total:
+            return bound
+    return PACKET_SIZE_BUCKETS[-1]
+
+
+def format_metrics(families):
+    """将指标族渲染为Prometheus文本格式"""
+    lines = []
+    for name, metric_type, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for suffix, labels, value in samples:
+            label_str = ','.join(f'{k}="{prometheus_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{suffix}{{{label_str}}} {value}" if label_str else f"{name}{suffix} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_escape(value):
+    """转义Prometheus标签值"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def rate_totals(snapshot):
+    """从统计快照取出计算速率用的各线路累计计数"""
+    tcp, udp = snapshot['tcp'], snapshot['udp']
+    return {
+        'tcp_conns': tcp['targets'],
+        'udp_sessions': udp['new_sessions'],
+        'udp_packets': udp['targets'],
+        'bytes_in': [a + b for a, b in zip(tcp['bytes_in'], udp['bytes_in'])],
+        'bytes_out': [a + b for a, b in zip(tcp['bytes_out'], udp['bytes_out'])]
+    }
+
+
+def merge_stats(snapshots):
+    """合并多个统计快照（数值求和，列表按位求和）"""
+    merged = snapshots[0]
+    for snapshot in snapshots[1:]:
+        merged = _merge_value(merged, snapshot)
+    return merged
+
+
+def _merge_value(a, b):
+    if isinstance(a, dict):
+        return {
+            key: b.get(key, a[key]) if key in NON_ADDITIVE_STATS else
+            (_merge_value(a[key], b[key]) if key in b else a[key])
+            for key in a
+        }
+    if isinstance(a, list):
+        return [_merge_value(x, y) for x, y in zip(a, b)]
+    return a + b
+
+
+def raise_nofile_limit(log):
+    """将文件描述符软限制提升到硬限制"""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        new_soft = hard if hard != resource.RLIM_INFINITY else 1048576
+        if soft != resource.RLIM_INFINITY and soft < new_soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            log(f"文件描述符上限: {soft} -> {new_soft}")
+    except (ValueError, OSError) as e:
+        log(f"无法提升文件描述符上限: {e}", 'warning')
 
 
 def parse_target(target_str, default_host):
+    """解析目标地址（可带 @权重 后缀），返回((host, port), weight)"""
+    weight = 1
+    if '@' in target_str:
+        target_str, weight_str = target_str.rsplit('@', 1)
+        weight = int(weight_str)
+        if weight < 1:
+            raise ValueError(f"权重必须为正整数: {weight_str}")
+    return parse_address(target_str, default_host), weight
+
+
+def parse_address(target_str, default_host):
     """解析目标地址"""
     if ':' in target_str:
         host, port = target_str.rsplit(':', 1)
@@ -535,6 +4348,174 @@ def parse_target(target_str, default_host):
         return (default_host, int(target_str))
 
 
+def load_config(path):
+    """读取JSON配置文件，键为命令行参数的长选项名（如 listen_port 或 listen-port）"""
+    with open(path, 'r') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError("配置文件顶层必须是JSON对象")
+    return {key.replace('-', '_'): value for key, value in config.items()}
+
+
+def config_argv(parser, config):
+    """将配置项转换为命令行参数，使其与命令行一样经过各参数的type/choices校验
+
+    开关参数取true/false，多值参数取列表，其余取单个值；null表示不设置。
+    """
+    actions = {
+        action.dest: action for action in parser._actions
+        if action.option_strings and action.default != argparse.SUPPRESS  # 排除 --help/--version
+    }
+    unknown = sorted(key for key in config if key not in actions)
+    if unknown:
+        raise ValueError(f"配置文件包含未知参数: {', '.join(unknown)}")
+    argv = []
+    for key, value in config.items():
+        action = actions[key]
+        option = max(action.option_strings, key=len)
+        if value is None:
+            continue
+        if action.nargs == 0:
+            if not isinstance(value, bool):
+                raise ValueError(f"配置项 {key} 应为 true 或 false")
+            if value:
+                argv.append(option)
+        elif action.nargs in ('+', '*'):
+            values = value if isinstance(value, list) else [value]
+            argv += [option] + [str(v) for v in values]
+        elif isinstance(value, (list, dict)):
+            raise ValueError(f"配置项 {key} 只能是单个值")
+        else:
+            argv.append(f"{option}={value}")
+    return argv
+
+
+def parse_args(parser, argv):
+    """解析命令行；指定-c时以配置文件中的值作为默认值，命令行参数优先
+
+    配置文件含 listeners 数组时，args.listeners 为每个监听的参数（监听项中的值 > 命令行 > 顶层值 > 默认值），否则为None
+    """
+    args = parser.parse_args(argv)
+    listeners = None
+    if args.config:
+        config = load_config(args.config)
+        config.pop('config', None)
+        listeners = config.pop('listeners', None)
+        
+        def config_error(message):
+            raise ValueError(f"配置文件参数无效: {message}")
+        
+        # 配置项放在命令行参数之前：同一参数以命令行为准；取值错误报告为ValueError（重载时保持原配置）
+        parser.error = config_error
+        try:
+            config_args = config_argv(parser, config)
+            args = parser.parse_args(config_args + argv)
+            if listeners is not None:
+                if not isinstance(listeners, list) or not listeners:
+                    raise ValueError("listeners 必须是非空的JSON数组")
+                parsed = []
+                for entry in listeners:
+                    if not isinstance(entry, dict):
+                        raise ValueError("listeners 中的每一项必须是JSON对象")
+                    entry = {key.replace('-', '_'): value for key, value in entry.items()}
+                    try:
+                        entry_args = config_argv(parser, entry)
+                    except ValueError as e:
+                        raise ValueError(f"listeners: {e}")
+                    parsed.append(parser.parse_args(config_args + argv + entry_args))
+                listeners = parsed
+        finally:
+            del parser.error
+    args.listeners = listeners
+    return args
+
+
+def resolve_targets(args):
+    """校验并解析目标线路，返回(targets, weights, primary)"""
+    if args.bond == 'server':
+        if len(args.targets) != 1:
+            raise ValueError("绑定服务端只能指定1个目标（后端服务）")
+    elif len(args.targets) < 2 or len(args.targets) > 6:
+        raise ValueError("目标数量必须在2-6之间")
+    if args.primary < 1 or args.primary > len(args.targets):
+        raise ValueError(f"主线路编号必须在1-{len(args.targets)}之间")
+    parsed = [parse_target(str(t), args.target_host) for t in args.targets]
+    return [target for target, _ in parsed], [weight for _, weight in parsed], args.primary
+
+
+def create_balancer(args, config_loader=None, **overrides):
+    """按解析后的参数创建负载均衡器，overrides覆盖对应的构造参数"""
+    targets, weights, primary = resolve_targets(args)
+    options = dict(
+        listen_host=args.host,
+        listen_port=args.listen_port,
+        targets=targets,
+        small_packet_size=args.size,
+        mode=args.mode,
+        protocols=['tcp', 'udp'] if args.protocol == 'both' else [args.protocol],
+        daemon=args.daemon,
+        log_file=args.log_file,
+        primary=primary,
+        engine=args.engine,
+        relay=args.relay,
+        tcp_buffer_size=args.tcp_buffer_size,
+        udp_buffer_size=args.udp_buffer_size,
+        buffer_pool_size=args.buffer_pool_size,
+        workers=args.workers,
+        health_check=args.health_check,
+        connect_timeout=args.connect_timeout,
+        eject_failures=args.eject_failures,
+        eject_time=args.eject_time,
+        latency_factor=args.latency_factor,
+        weights=weights,
+        pool_min=args.pool_min,
+        pool_max=args.pool_max,
+        pool_idle_ttl=args.pool_idle_ttl,
+        metrics_port=args.metrics_port,
+        metrics_host=args.metrics_host,
+        log_sample=args.log_sample,
+        log_queue_size=args.log_queue_size,
+        udp_timeout=args.udp_timeout,
+        udp_port_timeouts=parse_port_timeouts(args.udp_port_timeout or []),
+        hash_key=args.hash_key,
+        size_target=args.size_target,
+        size_adapt_interval=args.size_adapt_interval,
+        max_udp_sessions=args.max_udp_sessions,
+        bond=args.bond,
+        bond_chunk=args.bond_chunk,
+        peek_timeout=args.peek_timeout,
+        race_delay=args.race_delay,
+        config_loader=config_loader,
+        upgrade=args.upgrade,
+        drain_timeout=args.drain_timeout,
+        max_tcp_conns=args.max_tcp_conns,
+        max_udp_handlers=args.max_udp_handlers,
+        max_flows_per_ip=args.max_flows_per_ip,
+        overload=args.overload,
+        queue_timeout=args.queue_timeout,
+        backlog=args.backlog,
+        listen_sockopt=args.listen_sockopt,
+        target_sockopt=args.target_sockopt,
+        line_rate=args.line_rate,
+        shape_policy=args.shape_policy,
+        shape_max_delay=args.shape_max_delay
+    )
+    options.update(overrides)
+    return MultiLineLoadBalancer(**options)
+
+
+def send_control_command(listen_port, command):
+    """向运行中的实例发送控制命令，返回JSON回复"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(CONTROL_TIMEOUT)
+    try:
+        conn.connect(f'/tmp/loadbalancer_{listen_port}.sock')
+        conn.sendall(f"{command}\n".encode())
+        return json.loads(recv_line(conn, 1 << 20))
+    finally:
+        conn.close()
+
+
 def read_pid(pid_file):
     """读取PID文件"""
     try:
@@ -553,6 +4534,21 @@ def stop_daemon(listen_port):
         print(f"未找到运行中的负载均衡器（端口 {listen_port}）")
         return False
     
+    # 优先通过控制socket只停止该端口的监听（同一进程可能承载多个监听）
+    try:
+        stopped = send_control_command(listen_port, 'stop').get('ok')
+    except (OSError, EOFError, ValueError):
+        stopped = False
+    if stopped:
+        print(f"正在停止负载均衡器（端口 {listen_port}，PID: {pid}）...")
+        for _ in range(20):
+            if read_pid(pid_file) != pid:
+                print("负载均衡器已停止")
+                return True
+            time.sleep(0.5)
+        print(f"停止超时，可执行 kill -9 {pid} 强制结束（将同时结束该进程承载的所有监听）")
+        return False
+    
     try:
         os.kill(pid, signal.SIGTERM)
         print(f"正在停止负载均衡器（PID: {pid}）...")
@@ -579,28 +4575,567 @@ def stop_daemon(listen_port):
         return False
 
 
-def show_status(listen_port):
-    """显示运行状态"""
+def display_width(text):
+    """终端显示宽度（中文等宽字符占2列）"""
+    return sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in text)
+
+
+def pad(text, width):
+    """按显示宽度右侧补空格"""
+    return text + ' ' * max(0, width - display_width(text))
+
+
+def format_duration(seconds):
+    """秒数转为 [N天 ]HH:MM:SS"""
+    days, rest = divmod(int(seconds), 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes, secs = divmod(rest, 60)
+    return (f"{days}天 " if days else "") + f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+
+def render_status(report):
+    """把控制命令stats的回复渲染为文本视图（每条线路一行，速率依次为最近1/10/60秒）"""
+    stats, rates = report['stats'], report['rates']
+    windows = [str(window) for window in RATE_WINDOWS]
+    
+    def triple(name, i, fmt):
+        return '/'.join(fmt(rates[w][name][i]) if rates[w] else '-' for w in windows)
+    
+    def per_second(value):
+        return format_bytes(int(value))
+    
+    def count(value):
+        return f"{value:.1f}" if value < 100 else f"{value:.0f}"
+    
+    adapt = stats.get('size_adapt')
+    threshold = f"(阈值{adapt['threshold']}B)" if adapt else ""
+    lines = [
+        f"拼好线 v{report['version']}  监听 {report['listen']}  PID {report['pid']}  运行 {format_duration(report['uptime'])}",
+        f"模式 {report['mode']}{threshold}  引擎 {report['engine']}  协议 {'+'.join(p.upper() for p in report['protocols'])}"
+        f"  工作进程 {report['workers']}  UDP会话 {stats['udp_sessions']}"
+        + ("  [已交出监听，等待在途连接结束]" if report['draining'] else "")
+    ]
+    dropped = {proto: sum(stats['overload'][proto].values()) for proto in ('tcp', 'udp')}
+    if any(dropped.values()):
+        lines.append(f"准入拒绝  TCP {dropped['tcp']}  UDP {dropped['udp']}")
+    lines.append("")
+    columns = [('线路', 28), ('活跃TCP/UDP', 13), ('新建/秒', 18), ('上行/秒', 27), ('下行/秒', 27), ('RTT', 9), ('状态', 6)]
+    lines.append(''.join(pad(title, width) for title, width in columns))
+    lines.append(''.join(pad(sub, width) for sub, (_, width) in
+                         zip(['', '', '1s/10s/60s', '1s/10s/60s', '1s/10s/60s', '', ''], columns)))
+    for i, target in enumerate(report['targets']):
+        health = stats['health'][i]
+        primary_mark = '*' if i + 1 == report['primary'] else ' '
+        weight = f" @{report['weights'][i]}" if len(set(report['weights'])) > 1 else ""
+        new_flows = '/'.join(
+            count(rates[w]['tcp_conns'][i] + rates[w]['udp_sessions'][i]) if rates[w] else '-' for w in windows)
+        cells = [
+            f"T{i+1}{primary_mark} {target}{weight}",
+            f"{stats['active']['tcp'][i]}/{stats['active']['udp'][i]}",
+            new_flows,
+            triple('bytes_in', i, per_second),
+            triple('bytes_out', i, per_second),
+            f"{health['rtt_ms']:.1f}ms" if health['rtt_ms'] is not None else "-",
+            "已剔除" if health['ejected'] else "正常"
+        ]
+        lines.append(''.join(pad(cell, width) for cell, (_, width) in zip(cells, columns)))
+    return '\n'.join(lines)
+
+
+def status_text(listen_port):
+    """查询一个监听的状态，返回(文本, 是否取得了实时统计)"""
     pid_file = f'/tmp/loadbalancer_{listen_port}.pid'
     pid = read_pid(pid_file)
     
     if pid is None:
-        print(f"负载均衡器（端口 {listen_port}）未运行")
-        return
+        return f"负载均衡器（端口 {listen_port}）未运行", False
     
     try:
         os.kill(pid, 0)
-        print(f"负载均衡器正在运行")
-        print(f"  PID: {pid}")
-        print(f"  PID文件: {pid_file}")
-        print(f"  日志文件: /var/log/loadbalancer_{listen_port}.log")
-        print(f"\n查看日志: tail -f /var/log/loadbalancer_{listen_port}.log")
     except OSError:
-        print(f"负载均衡器（端口 {listen_port}）未运行（PID文件过期）")
         try:
             os.remove(pid_file)
         except:
             pass
+        return f"负载均衡器（端口 {listen_port}）未运行（PID文件过期）", False
+    
+    try:
+        report = send_control_command(listen_port, 'stats')
+    except (OSError, EOFError, ValueError):
+        report = None
+    if not report or not report.get('ok'):
+        reason = report.get('error') if report else '控制socket不可用'
+        return (f"负载均衡器（端口 {listen_port}）正在运行\n  PID: {pid}\n  PID文件: {pid_file}\n"
+                f"  无法获取实时统计: {reason}"), False
+    return render_status(report), True
+
+
+def show_status(ports, interval=1.0):
+    """显示运行状态：经控制socket获取实时统计，在终端中每秒刷新（类似top），输出被重定向时只输出一次"""
+    live = sys.stdout.isatty()
+    try:
+        while True:
+            results = [status_text(port) for port in ports]
+            text = '\n\n'.join(text for text, _ in results)
+            if not live or not any(ok for _, ok in results):
+                print(text)
+                return
+            sys.stdout.write('\033[H\033[2J' + text + '\n\n按 Ctrl+C 退出\n')
+            sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print()
+
+
+# ========== 基准测试 ==========
+def find_free_port():
+    """获取一个空闲的本地端口"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_sink_server():
+    """启动本地TCP汇聚服务：读到EOF后回复1字节确认"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1024)
+    
+    def handle(conn):
+        buf = bytearray(262144)
+        try:
+            while conn.recv_into(buf):
+                pass
+            conn.sendall(b'k')
+        except OSError:
+            pass
+        finally:
+            conn.close()
+    
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def start_echo_server():
+    """启动本地TCP回显服务"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1024)
+    
+    def handle(conn):
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        try:
+            while True:
+                n = conn.recv_into(buf)
+                if not n:
+                    break
+                conn.sendall(view[:n])
+        except OSError:
+            pass
+        finally:
+            conn.close()
+    
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def start_udp_echo_server(replies=1):
+    """启动本地UDP回显服务，每收到一个包回显replies次（模拟一问多答的协议）"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    
+    def serve():
+        buf = bytearray(65535)
+        view = memoryview(buf)
+        while True:
+            try:
+                n, address = server.recvfrom_into(buf)
+                for _ in range(replies):
+                    server.sendto(view[:n], address)
+            except OSError:
+                break
+    
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def start_bench_balancer(targets, engine='thread', relay='copy', mode='auto', small_packet_size=1024,
+                         protocol='tcp'):
+    """在当前进程中启动一个只转发单一协议的负载均衡器"""
+    port = find_free_port()
+    balancer = MultiLineLoadBalancer(
+        listen_host='127.0.0.1',
+        listen_port=port,
+        targets=targets,
+        small_packet_size=small_packet_size,
+        mode=mode,
+        protocols=[protocol],
+        engine=engine,
+        relay=relay
+    )
+    if protocol == 'udp':
+        run = balancer.start_udp_server
+    else:
+        run = balancer.run_asyncio_engine if engine == 'asyncio' else balancer.start_tcp_server
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    
+    # 等待监听就绪
+    for _ in range(50):
+        if protocol == 'udp':
+            if balancer.udp_server:
+                break
+            time.sleep(0.1)
+            continue
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return balancer, thread
+
+
+def latency_summary(samples):
+    """延迟样本（秒）的分位数（毫秒）"""
+    if not samples:
+        return {'p50': None, 'p99': None, 'p999': None}
+    samples = sorted(samples)
+    
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    
+    return {'p50': pick(0.5), 'p99': pick(0.99), 'p999': pick(0.999)}
+
+
+def run_load(make_client, concurrency, seconds):
+    """闭环压测：concurrency个客户端在seconds秒内循环执行请求
+
+    make_client(client_id) 返回 (request, close)，request() 完成一次请求，失败时抛出OSError。
+    返回 (成功次数, 失败次数, 延迟样本列表, 实际耗时)
+    """
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    deadline = start + seconds
+    
+    def worker(client_id):
+        request, close = make_client(client_id)
+        local, failed = [], 0
+        try:
+            while True:
+                begin = time.perf_counter()
+                if begin >= deadline:
+                    break
+                try:
+                    request()
+                except OSError:
+                    failed += 1
+                    continue
+                local.append(time.perf_counter() - begin)
+        finally:
+            close()
+        latencies.extend(local)
+        errors.append(failed)
+    
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(latencies), sum(errors), latencies, time.perf_counter() - start
+
+
+def bench_payload(client_id, small_packet_size):
+    """奇偶客户端分别发送小包/大包，使size模式两类线路都有流量"""
+    return b'x' * (64 if client_id % 2 == 0 else small_packet_size * 2)
+
+
+def bench_connect_rate(engine, mode, target_count, concurrency, seconds, small_packet_size=1024):
+    """TCP新建连接速率：每次请求新建连接、回显一个请求后关闭"""
+    echoes = [start_echo_server() for _ in range(target_count)]
+    targets = [('127.0.0.1', s.getsockname()[1]) for s in echoes]
+    balancer, thread = start_bench_balancer(targets, engine=engine, mode=mode,
+                                            small_packet_size=small_packet_size)
+    address = ('127.0.0.1', balancer.listen_port)
+    linger = struct.pack('ii', 1, 0)
+    
+    def make_client(client_id):
+        payload = bench_payload(client_id, small_packet_size)
+        buf = bytearray(len(payload))
+        
+        def request():
+            conn = socket.create_connection(address, timeout=5)
+            try:
+                # 以RST关闭，避免压测端积累TIME_WAIT
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
+                conn.sendall(payload)
+                view = memoryview(buf)
+                while view:
+                    n = conn.recv_into(view)
+                    if not n:
+                        raise ConnectionError('连接提前关闭')
+                    view = view[n:]
+            finally:
+                conn.close()
+        
+        return request, lambda: None
+    
+    ops, errors, latencies, elapsed = run_load(make_client, concurrency, seconds)
+    per_target = balancer.snapshot_stats()['tcp']['targets']
+    balancer.running = False
+    thread.join()
+    for s in echoes:
+        s.close()
+    
+    return {
+        'scenario': 'tcp_connect_rate',
+        'engine': engine,
+        'mode': mode,
+        'targets': target_count,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 4),
+        'completed': ops,
+        'errors': errors,
+        'conn_per_s': round(ops / elapsed, 1),
+        'latency_ms': latency_summary(latencies),
+        'per_target': per_target
+    }
+
+
+def bench_udp_pps(mode, target_count, concurrency, seconds, small_packet_size=1024):
+    """UDP包转发速率：每个客户端一个会话，发一个包等一个回包"""
+    echoes = [start_udp_echo_server() for _ in range(target_count)]
+    targets = [('127.0.0.1', s.getsockname()[1]) for s in echoes]
+    balancer, thread = start_bench_balancer(targets, mode=mode, small_packet_size=small_packet_size,
+                                            protocol='udp')
+    address = ('127.0.0.1', balancer.listen_port)
+    
+    def make_client(client_id):
+        payload = bench_payload(client_id, small_packet_size)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(1.0)
+        sock.connect(address)
+        buf = bytearray(65535)
+        
+        def request():
+            sock.send(payload)
+            sock.recv_into(buf)
+        
+        return request, sock.close
+    
+    ops, errors, latencies, elapsed = run_load(make_client, concurrency, seconds)
+    per_target = balancer.snapshot_stats()['udp']['targets']
+    balancer.running = False
+    thread.join()
+    for s in echoes:
+        s.close()
+    
+    return {
+        'scenario': 'udp_pps',
+        'mode': mode,
+        'targets': target_count,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 4),
+        'completed': ops,
+        'errors': errors,
+        'packets_per_s': round(ops / elapsed, 1),
+        'latency_ms': latency_summary(latencies),
+        'per_target': per_target
+    }
+
+
+def bench_udp_stream(mode, target_count, concurrency, seconds, replies, small_packet_size=1024):
+    """UDP一问多答：每个请求服务端回replies个包，测回包速率及首包/末包延迟"""
+    echoes = [start_udp_echo_server(replies) for _ in range(target_count)]
+    targets = [('127.0.0.1', s.getsockname()[1]) for s in echoes]
+    balancer, thread = start_bench_balancer(targets, mode=mode, small_packet_size=small_packet_size,
+                                            protocol='udp')
+    address = ('127.0.0.1', balancer.listen_port)
+    first_latencies = []
+    lost = []
+    
+    def make_client(client_id):
+        payload = bench_payload(client_id, small_packet_size)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(1.0)
+        sock.connect(address)
+        buf = bytearray(65535)
+        seq = itertools.count()
+        local_first, local_lost = [], [0]
+        
+        def request():
+            # 包头带请求序号，丢弃上一个（超时的）请求迟到的回包
+            tag = struct.pack('!I', next(seq))
+            begin = time.perf_counter()
+            sock.send(tag + payload[4:])
+            received = 0
+            try:
+                while received < replies:
+                    n = sock.recv_into(buf)
+                    if buf[:4] != tag:
+                        continue
+                    if not received:
+                        local_first.append(time.perf_counter() - begin)
+                    received += 1
+            except OSError:
+                local_lost[0] += replies - received
+                raise
+        
+        def close():
+            sock.close()
+            first_latencies.extend(local_first)
+            lost.append(local_lost[0])
+        
+        return request, close
+    
+    ops, errors, latencies, elapsed = run_load(make_client, concurrency, seconds)
+    balancer.running = False
+    thread.join()
+    for s in echoes:
+        s.close()
+    
+    return {
+        'scenario': 'udp_stream',
+        'mode': mode,
+        'targets': target_count,
+        'concurrency': concurrency,
+        'replies': replies,
+        'seconds': round(elapsed, 4),
+        'completed': ops,
+        'errors': errors,
+        'lost_replies': sum(lost),
+        'replies_per_s': round(ops * replies / elapsed, 1),
+        'first_reply_latency_ms': latency_summary(first_latencies),
+        'last_reply_latency_ms': latency_summary(latencies)
+    }
+
+
+def bench_tcp_throughput(engine, relay, target_count=2, total_mb=256, streams=4):
+    """TCP大流量吞吐测试"""
+    sinks = [start_sink_server() for _ in range(target_count)]
+    targets = [('127.0.0.1', s.getsockname()[1]) for s in sinks]
+    balancer, thread = start_bench_balancer(targets, engine=engine, relay=relay)
+    
+    per_stream = total_mb * 1024 * 1024 // streams
+    chunk = memoryview(bytearray(262144))
+    
+    def send_stream():
+        conn = socket.create_connection(('127.0.0.1', balancer.listen_port))
+        try:
+            left = per_stream
+            while left > 0:
+                n = min(left, len(chunk))
+                conn.sendall(chunk[:n])
+                left -= n
+            conn.shutdown(socket.SHUT_WR)
+            return conn.recv(1) == b'k'
+        finally:
+            conn.close()
+    
+    results = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    workers = [threading.Thread(target=lambda: results.append(send_stream())) for _ in range(streams)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    
+    balancer.running = False
+    thread.join()
+    for s in sinks:
+        s.close()
+    
+    total = per_stream * streams
+    return {
+        'scenario': 'tcp_throughput',
+        'engine': engine,
+        'relay': 'splice' if balancer.use_splice else 'copy',
+        'targets': target_count,
+        'streams': streams,
+        'bytes': total,
+        'completed': sum(1 for r in results if r),
+        'seconds': round(elapsed, 4),
+        'mbit_per_s': round(total * 8 / elapsed / 1e6, 1),
+        'cpu_seconds': round(cpu, 4)
+    }
+
+
+def run_bench(args):
+    """运行基准测试并输出JSON结果"""
+    logging.basicConfig(level=logging.WARNING)
+    raise_nofile_limit(lambda msg: None)
+    relays = ['copy', 'splice'] if SPLICE_AVAILABLE else ['copy']
+    scenarios = args.bench_scenarios
+    concurrency, seconds = args.bench_concurrency, args.bench_seconds
+    results = []
+    
+    if 'connect' in scenarios:
+        for engine in ['thread', 'asyncio']:
+            for mode in ['auto', 'size']:
+                for count in args.bench_targets:
+                    result = bench_connect_rate(engine, mode, count, concurrency, seconds)
+                    print(f"[基准] 新建连接 {engine}/{mode}/{count}线路: {result['conn_per_s']} 连接/秒，"
+                          f"p99 {result['latency_ms']['p99']}ms", file=sys.stderr)
+                    results.append(result)
+    
+    if 'throughput' in scenarios:
+        for engine in ['thread', 'asyncio']:
+            for relay in relays:
+                result = bench_tcp_throughput(engine, relay, total_mb=args.bench_mb)
+                print(f"[基准] 吞吐 {engine}/{result['relay']}: {result['mbit_per_s']} Mbit/s "
+                      f"(CPU {result['cpu_seconds']}s)", file=sys.stderr)
+                results.append(result)
+    
+    if 'udp' in scenarios:
+        for mode in ['auto', 'size']:
+            for count in args.bench_targets:
+                result = bench_udp_pps(mode, count, concurrency, seconds)
+                print(f"[基准] UDP {mode}/{count}线路: {result['packets_per_s']} 包/秒，"
+                      f"p99 {result['latency_ms']['p99']}ms", file=sys.stderr)
+                results.append(result)
+    
+    if 'udp-stream' in scenarios:
+        for count in args.bench_targets:
+            result = bench_udp_stream('auto', count, concurrency, seconds, args.bench_replies)
+            print(f"[基准] UDP一问{args.bench_replies}答 {count}线路: {result['replies_per_s']} 回包/秒，"
+                  f"首包p99 {result['first_reply_latency_ms']['p99']}ms，末包p99 {result['last_reply_latency_ms']['p99']}ms，"
+                  f"丢失 {result['lost_replies']}", file=sys.stderr)
+            results.append(result)
+    
+    output = json.dumps({
+        'version': __version__,
+        'python': sys.version.split()[0],
+        'concurrency': concurrency,
+        'results': results
+    }, indent=2)
+    if args.bench_output:
+        with open(args.bench_output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
 
 
 if __name__ == "__main__":
@@ -624,37 +5159,166 @@ if __name__ == "__main__":
   # 按包大小分流
   %(prog)s -l 40001 -t 40002 40003 -m size -s 1024 -d
   
+  # 最少活跃连接（适合长连接）
+  %(prog)s -l 40001 -t 40002 40003 40004 -m least-conn -d
+  
+  # 每5秒健康检查，自动剔除故障线路并优选低延迟线路
+  %(prog)s -l 40001 -t 40002 40003 40004 --health-check 5 -d
+  
+  # 每条线路保持2-8条预建立连接，省去建连握手
+  %(prog)s -l 40001 -t 40002 40003 --pool-min 2 --pool-max 8 -d
+  
+  # 多线路绑定：本地把每条连接拆到3条线路，对端重组后转发到8080
+  %(prog)s -l 40001 -t 1.1.1.1:50000 2.2.2.2:50000 3.3.3.3:50000 --bond client -d
+  %(prog)s -l 50000 -t 127.0.0.1:8080 --bond server -d
+  
+  # 在本地9100端口提供Prometheus指标
+  %(prog)s -l 40001 -t 40002 40003 --metrics-port 9100 -d
+  
+  # 4个工作进程（SO_REUSEPORT，利用多核）
+  %(prog)s -l 40001 -t 40002 40003 --workers 4 -d
+  
+  # asyncio引擎（单线程事件循环，适合上万并发TCP连接）
+  %(prog)s -l 40001 -t 40002 40003 --engine asyncio -d
+  
   # 完整地址配置
   %(prog)s -l 40001 -t 192.168.1.10:40002 192.168.1.11:40003 -d
   
+  # 加权轮询（1G线路与100M线路按10:1分配）
+  %(prog)s -l 40001 -t 192.168.1.10:40002@10 192.168.1.11:40003@1 -d
+  
+  # 从配置文件启动，修改线路后重新加载（在途连接不中断）
+  %(prog)s -c /etc/bs2.json -d
+  %(prog)s -c /etc/bs2.json --reload
+  
+  # 平滑升级：新进程接管监听socket，旧进程处理完在途连接后退出
+  %(prog)s -c /etc/bs2.json --upgrade -d
+  
+  # 配置文件含 listeners 数组时单进程承载多个监听，可按端口单独停止
+  %(prog)s -c /etc/bs2-multi.json -d
+  %(prog)s --stop -l 25565
+  
   # 停止后台进程
   %(prog)s --stop -l 40001
   
   # 查看运行状态
   %(prog)s --status -l 40001
+  
+  # splice零拷贝转发（Linux）
+  %(prog)s -l 40001 -t 40002 40003 --relay splice -d
+  
+  # 本地基准测试（新建连接/秒、吞吐、UDP包/秒及延迟分位数）
+  %(prog)s --bench --bench-output result.json
+  
+  # 只测新建连接，6条线路，64并发
+  %(prog)s --bench --bench-scenarios connect --bench-targets 6 --bench-concurrency 64
 
 GitHub: https://github.com/Lorry-San/route-load-balancing
         '''
     )
     
+    parser.add_argument('-c', '--config',
+                        help='JSON配置文件，键为长选项名（如 "targets": ["40002@2", "40003"]），命令行参数优先；'
+                             'listeners 数组中每项为一个监听，由同一进程承载')
     parser.add_argument('-l', '--listen-port', type=int, 
                         help='监听端口')
     parser.add_argument('-t', '--targets', nargs='+', 
-                        help='目标端口或host:port列表（2-6个）')
+                        help='目标端口或host:port列表（2-6个），可加@权重，如 host:port@5')
     parser.add_argument('-p', '--protocol', 
                         choices=['tcp', 'udp', 'both'], 
                         default='both',
                         help='协议类型: tcp, udp, both（默认both）')
-    parser.add_argument('-m', '--mode', choices=['auto', 'size'], default='auto',
-                        help='分流模式: auto=自动轮询(默认), size=按包大小')
+    parser.add_argument('-m', '--mode', choices=list(STRATEGIES), default='auto',
+                        help='分流模式: auto=自动轮询(默认), size=按包大小, '
+                             'least-conn=最少活跃连接, p2c=随机二选一, hash=按客户端哈希固定线路')
+    parser.add_argument('--hash-key', choices=HASH_KEYS, default='ip',
+                        help='hash模式的客户端键: ip=客户端IP(默认), ip:port=客户端IP和端口')
     parser.add_argument('-s', '--size', type=int, default=1024, 
                         help='小包阈值（默认1024字节）')
+    parser.add_argument('--size-target', type=float, default=0,
+                        help='size模式主线路的目标流量占比（0-1），设置后按首包大小分布自适应调整阈值，-s为初始值（默认0=固定阈值）')
+    parser.add_argument('--size-adapt-interval', type=float, default=10,
+                        help='自适应阈值的调整周期（秒，默认10）')
     parser.add_argument('-H', '--host', default='0.0.0.0', 
                         help='监听地址（默认0.0.0.0）')
     parser.add_argument('--target-host', default='127.0.0.1', 
                         help='目标主机（默认127.0.0.1）')
     parser.add_argument('--primary', type=int, default=1,
                         help='主线路编号（1-6，默认1）')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='TCP转发引擎: thread=每连接线程(默认), asyncio=单事件循环')
+    parser.add_argument('--relay', choices=['copy', 'splice'], default='copy',
+                        help='TCP转发方式: copy=用户态拷贝(默认), splice=内核零拷贝(Linux)')
+    parser.add_argument('--tcp-buffer-size', type=int, default=8192,
+                        help='TCP转发缓冲区大小（默认8192字节）')
+    parser.add_argument('--udp-buffer-size', type=int, default=65535,
+                        help='UDP收包缓冲区大小（默认65535字节）')
+    parser.add_argument('--buffer-pool-size', type=int, default=1024,
+                        help='每种协议缓冲池保留的最大缓冲区数（默认1024）')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='工作进程数（SO_REUSEPORT多进程，默认1）')
+    parser.add_argument('--health-check', type=float, default=0,
+                        help='主动健康检查间隔（秒，默认0=关闭）')
+    parser.add_argument('--connect-timeout', type=float, default=5.0,
+                        help='连接目标超时（秒，默认5），失败自动切换下一条线路')
+    parser.add_argument('--eject-failures', type=int, default=3,
+                        help='连续失败多少次剔除线路（默认3）')
+    parser.add_argument('--eject-time', type=float, default=30,
+                        help='线路剔除时长（秒，默认30）')
+    parser.add_argument('--latency-factor', type=float, default=2.0,
+                        help='RTT超过最优线路该倍数时不参与分配（默认2.0，0=关闭）')
+    parser.add_argument('--pool-min', type=int, default=0,
+                        help='每条线路预建立的最少空闲TCP连接数（默认0=关闭）')
+    parser.add_argument('--pool-max', type=int, default=16,
+                        help='每条线路最多保留的空闲连接数（默认16）')
+    parser.add_argument('--pool-idle-ttl', type=float, default=30,
+                        help='空闲预连接最长保留时间（秒，默认30）')
+    parser.add_argument('--udp-timeout', type=int, default=60,
+                        help='UDP会话空闲超时秒数，上下行任一方向有数据即刷新（默认60）')
+    parser.add_argument('--udp-port-timeout', nargs='+',
+                        help='按目标端口设置UDP会话空闲超时，如 53=10 443=120 27015-27030=300')
+    parser.add_argument('--max-udp-sessions', type=int, default=65536,
+                        help='UDP会话数上限，超出时淘汰最久未用的会话（默认65536，0=不限制）')
+    parser.add_argument('--peek-timeout', type=float, default=1.0,
+                        help='按包大小分流时等待TCP首包的秒数，超时走主线路（默认1.0）')
+    parser.add_argument('--race-delay', type=float, default=0,
+                        help='连接竞速：选中线路在该秒数内未完成握手则并行连接下一条线路（默认0=关闭，建议0.25）')
+    parser.add_argument('--max-tcp-conns', type=int, default=0,
+                        help='同时转发的TCP连接数上限（默认0=不限制）')
+    parser.add_argument('--max-udp-handlers', type=int, default=0,
+                        help='同时处理中的UDP数据包数上限（默认0=不限制）')
+    parser.add_argument('--max-flows-per-ip', type=int, default=0,
+                        help='单个客户端IP的活跃TCP连接+UDP会话数上限，超出直接拒绝（默认0=不限制）')
+    parser.add_argument('--overload', choices=OVERLOAD_POLICIES, default='reject',
+                        help='超出并发上限时: reject=立即拒绝(默认), queue=排队等待, shed=排队且队列满时丢弃等待最久的')
+    parser.add_argument('--queue-timeout', type=float, default=1.0,
+                        help='排队等待准入的最长秒数（默认1.0）')
+    parser.add_argument('--backlog', type=int, default=100,
+                        help='TCP监听队列长度（listen backlog，默认100）')
+    parser.add_argument('--listen-sockopt',
+                        help='监听socket选项，如 nodelay,rcvbuf=4M,keepalive=60:10:5,fastopen,user_timeout=30000,cc=bbr')
+    parser.add_argument('--target-sockopt', nargs='+',
+                        help='连接目标的socket选项，SPEC作用于所有线路，N:SPEC只作用于线路N（覆盖同名项）；'
+                             'fastopen使connect立即返回，故障转移与连接延迟统计失效，不能与--race-delay/--pool-min同用')
+    parser.add_argument('--line-rate', nargs='+',
+                        help='线路限速，如 rate=10M,pps=5000（字节/秒，上下行各自限制；up=/down=单独指定方向）；'
+                             'SPEC作用于每条线路，N:SPEC只作用于线路N')
+    parser.add_argument('--shape-policy', choices=SHAPE_POLICIES, default='queue',
+                        help='UDP超出线路限速时: queue=排队等待(默认), drop=直接丢弃')
+    parser.add_argument('--shape-max-delay', type=float, default=0.1,
+                        help='UDP限速排队的最长等待秒数，超出则丢弃（默认0.1）')
+    parser.add_argument('--bond', choices=['client', 'server'],
+                        help='多线路绑定：client将每条TCP连接拆分到所有线路，server重组后转发到唯一的目标')
+    parser.add_argument('--bond-chunk', type=int, default=16384,
+                        help='绑定模式的切块大小（字节，默认16384）')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Prometheus指标HTTP端口（默认0=关闭）')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='指标服务监听地址（默认127.0.0.1）')
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help='每连接/每会话日志采样，每N条记录1条（默认1=全部记录）')
+    parser.add_argument('--log-queue-size', type=int, default=10000,
+                        help='日志队列长度，队列满时丢弃并计数（默认10000）')
     parser.add_argument('-d', '--daemon', action='store_true',
                         help='后台运行')
     parser.add_argument('--log-file', 
@@ -662,26 +5326,135 @@ GitHub: https://github.com/Lorry-San/route-load-balancing
     parser.add_argument('--stop', action='store_true',
                         help='停止后台进程')
     parser.add_argument('--status', action='store_true',
-                        help='查看运行状态')
+                        help='查看运行状态（实时统计，终端中每秒刷新）')
+    parser.add_argument('--reload', action='store_true',
+                        help='让运行中的实例重新加载配置文件中的线路（同 kill -HUP）')
+    parser.add_argument('--upgrade', action='store_true',
+                        help='平滑升级：从运行中的旧进程接管监听socket后启动，旧进程不再接受新连接')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='交出监听socket后等待在途连接结束的最长秒数（默认60）')
+    parser.add_argument('--bench', action='store_true',
+                        help='运行本地基准测试并输出JSON结果')
+    parser.add_argument('--bench-mb', type=int, default=256,
+                        help='吞吐测试传输量（MB，默认256）')
+    parser.add_argument('--bench-output',
+                        help='基准测试结果输出文件')
+    parser.add_argument('--bench-scenarios', nargs='+', choices=['connect', 'throughput', 'udp', 'udp-stream'],
+                        default=['connect', 'throughput', 'udp', 'udp-stream'],
+                        help='基准测试场景（默认全部）')
+    parser.add_argument('--bench-replies', type=int, default=8,
+                        help='udp-stream场景中每个请求的回包数（默认8）')
+    parser.add_argument('--bench-targets', nargs='+', type=int, default=[2, 6],
+                        help='基准测试的线路数（2-6，默认 2 6）')
+    parser.add_argument('--bench-concurrency', type=int, default=32,
+                        help='基准测试并发客户端数（默认32）')
+    parser.add_argument('--bench-seconds', type=float, default=3,
+                        help='新建连接/UDP场景每项持续秒数（默认3）')
     parser.add_argument('-v', '--version', action='version',
                         version=f'%(prog)s {__version__}')
     
-    args = parser.parse_args()
+    try:
+        args = parse_args(parser, sys.argv[1:])
+    except (OSError, ValueError) as e:
+        print(f"错误: 无法读取配置文件: {e}")
+        sys.exit(1)
+    
+    # 多监听配置文件未指定-l时，--stop/--status 作用于文件中的所有监听
+    if args.listen_port:
+        ports = [args.listen_port]
+    else:
+        ports = [listener.listen_port for listener in args.listeners or [] if listener.listen_port]
     
     # 停止服务
     if args.stop:
-        if not args.listen_port:
+        if not ports:
             print("错误: 需要指定 -l/--listen-port")
             sys.exit(1)
-        stop_daemon(args.listen_port)
+        for port in ports:
+            stop_daemon(port)
         sys.exit(0)
     
     # 查看状态
     if args.status:
+        if not ports:
+            print("错误: 需要指定 -l/--listen-port")
+            sys.exit(1)
+        show_status(ports)
+        sys.exit(0)
+    
+    # 重新加载配置
+    if args.reload:
         if not args.listen_port:
             print("错误: 需要指定 -l/--listen-port")
             sys.exit(1)
-        show_status(args.listen_port)
+        try:
+            reply = send_control_command(args.listen_port, 'reload')
+        except (OSError, EOFError, ValueError) as e:
+            print(f"无法连接负载均衡器（端口 {args.listen_port}）的控制socket: {e}")
+            sys.exit(1)
+        if not reply.get('ok'):
+            print(f"重新加载失败: {reply.get('error')}")
+            sys.exit(1)
+        print(f"已重新加载，线路: {' '.join(reply['targets'])}，主线路: 目标{reply['primary']}")
+        sys.exit(0)
+    
+    # 基准测试
+    if args.bench:
+        if any(count < 2 or count > 6 for count in args.bench_targets):
+            print("错误: 基准测试线路数必须在2-6之间")
+            sys.exit(1)
+        run_bench(args)
+        sys.exit(0)
+    
+    # 多监听：一个进程承载配置文件中的所有监听
+    if args.listeners:
+        if args.workers > 1 or any(listener.workers > 1 for listener in args.listeners):
+            print("错误: 多监听模式在单进程中运行，不支持 --workers")
+            sys.exit(1)
+        seen = set()
+        for listener in args.listeners:
+            if not listener.listen_port or not listener.targets:
+                print("错误: listeners 中的每一项都需要 listen_port 和 targets")
+                sys.exit(1)
+            if listener.listen_port in seen:
+                print(f"错误: 监听端口 {listener.listen_port} 重复")
+                sys.exit(1)
+            seen.add(listener.listen_port)
+        
+        def listener_loader(port):
+            # 重载时重新读取配置文件，按端口找到该监听的线路
+            def load_targets():
+                for listener in parse_args(parser, sys.argv[1:]).listeners or []:
+                    if listener.listen_port == port:
+                        return resolve_targets(listener)
+                raise ValueError(f"配置文件中已没有端口 {port} 的监听")
+            return load_targets
+        
+        try:
+            # 后台化、日志和指标服务取顶层配置，由第一个监听负责
+            balancers = [
+                create_balancer(listener, config_loader=listener_loader(listener.listen_port),
+                                daemon=args.daemon, log_file=args.log_file,
+                                metrics_port=args.metrics_port if i == 0 else 0,
+                                metrics_host=args.metrics_host)
+                for i, listener in enumerate(args.listeners)
+            ]
+            group = ListenerGroup(balancers)
+            
+            if args.daemon:
+                print(f"正在后台启动拼好线负载均衡器（{len(balancers)} 个监听）...")
+                for lb in balancers:
+                    print(f"端口: {lb.listen_port}  线路数: {lb.target_count}  主线路: 目标{lb.primary_index + 1}")
+                print(f"日志文件: {args.log_file or f'/var/log/loadbalancer_{balancers[0].listen_port}.log'}")
+                print(f"\n使用以下命令管理:")
+                print(f"  查看状态: bs2 --status -c {args.config}")
+                print(f"  停止全部: bs2 --stop -c {args.config}")
+                print(f"  停止单个监听: bs2 --stop -l <端口>")
+            
+            group.start()
+        except Exception as e:
+            print(f"错误: {e}")
+            sys.exit(1)
         sys.exit(0)
     
     # 启动服务
@@ -689,42 +5462,22 @@ GitHub: https://github.com/Lorry-San/route-load-balancing
         parser.print_help()
         sys.exit(1)
     
-    # 验证目标数量
-    if len(args.targets) < 2 or len(args.targets) > 6:
-        print("错误: 目标数量必须在2-6之间")
-        sys.exit(1)
-    
-    # 验证主线路编号
-    if args.primary < 1 or args.primary > len(args.targets):
-        print(f"错误: 主线路编号必须在1-{len(args.targets)}之间")
+    if args.bond == 'server' and args.workers > 1:
+        print("错误: 绑定服务端的同一会话须由同一进程重组，不支持多进程")
         sys.exit(1)
     
-    # 确定协议
-    if args.protocol == 'both':
-        protocols = ['tcp', 'udp']
-    else:
-        protocols = [args.protocol]
-    
     try:
-        # 解析所有目标
-        targets = [parse_target(t, args.target_host) for t in args.targets]
-        
-        balancer = MultiLineLoadBalancer(
-            listen_host=args.host,
-            listen_port=args.listen_port,
-            targets=targets,
-            small_packet_size=args.size,
-            mode=args.mode,
-            protocols=protocols,
-            daemon=args.daemon,
-            log_file=args.log_file,
-            primary=args.primary
-        )
+        # 重载时重新读取配置文件，命令行参数仍然优先
+        def load_targets():
+            return resolve_targets(parse_args(parser, sys.argv[1:]))
+        
+        # 验证并解析所有目标（数量、主线路编号、权重）
+        balancer = create_balancer(args, config_loader=load_targets if args.config else None)
         
         if args.daemon:
             print(f"正在后台启动拼好线负载均衡器...")
             print(f"端口: {args.listen_port}")
-            print(f"线路数: {len(targets)}")
+            print(f"线路数: {balancer.target_count}")
             print(f"主线路: 目标{args.primary}")
             print(f"日志文件: {args.log_file or f'/var/log/loadbalancer_{args.listen_port}.log'}")
             print(f"PID文件: /tmp/loadbalancer_{args.listen_port}.pid")
@@ -0,0 +1,600 @@
+"""bs2 单元测试"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bs2  # noqa: E402
+
+
+def make_balancer(targets=4, **kwargs):
+    lb = bs2.MultiLineLoadBalancer('127.0.0.1', 0, [('127.0.0.1', 41000 + i) for i in range(targets)], **kwargs)
+    lb.logger.disabled = True
+    return lb
+
+
+def clients(count):
+    return [(f"10.{i // 65536}.{i // 256 % 256}.{i % 256}", 5000) for i in range(count)]
+
+
+# ========== 缓冲池 ==========
+def test_buffer_pool_reuses_and_caps():
+    pool = bs2.BufferPool(128, max_buffers=2, preallocate=1)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert len(first) == len(second) == 128
+    assert (pool.hits, pool.misses) == (1, 1)
+
+    pool.release(first)
+    pool.release(second)
+    pool.release(bytearray(128))  # 超出上限的直接丢弃
+    assert len(pool.free) == 2
+    assert pool.acquire() is second
+
+
+# ========== 多进程模式 ==========
+def test_worker_log_records_go_through_channel():
+    sent = []
+    logger = bs2.logging.getLogger('bs2-test-worker')
+    logger.propagate = False
+    logger.addHandler(bs2.ChannelLogHandler(sent.append))
+    logger.warning("线路 %d 失败", 2)
+    level, text, created = sent[0]['log']
+    assert (level, text) == (bs2.logging.WARNING, "线路 2 失败")
+    assert created > 0
+
+
+# ========== 分流策略 ==========
+def test_strategy_must_implement_select():
+    class Incomplete(bs2.BalanceStrategy):
+        name = 'incomplete'
+
+    with pytest.raises(TypeError):
+        Incomplete(None)
+
+
+def test_least_conn_picks_least_active_line():
+    lb = make_balancer(targets=3, mode='least-conn')
+    for index, flows in ((0, 2), (1, 1), (2, 3)):
+        for _ in range(flows):
+            lb.flow_started('tcp', index)
+    assert lb.strategy.select('tcp', ('10.0.0.1', 5000), 64)[0] == 1
+    lb.flow_started('udp', 1)
+    lb.flow_started('udp', 1)
+    assert lb.strategy.select('udp', ('10.0.0.1', 5000), 64)[0] == 0
+
+
+# ========== 加权分流 ==========
+def test_parse_target_weight_suffix():
+    assert bs2.parse_target('10.0.0.2:443@3', '127.0.0.1') == (('10.0.0.2', 443), 3)
+    assert bs2.parse_target('8080', '127.0.0.1') == (('127.0.0.1', 8080), 1)
+    with pytest.raises(ValueError):
+        bs2.parse_target('8080@0', '127.0.0.1')
+
+
+def test_smooth_weighted_round_robin_shares():
+    lb = make_balancer(targets=3, weights=[5, 1, 1])
+    picks = [lb.smooth_weighted_select('tcp', None) for _ in range(70)]
+    assert [picks.count(i) for i in range(3)] == [50, 10, 10]
+    # 平滑：高权重线路不会连续占满一个周期
+    assert picks[:7] == [0, 0, 1, 0, 2, 0, 0]
+    allowed = [lb.smooth_weighted_select('udp', [1, 2]) for _ in range(10)]
+    assert sorted(set(allowed)) == [1, 2] and allowed.count(1) == 5
+
+
+# ========== 预连接池 ==========
+def test_upstream_pool_skips_dead_and_expired_connections():
+    pool = bs2.UpstreamPool(min_size=1, max_size=3, idle_ttl=60)
+    alive, alive_peer = bs2.socket.socketpair()
+    dead, dead_peer = bs2.socket.socketpair()
+    dead_peer.close()
+    pool.put(alive, 0.001)
+    pool.put(dead, 0.001)
+    assert pool.acquire() is alive  # 后放入的死连接被丢弃
+    assert dead.fileno() == -1
+    assert pool.acquire() is None
+    assert (pool.hits, pool.misses, pool.want) == (1, 1, 2)
+    assert pool.wakeup.is_set()
+
+    stale, stale_peer = bs2.socket.socketpair()
+    pool.idle.append((stale, bs2.time.time() - 120))
+    assert pool.prune() == 1  # 过期连接被关闭，目标空闲数回落到1
+    assert not pool.idle and pool.want == 1
+    for sock in (alive, alive_peer, stale_peer):
+        sock.close()
+
+
+# ========== UDP会话表 ==========
+def make_session(client):
+    return lambda: bs2.UdpSession(client, None, 0, None, 60)
+
+
+def test_session_cap_is_global():
+    table = bs2.UdpSessionTable(max_sessions=4)
+    evicted = []
+    for i in range(40):
+        session, is_new, dropped = table.get_or_create(('1.1.1.1', i), make_session(('1.1.1.1', i)))
+        assert is_new
+        evicted += dropped
+        assert len(table) == min(i + 1, 4)
+    # 淘汰按全表最久未用的顺序
+    assert [s.client[1] for s in evicted] == list(range(36))
+    assert table.counts() == (36, 0)
+
+
+def test_session_lru_refreshed_by_lookup_and_touch():
+    table = bs2.UdpSessionTable(max_sessions=2)
+    a, _, _ = table.get_or_create('a', make_session('a'))
+    time.sleep(0.002)
+    b, _, _ = table.get_or_create('b', make_session('b'))
+    time.sleep(0.002)
+    assert table.get_or_create('a', make_session('a'))[:2] == (a, False)
+    time.sleep(0.002)
+    _, _, evicted = table.get_or_create('c', make_session('c'))
+    assert evicted == [b]
+
+    # 只有回包的会话同样保持最近使用
+    time.sleep(0.002)
+    table.touch(a)
+    time.sleep(0.002)
+    _, _, evicted = table.get_or_create('d', make_session('d'))
+    assert [s.client for s in evicted] == ['c']
+
+
+def test_touch_ignores_evicted_session():
+    table = bs2.UdpSessionTable(max_sessions=1)
+    a, _, _ = table.get_or_create('a', make_session('a'))
+    time.sleep(0.002)
+    table.get_or_create('b', make_session('b'))
+    table.touch(a)
+    assert len(table) == 1
+    assert table.shard('a').sessions.get('a') is None
+
+
+def test_session_expire():
+    table = bs2.UdpSessionTable()
+    session, _, _ = table.get_or_create('a', make_session('a'))
+    session.last_seen -= 120
+    # 时间轮落后一圈以上时所有格子都会被处理
+    for shard in table.shards:
+        shard.tick -= bs2.UdpSessionTable.WHEEL_SLOTS
+    assert table.expire() == [session]
+    assert len(table) == 0
+    assert table.counts() == (0, 1)
+
+
+def test_session_clear_returns_all_sessions():
+    table = bs2.UdpSessionTable()
+    created = [table.get_or_create(c, make_session(c))[0] for c in 'abc']
+    assert sorted(s.client for s in table.clear()) == ['a', 'b', 'c']
+    assert len(table) == 0 and table.expire() == []
+    assert table.get_or_create('a', make_session('a'))[0] is not created[0]
+
+
+# ========== 多线路绑定 ==========
+def test_bond_session_reorders_frames():
+    lb = make_balancer(targets=2)
+    session = bs2.BondSession(lb, b'\0' * 16)
+    peer, other = bs2.socket.socketpair()
+    session.peer = peer
+    writer = bs2.threading.Thread(target=session.run_writer, daemon=True)
+    writer.start()
+    for seq, payload, fin in ((2, b'c', False), (0, b'a', False), (3, b'', True), (1, b'b', False)):
+        assert session.deliver(seq, payload, fin)
+    writer.join(5)
+    other.settimeout(5)
+    received = b''
+    while True:
+        chunk = other.recv(16)
+        if not chunk:
+            break
+        received += chunk
+    assert received == b'abc'
+    assert session.fin_received and not session.pending
+    session.close()
+    other.close()
+
+
+# ========== 配置文件、热重载与平滑升级 ==========
+def make_parser():
+    parser = bs2.argparse.ArgumentParser()
+    parser.add_argument('-c', '--config')
+    parser.add_argument('-l', '--listen-port', type=int)
+    parser.add_argument('-t', '--targets', nargs='+')
+    parser.add_argument('-m', '--mode', choices=['auto', 'size'], default='auto')
+    parser.add_argument('-d', '--daemon', action='store_true')
+    return parser
+
+
+def test_config_values_go_through_argparse(tmp_path):
+    path = tmp_path / 'bs2.json'
+    path.write_text('{"listen-port": "40001", "targets": [40002, "40003@2"], "daemon": true}')
+    args = bs2.parse_args(make_parser(), ['-c', str(path), '-m', 'size'])
+    assert (args.listen_port, args.targets, args.daemon, args.mode) == (40001, ['40002', '40003@2'], True, 'size')
+    # 命令行参数优先于配置文件
+    assert bs2.parse_args(make_parser(), ['-c', str(path), '-l', '40009']).listen_port == 40009
+
+
+@pytest.mark.parametrize('config', [
+    '{"listen_port": "abc"}', '{"mode": "bogus"}', '{"daemon": "yes"}', '{"listen_port": [1]}', '{"colour": 1}',
+])
+def test_invalid_config_values_raise_value_error(tmp_path, config):
+    path = tmp_path / 'bs2.json'
+    path.write_text(config)
+    with pytest.raises(ValueError):
+        bs2.parse_args(make_parser(), ['-c', str(path)])
+
+
+def test_listener_entries_override_command_line(tmp_path):
+    path = tmp_path / 'bs2.json'
+    path.write_text('{"mode": "size", "listeners": [{"listen_port": 40001}, {"listen_port": 40002, "mode": "auto"}]}')
+    args = bs2.parse_args(make_parser(), ['-c', str(path), '-t', '40003', '40004'])
+    assert [(l.listen_port, l.mode, l.targets) for l in args.listeners] == [
+        (40001, 'size', ['40003', '40004']), (40002, 'auto', ['40003', '40004'])]
+    path.write_text('{"listeners": [{"listen_port": 40001, "mode": "bogus"}]}')
+    with pytest.raises(ValueError):
+        bs2.parse_args(make_parser(), ['-c', str(path)])
+
+
+def test_listener_group_closes_replaced_selectors():
+    balancers = [make_balancer(targets=2), make_balancer(targets=2)]
+    own = [lb.udp_selector for lb in balancers]
+    group = bs2.ListenerGroup(balancers)
+    assert all(lb.udp_selector is group.udp_selector for lb in balancers)
+    for selector in own:
+        with pytest.raises((ValueError, OSError)):
+            selector.select(0)
+    group.udp_selector.close()
+
+
+def test_reload_keeps_per_target_counters_with_their_target():
+    lb = make_balancer(targets=3)
+    a, b, c = lb.targets
+    lb.update_stats('tcp', a)
+    lb.update_stats('tcp', c)
+    lb.update_stats('tcp', c)
+    lb.apply_targets([c, a], [1, 1], 1)
+    assert lb.lines.targets == [c, a] and lb.target_count == 2
+    assert lb.snapshot_stats()['tcp']['targets'] == [2, 1]
+    # 重载前选出的越界下标改用主线路
+    assert lb.resolve_line(2)[1] == 0
+
+
+def test_handoff_passes_listener_to_new_process(tmp_path):
+    old = make_balancer(targets=2, protocols=['tcp'])
+    old.running = True
+    old.control_path = str(tmp_path / 'control.sock')
+    old.tcp_server = old.create_listener(bs2.socket.SOCK_STREAM)
+    port = old.tcp_server.getsockname()[1]
+    old.start_control_server()
+    new = make_balancer(targets=2, protocols=['tcp'])
+    new.control_path = old.control_path
+    try:
+        new.take_over_listeners()
+        inherited = new.inherited_listeners['tcp']
+        assert inherited.getsockname()[1] == port
+        assert old.draining and old.control_server is None
+        # 接管后的监听socket仍接受连接
+        bs2.socket.create_connection(('127.0.0.1', port), timeout=2).close()
+    finally:
+        old.running = False
+        old.tcp_server.close()
+        for sock in new.inherited_listeners.values():
+            sock.close()
+
+
+# ========== 准入控制 ==========
+def make_gate(policy, limit=2, queue_timeout=60):
+    dropped = []
+    gate = bs2.AdmissionGate(limit, policy, queue_timeout, lambda item, reason: dropped.append((item, reason)))
+    return gate, dropped
+
+
+def test_admission_gate_reject():
+    gate, dropped = make_gate('reject')
+    assert gate.admit('a') and gate.admit('b')
+    assert not gate.admit('c')
+    assert dropped == [('c', 'reject')]
+    assert gate.release() is None and gate.active == 1
+
+
+def test_admission_gate_queue_hands_slot_to_waiter():
+    gate, dropped = make_gate('queue')
+    assert gate.admit('a') and gate.admit('b')
+    assert not gate.admit('c') and not gate.admit('d')
+    assert not gate.admit('e')  # 队列已满，拒绝新来的
+    assert dropped == [('e', 'reject')]
+    # 名额直接交给队首，活跃数不变
+    assert gate.release() == 'c' and gate.active == 2
+    assert gate.release() == 'd'
+    assert gate.release() is None and gate.release() is None and gate.active == 0
+
+
+def test_admission_gate_shed_drops_oldest_waiter():
+    gate, dropped = make_gate('shed', limit=1)
+    assert gate.admit('a')
+    assert not gate.admit('b')
+    assert not gate.admit('c')
+    assert dropped == [('b', 'shed')]
+    assert gate.release() == 'c'
+
+
+def test_admission_gate_expires_waiters():
+    gate, dropped = make_gate('queue', limit=1, queue_timeout=0)
+    assert gate.admit('a')
+    assert not gate.admit('b')
+    gate.expire()
+    assert dropped == [('b', 'timeout')]
+    assert gate.release() is None and gate.active == 0
+
+
+def test_async_tcp_client_releases_slot_when_cancelled():
+    lb = make_balancer(targets=2, max_tcp_conns=1, overload='queue')
+    queued, queued_peer = bs2.socket.socketpair()
+
+    async def scenario():
+        async def handle(client_socket, client_address):
+            await bs2.asyncio.sleep(60)
+        lb.handle_tcp_client_async = handle
+        assert lb.tcp_gate.admit((None, ('10.0.0.1', 1)))
+        assert not lb.tcp_gate.admit((queued, ('10.0.0.2', 1)))
+        task = bs2.asyncio.ensure_future(lb.run_tcp_client_async((None, ('10.0.0.1', 1))))
+        await bs2.asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(bs2.asyncio.CancelledError):
+            await task
+
+    bs2.asyncio.run(scenario())
+    assert lb.tcp_gate.active == 0 and not lb.tcp_gate.waiting
+    assert queued.fileno() == -1  # 转交过来的排队连接被关闭
+    queued_peer.close()
+
+
+# ========== socket选项 ==========
+def test_socket_profile_parse():
+    profile = bs2.SocketProfile.parse('nodelay,sndbuf=4M,keepalive=60:10:5,cc=bbr')
+    assert profile.options == {'nodelay': True, 'sndbuf': 4 * 1024 ** 2, 'keepalive': (60, 10, 5), 'cc': 'bbr'}
+    assert bs2.SocketProfile.parse('nodelay=0,user-timeout=3000').options == {'nodelay': False, 'user_timeout': 3000}
+
+
+@pytest.mark.parametrize('spec', ['tos=1', 'sndbuf', 'rcvbuf=big'])
+def test_socket_profile_parse_invalid(spec):
+    with pytest.raises(ValueError):
+        bs2.SocketProfile.parse(spec)
+
+
+def test_line_profile_overrides_shared_options():
+    lb = make_balancer(target_sockopt=['nodelay,rcvbuf=1M', '2:rcvbuf=4M'])
+    assert lb.line_profile(0).options == {'nodelay': True, 'rcvbuf': 1024 ** 2}
+    assert lb.line_profile(1).options == {'nodelay': True, 'rcvbuf': 4 * 1024 ** 2}
+
+
+@pytest.mark.parametrize('kwargs', [{'race_delay': 0.05}, {'pool_min': 2}])
+def test_upstream_fastopen_refused_with_race_or_pool(kwargs):
+    with pytest.raises(ValueError):
+        make_balancer(target_sockopt=['3:fastopen'], **kwargs)
+    assert make_balancer(target_sockopt=['3:fastopen']).line_fastopen(2)
+
+
+# ========== 实时统计 ==========
+def test_rate_tracker_rates_and_reset_on_reorder(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(bs2.time, 'monotonic', lambda: now[0])
+    tracker = bs2.RateTracker(windows=(1, 10))
+    assert tracker.rates() == {'1': None, '10': None}
+    for second, value in enumerate((0, 10, 30)):
+        now[0] = 100.0 + second
+        tracker.record({'bytes_in': [value, 0]}, ['a', 'b'])
+    rates = tracker.rates()
+    assert rates['1'] == {'bytes_in': [20.0, 0.0]}
+    assert rates['10'] == {'bytes_in': [15.0, 0.0]}  # 不满窗口时按最早的样本
+
+    now[0] = 103.0
+    tracker.record({'bytes_in': [0, 30]}, ['b', 'a'])  # 重载调整了线路顺序
+    assert tracker.rates() == {'1': None, '10': None}
+
+
+# ========== 线路限速 ==========
+@pytest.mark.parametrize('value, expected', [
+    ('512', 512), ('4K', 4096), ('4m', 4 * 1024 ** 2), ('1.5G', 1.5 * 1024 ** 3),
+])
+def test_parse_size(value, expected):
+    assert bs2.parse_size(value) == expected
+
+
+@pytest.mark.parametrize('value', ['0', '-1K', 'abc', ''])
+def test_parse_size_invalid(value):
+    with pytest.raises(ValueError):
+        bs2.parse_size(value)
+
+
+def test_line_shaper_parse():
+    assert bs2.LineShaper.parse('rate=10M, pps=5000') == {'rate': 10 * 1024 ** 2, 'pps': 5000.0}
+    assert bs2.LineShaper.parse('up=1M,down=4M,burst=64K') == {'up': 1024 ** 2, 'down': 4 * 1024 ** 2, 'burst': 65536}
+
+
+@pytest.mark.parametrize('spec', ['burst=64K', 'rate=0', 'speed=1M', 'pps=x'])
+def test_line_shaper_parse_invalid(spec):
+    with pytest.raises(ValueError):
+        bs2.LineShaper.parse(spec)
+
+
+def test_parse_line_specs():
+    merge = lambda a, b: {**a, **b}
+    common, lines = bs2.parse_line_specs(['rate=1M', '2:pps=100', '2:rate=2M'], 3, bs2.LineShaper.parse, merge, '--line-rate')
+    assert common == {'rate': 1024 ** 2}
+    assert lines == {2: {'rate': 2 * 1024 ** 2, 'pps': 100.0}}
+    with pytest.raises(ValueError):
+        bs2.parse_line_specs(['4:rate=1M'], 3, bs2.LineShaper.parse, merge, '--line-rate')
+
+
+def test_token_bucket_refill_is_capped_at_burst():
+    bucket = bs2.TokenBucket(1000, 500)
+    bucket.tokens = 0
+    bucket.refill(bucket.stamp + 0.2)
+    assert bucket.tokens == pytest.approx(200)
+    bucket.refill(bucket.stamp + 10)
+    assert bucket.tokens == 500
+    assert bucket.delay(300) == 0
+    assert bucket.delay(5000) == 0  # 超过容量的请求在桶满时即可取
+
+
+def test_line_shaper_reserve_runs_into_debt(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(bs2.time, 'monotonic', lambda: now[0])
+    shaper = bs2.LineShaper({'rate': 1000, 'burst': 1000})
+    assert shaper.reserve('up', 1000) == 0.0
+    assert shaper.reserve('up', 500) == pytest.approx(0.5)  # 欠账由后来者等待
+    assert shaper.reserve('up', 500) == pytest.approx(1.0)
+    assert shaper.reserve('up', 500, max_wait=0.5) is None  # 超过max_wait时不预约
+    now[0] += 1.0
+    assert shaper.reserve('down', 10 ** 6) == 0.0  # 下行不受影响
+    assert shaper.reserve('up', 500) == pytest.approx(0.5)
+
+
+def test_udp_shaping_counters_follow_target():
+    lb = make_balancer(line_rate=['2:pps=1'], shape_policy='drop')
+    target = lb.targets[1]
+    assert lb.shape_udp_packet(1, target, 'up', 100) == 0.0
+    assert lb.shape_udp_packet(1, target, 'up', 100) is None
+    assert lb.shape_udp_packet(0, lb.targets[0], 'up', 100) == 0.0  # 线路1未限速
+    assert lb.snapshot_stats()['shaping']['dropped']['up'] == [0, 1, 0, 0]
+
+
+def test_bond_links_are_shaped_per_target():
+    lb = make_balancer(targets=2, line_rate=['1:rate=1M,burst=16K'])
+    session = bs2.BondSession(lb, b'\1' * 16)
+    listener = bs2.socket.create_server(('127.0.0.1', 0))
+    sock = bs2.socket.create_connection(listener.getsockname())
+    other, _ = listener.accept()
+    listener.close()
+    session.add_link(0, sock, 1e6, lb.targets[0])
+    link = session.links[0]
+    frame = bs2.BOND_FRAME.pack(0, 8192, 0) + b'x' * 8192
+    with session.cond:
+        for _ in range(3):
+            link.queue.append(frame)
+            link.queued += len(frame)
+        session.cond.notify_all()
+    other.settimeout(5)
+    received = 0
+    while received < 3 * len(frame):
+        received += len(other.recv(65536))
+    deadline = time.time() + 5
+    while lb.snapshot_stats()['tcp']['bytes_in'][0] < 3 * 8192 and time.time() < deadline:
+        time.sleep(0.01)  # 发送线程在sendall之后才计数
+    snapshot = lb.snapshot_stats()
+    assert snapshot['shaping']['throttle_seconds']['tcp'][0] > 0
+    assert snapshot['shaping']['throttle_seconds']['tcp'][1] == 0
+    assert snapshot['tcp']['bytes_in'] == [3 * 8192, 0]
+    session.close()
+    other.close()
+
+
+# ========== UDP会话超时 ==========
+def test_parse_port_timeouts():
+    assert bs2.parse_port_timeouts(['53=10', '27015-27030=300']) == [(53, 53, 10.0), (27015, 27030, 300.0)]
+    for spec in ('53', '53=0', '100-50=10', '70000=5', 'dns=10'):
+        with pytest.raises(ValueError):
+            bs2.parse_port_timeouts([spec])
+
+
+def test_udp_session_timeout_by_target_port():
+    lb = make_balancer(udp_port_timeouts=[(41001, 41001, 10.0), (41000, 41003, 300.0)])
+    assert [lb.udp_session_timeout(t) for t in lb.targets] == [300.0, 10.0, 300.0, 300.0]
+    assert lb.udp_session_timeout(('127.0.0.1', 53)) == lb.udp_timeout
+
+
+# ========== 客户端哈希 ==========
+def test_hash_is_stable_and_moves_about_one_nth():
+    lb = make_balancer(targets=4, mode='hash')
+    keys = clients(4000)
+    before = {c: lb.strategy.select('tcp', c, None)[0] for c in keys}
+    assert before == {c: lb.strategy.select('udp', c, None)[0] for c in keys}
+
+    # 增加第5条线路：只有改落到新线路的客户端迁移，约1/5
+    lb.apply_targets(lb.targets + [('127.0.0.1', 41004)], [1] * 5, 1)
+    after = {c: lb.strategy.select('tcp', c, None)[0] for c in keys}
+    moved = [c for c in keys if after[c] != before[c]]
+    assert all(after[c] == 4 for c in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.25
+
+
+def test_hash_follows_weights():
+    lb = make_balancer(targets=2, mode='hash', weights=[1, 3])
+    picks = [lb.strategy.select('tcp', c, None)[0] for c in clients(4000)]
+    assert 0.7 < picks.count(1) / len(picks) < 0.8
+
+
+def test_hash_ignores_rtt_and_fails_over_by_score():
+    lb = make_balancer(targets=4, mode='hash', health_check=5)
+    keys = clients(2000)
+    before = {c: lb.strategy.select('tcp', c, None)[0] for c in keys}
+    for h in lb.health:
+        h.rtt = 0.001
+    lb.health[1].rtt = 0.5
+    assert before == {c: lb.strategy.select('tcp', c, None)[0] for c in keys}
+
+    # 剔除线路后，原客户端迁移到的线路即故障转移时的下一条线路
+    lb.health[2].ejected_until = time.time() + 30
+    for c in keys:
+        selected = lb.strategy.select('tcp', c, None)[0]
+        if before[c] == 2:
+            assert lb.strategy.failover_order(c, 2, lb.lines)[1] == selected
+        else:
+            assert selected == before[c]
+
+
+# ========== 自适应小包阈值 ==========
+def size_histogram(sizes):
+    histogram = [0] * (len(bs2.PACKET_SIZE_BUCKETS) + 1)
+    for size in sizes:
+        histogram[bs2.bisect.bisect_right(bs2.PACKET_SIZE_BUCKETS, size)] += 1
+    return histogram
+
+
+def test_size_threshold_converges_to_target():
+    lb = make_balancer(targets=2, mode='size', size_target=0.6, small_packet_size=1024)
+    # 首包大小在 40B..40KB 间对数均匀分布
+    histogram = size_histogram(int(40 * 1000 ** (i / 999)) for i in range(1000))
+    lb.update_size_threshold(histogram, 0)
+    threshold = lb.small_packet_size
+    assert threshold in bs2.PACKET_SIZE_BUCKETS
+    assert abs(lb.size_predicted - 0.6) <= bs2.SIZE_ADAPT_HYSTERESIS
+    # 按新阈值实际走主线路的比例与预计一致（大包轮询时主线路分得一半）
+    small = sum(histogram[:bs2.bisect.bisect_right(bs2.PACKET_SIZE_BUCKETS, threshold)]) / 1000
+    assert lb.size_predicted == pytest.approx(small + (1 - small) / 2)
+
+    # 分布不变时阈值保持不变
+    for _ in range(3):
+        lb.update_size_threshold(histogram, 0)
+        assert lb.small_packet_size == threshold
+
+
+def test_size_threshold_hysteresis():
+    lb = make_balancer(targets=2, mode='size', size_target=0.75, small_packet_size=1024)
+    histogram = size_histogram([100] * 500 + [5000] * 500)
+    lb.update_size_threshold(histogram, 0)
+    assert lb.small_packet_size == 1024
+    assert lb.size_predicted == pytest.approx(0.75)
+    # 占比偏离在滞回范围内不调整
+    lb.update_size_threshold(size_histogram([100] * 460 + [5000] * 540), 0)
+    assert lb.small_packet_size == 1024
+    # 超出滞回范围时调整
+    lb.update_size_threshold(size_histogram([100] * 200 + [2000] * 500 + [5000] * 300), 0)
+    assert 2000 < lb.small_packet_size <= 5000
+    assert lb.size_predicted == pytest.approx(0.85)
+
+
+def test_first_packet_histogram_le_is_inclusive():
+    lb = make_balancer(targets=2, mode='size')
+    bound = bs2.PACKET_SIZE_BUCKETS[3]
+    for size in (bound - 1, bound):
+        lb.strategy.select('tcp', ('10.0.0.1', 5000), size)
+    text = lb.render_metrics(lb.snapshot_stats())
+    # 恰为界值的首包落入下一格：le=界-1 的累计只含 bound-1
+    assert f'bs2_first_packet_bytes_bucket{{le="{bound - 1}"}} 1' in text
+    assert f'bs2_first_packet_bytes_bucket{{le="{bs2.PACKET_SIZE_BUCKETS[4] - 1}"}} 2' in text
+    assert 'bs2_first_packet_bytes_bucket{le="+Inf"} 2' in text